@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measures the cost of TLS handshakes, full and resumed
+
+A local CA and a server certificate are generated with the openssl command
+line tool.
+
+Usage: python benchmarks/tls.py [-n CONNECTIONS]
+"""
+
+import argparse
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+from threading import Thread
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dragonfly.client import Client
+from dragonfly.server import Server, State
+
+def make_certificates(path):
+    """Generates a self-signed CA and a certificate it signs for localhost
+
+    Args:
+        path (str): Directory to write the files to.
+
+    Returns:
+        tuple[str, str, str]: The paths of the CA certificate, the server
+            certificate and the server key.
+    """
+
+    ca, ca_key = os.path.join(path, "ca.pem"), os.path.join(path, "ca.key")
+    cert, key = os.path.join(path, "server.pem"), os.path.join(path, "server.key")
+    csr, ext = os.path.join(path, "server.csr"), os.path.join(path, "ext")
+
+    with open(ext, "w") as f:
+        f.write("subjectAltName=DNS:localhost,IP:127.0.0.1\n")
+
+    for args in [
+        ["req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", ca_key,
+         "-out", ca, "-days", "1", "-subj", "/CN=Dragonfly benchmark CA"],
+        ["req", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", csr,
+         "-subj", "/CN=localhost"],
+        ["x509", "-req", "-in", csr, "-CA", ca, "-CAkey", ca_key, "-CAcreateserial",
+         "-out", cert, "-days", "1", "-extfile", ext]
+    ]:
+        subprocess.run(["openssl"] + args, check=True, capture_output=True)
+
+    return ca, cert, key
+
+def server_cpu_time(thread):
+    """Returns the CPU time used by the server's thread
+
+    Args:
+        thread (Thread): The thread running the server.
+
+    Returns:
+        float: The CPU time in seconds, or NaN if not supported.
+    """
+
+    if not hasattr(time, "pthread_getcpuclockid"):
+        return float("nan")
+
+    return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+
+def connections(port, context, n, resume, thread):
+    """Measures connections to the server
+
+    Args:
+        port (int): The server's port.
+        context (ssl.SSLContext): The client context, or None for plain TCP.
+        n (int): Number of connections.
+        resume (bool): Whether to resume the previous connection's session.
+        thread (Thread): The thread running the server.
+
+    Returns:
+        tuple[float, float]: The median time until CONNECTED and the server's
+            CPU time per connection, in seconds.
+    """
+
+    session = None
+    times = []
+    cpu = server_cpu_time(thread)
+
+    for _ in range(n):
+        client = Client(ssl_context=context)
+        if resume:
+            client.tls_session = session
+
+        start = time.perf_counter()
+        client.connect("localhost", port).result()
+        times.append(time.perf_counter() - start)
+
+        session = client.tls_session
+        client.disconnect()
+
+    cpu = (server_cpu_time(thread) - cpu) / n
+
+    return sorted(times)[len(times) // 2], cpu
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--connections", type=int, default=200, help="connections per run")
+    args = parser.parse_args()
+
+    if shutil.which("openssl") is None:
+        sys.exit("The openssl command line tool is required")
+
+    tmp = tempfile.mkdtemp()
+    ca, cert, key = make_certificates(tmp)
+
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert, key)
+    client_context = ssl.create_default_context(cafile=ca)
+
+    plain = Server(port=0)
+    tls = Server(port=0, ssl_context=server_context)
+    threads = {}
+    for server in [plain, tls]:
+        threads[server] = Thread(target=server.start, daemon=True)
+        threads[server].start()
+        while server.state != State.RUNNING:
+            time.sleep(0.01)
+
+    runs = {
+        "tcp": (plain, False),
+        "tls full": (tls, False),
+        "tls resumed": (tls, True)
+    }
+
+    print(f"{'handshake':<12} {'connect (ms)':>13} {'server cpu (ms)':>16}")
+    for name, (server, resume) in runs.items():
+        context = client_context if server is tls else None
+        port = server.socket.getsockname()[1]
+        lat, cpu = connections(port, context, args.connections, resume, threads[server])
+        print(f"{name:<12} {lat * 1e3:>13.2f} {cpu * 1e3:>16.2f}")
+
+    for server in [plain, tls]:
+        server.stop()
+
+    shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Compares the latency and throughput of the available transports
+
+Usage: python benchmarks/transports.py [-n MESSAGES] [-s SIZE]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from threading import Event, Thread
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dragonfly.client import Client
+from dragonfly.server import Server, State
+
+def latency(client, n):
+    """Measures round trips of a small message through the server
+
+    Args:
+        client (Client): A connected client.
+        n (int): Number of round trips.
+
+    Returns:
+        float: The median round trip time, in seconds.
+    """
+
+    received = Event()
+    client.on_message = lambda self, topic, msg: received.set()
+    client.subscribe("latency").result()
+
+    times = []
+    for _ in range(n):
+        received.clear()
+        start = time.perf_counter()
+        client.publish("latency", b"x")
+        received.wait()
+        times.append(time.perf_counter() - start)
+
+    client.unsubscribe("latency").result()
+
+    return sorted(times)[len(times) // 2]
+
+def throughput(publisher, subscriber, n, size):
+    """Measures the rate at which messages are relayed
+
+    Args:
+        publisher (Client): A connected client publishing the messages.
+        subscriber (Client): A connected client receiving them.
+        n (int): Number of messages.
+        size (int): Size of each message, in bytes.
+
+    Returns:
+        float: Messages per second.
+    """
+
+    done = Event()
+    count = [0]
+
+    def on_message(self, topic, msg):
+        count[0] += 1
+        if count[0] == n:
+            done.set()
+
+    subscriber.on_message = on_message
+    subscriber.subscribe("throughput").result()
+
+    body = os.urandom(size)
+    start = time.perf_counter()
+    for _ in range(n):
+        publisher.publish("throughput", body)
+
+    done.wait()
+    elapsed = time.perf_counter() - start
+    subscriber.unsubscribe("throughput").result()
+
+    return n / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--messages", type=int, default=20000, help="messages per throughput run")
+    parser.add_argument("-s", "--size", type=int, default=256, help="message size in bytes")
+    parser.add_argument("-r", "--round-trips", type=int, default=2000, help="latency round trips")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, "dragonfly.sock")
+    shm_path = os.path.join(tmp, "dragonfly-shm.sock")
+    server = Server(port=0, unix_path=path, shm_path=shm_path)
+    Thread(target=server.start, daemon=True).start()
+    while server.state != State.RUNNING:
+        time.sleep(0.01)
+
+    port = server.socket.getsockname()[1]
+    transports = {
+        "tcp": ("localhost", port),
+        "unix": ("unix://" + path, 0),
+        "shm": ("shm://" + shm_path, 0),
+        "loopback": (server, 0)
+    }
+
+    print(f"{'transport':<10} {'latency (us)':>14} {'throughput (msg/s)':>20} {'(MB/s)':>8}")
+    for name, (host, port_) in transports.items():
+        publisher, subscriber = Client(), Client()
+        publisher.connect(host, port_).result()
+        subscriber.connect(host, port_).result()
+
+        lat = latency(publisher, args.round_trips)
+        rate = throughput(publisher, subscriber, args.messages, args.size)
+        print(f"{name:<10} {lat * 1e6:>14.1f} {rate:>20.0f} {rate * args.size / 1e6:>8.1f}")
+
+        publisher.disconnect()
+        subscriber.disconnect()
+
+    server.stop()
+    os.rmdir(tmp)
+
+if __name__ == "__main__":
+    main()
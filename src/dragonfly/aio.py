@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+from collections import deque
+import logging
+import time
+
+from dragonfly.client import SHM_SCHEME, parse_address
+from dragonfly.compression import DEFAULT_THRESHOLD
+from dragonfly.exceptions import InvalidPayload
+from dragonfly.message import *
+
+class AsyncClient:
+    """asyncio Dragonfly client
+
+    Unlike :py:class:`dragonfly.client.Client`, this client runs on the
+    caller's event loop: requests are coroutines returning the server's ack
+    code and received messages are read with :py:meth:`messages`.
+
+    The server acknowledges requests of a given type in the order it receives
+    them, so each ack resolves the oldest pending request of its type.
+    """
+
+    #: Number of keepalive intervals without receiving anything after which
+    #: the connection is considered lost
+    KEEPALIVE_GRACE = 1.5
+
+    def __init__(self, username=None, password=None, compression=None,
+                 compression_threshold=DEFAULT_THRESHOLD,
+                 topic_alias_max=TOPIC_ALIAS_MAX, max_buffered=1024,
+                 ssl_context=None, keepalive=60):
+        """Initializes an AsyncClient instance
+
+        Args:
+            username (str, optional): The client's username. Defaults to None.
+            password (str, optional): The client's password. Defaults to None.
+            compression (str|list[str], optional): Compression codec(s) to
+                offer the server, by preference. Defaults to None (no
+                compression).
+            compression_threshold (int, optional): Minimum size of a body to
+                be compressed, in bytes. Defaults to
+                :py:const:`dragonfly.compression.DEFAULT_THRESHOLD`.
+            topic_alias_max (int, optional): Maximum number of topic aliases
+                accepted from the server. Defaults to
+                :py:const:`dragonfly.message.TOPIC_ALIAS_MAX`.
+            max_buffered (int, optional): Maximum number of received messages
+                buffered for :py:meth:`messages`. When the buffer is full, the
+                client stops reading from the socket (and thus receiving acks)
+                until messages are consumed. Defaults to 1024.
+            ssl_context (ssl.SSLContext, optional): If set, TCP connections
+                use TLS. Defaults to None.
+            keepalive (int, optional): Interval, in seconds, at which the
+                client pings the server when nothing is sent or received. The
+                server may lower it. Defaults to 60 (0 to disable).
+        """
+
+        self.username = username
+        self.password = password
+        self.compression = [compression] if isinstance(compression, str) else compression
+        self.compression_threshold = compression_threshold
+        self.codec = None
+        self.aliases = TopicAliases(topic_alias_max)
+        self.ssl_context = ssl_context
+        self.resume_token = None
+        self.keepalive = keepalive
+        self.keepalive_interval = 0
+        self.last_sent = None
+        self.last_received = None
+        self.pinged = False
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.frames = FrameReader()
+        self.streams = {}
+        self.inbox = asyncio.Queue(max_buffered)
+
+        # Futures waiting for an ack, by ack type
+        self.pending = {
+            CONNECTED: deque(),
+            PUBLISHED: deque(),
+            SUBSCRIBED: deque(),
+            UNSUBSCRIBED: deque()
+        }
+
+        self.logger = logging.getLogger("dragonfly")
+
+    async def connect(self, host="localhost", port=1869):
+        """Connects to a server and starts listening
+
+        Args:
+            host (str, optional): The server's host, or ``unix://<path>`` to
+                connect through a Unix domain socket. Defaults to
+                "localhost".
+            port (int, optional): The server's port. Defaults to 1869.
+
+        Raises:
+            ValueError: If the address is a shared memory or in-process one,
+                which are only supported by
+                :py:class:`dragonfly.client.Client`.
+
+        Returns:
+            int: The CONNECTED code.
+        """
+
+        address = parse_address(host, port)
+        if not isinstance(address, (str, tuple)):
+            raise ValueError("In-process connections are not supported by AsyncClient")
+
+        if isinstance(address, str) and address.startswith(SHM_SCHEME):
+            raise ValueError("Shared memory connections are not supported by AsyncClient")
+
+        if isinstance(address, tuple):
+            self.reader, self.writer = await asyncio.open_connection(*address, ssl=self.ssl_context)
+
+        else:
+            self.reader, self.writer = await asyncio.open_unix_connection(address)
+
+        self.last_sent = self.last_received = time.monotonic()
+        self.pinged = False
+
+        msg = Message(ORIGIN_CLIENT, CONNECT)
+        msg.username = self.username
+        msg.password = self.password
+
+        if self.compression:
+            msg.properties["compression"] = "|".join(self.compression)
+            msg.properties["compression_threshold"] = self.compression_threshold
+
+        if self.aliases.max_inbound:
+            msg.properties["topic_alias_max"] = self.aliases.max_inbound
+
+        if self.resume_token is not None:
+            msg.properties["resume_token"] = self.resume_token
+
+        if self.keepalive:
+            msg.properties["keepalive"] = self.keepalive
+
+        ack = self.request(msg, CONNECTED)
+        self.task = asyncio.create_task(self.mainloop())
+
+        return await ack
+
+    async def disconnect(self):
+        """Disconnects from the server
+
+        Returns once the server has closed the connection.
+        """
+
+        self.send(Message(ORIGIN_CLIENT, CONNECT, 4)) # Disconnect
+        await self.writer.drain()
+        await self.task
+
+    async def publish(self, topic, msg):
+        """Publishes a message to a topic
+
+        Args:
+            topic (str): The topic to publish to.
+            msg (str|bytes): The message to publish. Bytes-like objects are
+                sent as raw binary bodies.
+
+        Returns:
+            int: The PUBLISHED code.
+        """
+
+        msg = Message(ORIGIN_CLIENT, PUBLISH, topic=topic, body=msg,
+                      codec=self.codec, threshold=self.compression_threshold)
+
+        return await self.request(msg, PUBLISHED)
+
+    async def subscribe(self, topic):
+        """Subscribes to a topic
+
+        Args:
+            topic (str): The topic.
+
+        Returns:
+            int: The SUBSCRIBED code.
+        """
+
+        return await self.request(Message(ORIGIN_CLIENT, SUBSCRIBE, topic=topic), SUBSCRIBED)
+
+    async def unsubscribe(self, topic):
+        """Unsubscribes from a topic
+
+        Args:
+            topic (str): The topic.
+
+        Returns:
+            int: The UNSUBSCRIBED code.
+        """
+
+        return await self.request(Message(ORIGIN_CLIENT, UNSUBSCRIBE, topic=topic), UNSUBSCRIBED)
+
+    async def messages(self):
+        """Iterates over received messages
+
+        Ends when the connection is closed.
+
+        Yields:
+            tuple[str, str|bytes]: (topic, body) pairs.
+        """
+
+        while True:
+            item = await self.inbox.get()
+            if item is None:
+                # Let other consumers see the end too
+                self.inbox.put_nowait(None)
+                return
+
+            yield item
+
+    async def request(self, msg, ack_type):
+        """Sends a message and waits for its ack
+
+        Args:
+            msg (Message): The message to send.
+            ack_type (int): The type of the ack answering this message.
+
+        Raises:
+            ValueError: If the message cannot be encoded, e.g. a topic too
+                long for the protocol.
+            ConnectionError: If the connection is closed before the ack is
+                received.
+
+        Returns:
+            int: The ack's code.
+        """
+
+        self.send(msg)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[ack_type].append(future)
+        await self.writer.drain()
+
+        return await future
+
+    def send(self, msg):
+        """Writes a message to the socket's buffer
+
+        Args:
+            msg (Message): The message to send.
+
+        Raises:
+            ValueError: If the message cannot be encoded.
+        """
+
+        if msg.type.type == PUBLISH:
+            msg.alias = self.aliases.assign(msg.topic)
+
+        data = msg.to_bytes()
+        if not data:
+            if msg.alias is not None and msg.alias[1]:
+                self.aliases.release(msg.topic)
+
+            raise ValueError("Cannot encode message")
+
+        self.writer.write(data)
+        self.last_sent = time.monotonic()
+
+    async def mainloop(self):
+        """Reads and processes messages until the connection is closed"""
+
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(self.reader.read(RECV_SIZE), self.read_timeout())
+
+                except asyncio.TimeoutError:
+                    if self.pinged:
+                        self.logger.error("Connection lost: no answer to ping")
+                        break
+
+                    self.pinged = True
+                    self.send(Message(ORIGIN_CLIENT, PING))
+                    await self.writer.drain()
+                    continue
+
+                if not data:
+                    break
+
+                self.last_received = time.monotonic()
+                self.pinged = False
+
+                for frame in self.frames.feed(data):
+                    msg = Message()
+                    if not msg.from_bytes(frame, self.aliases):
+                        self.logger.warning("Malformed packet from server")
+                        continue
+
+                    self.logger.debug("Received %s", msg)
+                    try:
+                        if not await self.process_msg(msg):
+                            return
+
+                    except InvalidPayload as e:
+                        self.logger.warning("Malformed payload from server: %s", e)
+
+        except ConnectionError as e:
+            self.logger.error("Connection lost: %s", e)
+
+        finally:
+            self.closed()
+
+    def read_timeout(self):
+        """Returns the time to wait for data before pinging the server
+
+        Returns:
+            float: The delay in seconds, or None if keepalive is disabled.
+        """
+
+        if not self.keepalive_interval:
+            return None
+
+        if self.pinged:
+            delay = self.last_received + self.keepalive_interval * self.KEEPALIVE_GRACE - time.monotonic()
+
+        else:
+            # Idle in either direction: a client which only receives must
+            # still let the server know it is alive
+            delay = min(self.last_sent, self.last_received) + self.keepalive_interval - time.monotonic()
+
+        return max(0, delay)
+
+    async def process_msg(self, msg):
+        """Processes a message
+
+        Args:
+            msg (Message): The message instance.
+
+        Returns:
+            bool: False if the server closed the connection.
+        """
+
+        msg_type = msg.type
+        if msg_type.origin != ORIGIN_SERVER:
+            return True
+
+        if msg_type.type == CONNECTED:
+            if msg_type.flags & 4:
+                return False
+
+            self.codec = msg.properties.get("compression")
+            self.aliases.max_outbound = min(msg.get_int_property("topic_alias_max"), ALIAS_DEFINE)
+            self.resume_token = msg.properties.get("resume_token")
+            self.keepalive_interval = msg.get_int_property("keepalive")
+
+        if msg_type.type in self.pending:
+            if self.pending[msg_type.type]:
+                future = self.pending[msg_type.type].popleft()
+                if not future.done():
+                    future.set_result(msg.code)
+
+        elif msg_type.type == PUBLISH:
+            await self.inbox.put((msg.topic, msg.body))
+
+        elif msg_type.type == BATCH:
+            for sub in msg.messages:
+                if sub.type.type == PUBLISH:
+                    await self.inbox.put((sub.topic, sub.body))
+
+        elif msg_type.type == CHUNK:
+            await self.process_chunk(msg)
+
+        elif msg_type.type == PING:
+            self.send(Message(ORIGIN_CLIENT, PONG))
+
+        return True
+
+    async def process_chunk(self, msg):
+        """Reassembles streamed messages
+
+        Args:
+            msg (Message): The CHUNK message.
+        """
+
+        flags = msg.type.flags
+
+        if flags & CHUNK_FIRST:
+            self.streams[msg.stream_id] = (msg.topic, [])
+
+        if not msg.stream_id in self.streams:
+            return
+
+        topic, chunks = self.streams[msg.stream_id]
+        if flags & (CHUNK_LAST | CHUNK_ABORT):
+            del self.streams[msg.stream_id]
+
+        if not flags & CHUNK_ABORT:
+            chunks.append(msg.data)
+            if flags & CHUNK_LAST:
+                await self.inbox.put((topic, b"".join(chunks)))
+
+    def closed(self):
+        """Closes the socket and fails pending requests"""
+
+        self.writer.close()
+
+        for futures in self.pending.values():
+            while futures:
+                future = futures.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed"))
+
+        # Unblocks messages() even if the buffer is full
+        while self.inbox.full():
+            self.inbox.get_nowait()
+
+        self.inbox.put_nowait(None)
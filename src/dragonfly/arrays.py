@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import array
+import struct
+import sys
+
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
+
+from dragonfly.exceptions import InvalidArray
+
+#: Prefix of array bodies
+MAGIC = b"DFA"
+
+#: Supported struct format characters
+FORMATS = "?bBhHiIlLqQefd"
+
+_BYTEORDER = "<" if sys.byteorder == "little" else ">"
+
+def kind(char):
+    """Returns the kind of a struct format character
+
+    Args:
+        char (str): The format character.
+
+    Returns:
+        str: b (bool), i (signed integer), u (unsigned integer) or f (float).
+    """
+
+    if char == "?":
+        return "b"
+
+    if char in "efd":
+        return "f"
+
+    return "u" if char.isupper() else "i"
+
+# Native format characters, by kind and size (e.g. 'f4'), preferring the
+# first matching character of FORMATS
+_NATIVE = {f"{kind(c)}{struct.calcsize(c)}": c for c in reversed(FORMATS)}
+
+def dtype(view):
+    """Returns the portable type code of a buffer, e.g. ``'<f4'``
+
+    Args:
+        view (memoryview): The buffer.
+
+    Returns:
+        str: Byte order, kind (b: bool, i: signed, u: unsigned, f: float) and
+            item size.
+
+    Raises:
+        InvalidArray: If the buffer's items are not simple numbers.
+    """
+
+    fmt = view.format
+    order = _BYTEORDER
+    if fmt[:1] in "<>!=@" and len(fmt) == 2:
+        order = {"<": "<", ">": ">", "!": ">"}.get(fmt[0], _BYTEORDER)
+        fmt = fmt[1:]
+
+    if len(fmt) != 1 or not fmt in FORMATS:
+        raise InvalidArray(f"Unsupported item format '{view.format}'")
+
+    return f"{order}{kind(fmt)}{view.itemsize}"
+
+def pack(arr):
+    """Encodes a typed array as a binary body
+
+    The body is a header holding the item type and shape, padded to 8 bytes,
+    followed by the array's raw memory.
+
+    Args:
+        arr (buffer): Any C-contiguous object supporting the buffer protocol
+            with numeric items, e.g. an ``array.array`` or a NumPy array.
+
+    Returns:
+        bytes: The body.
+
+    Raises:
+        InvalidArray: If the array is not contiguous or its items are not
+            simple numbers.
+    """
+
+    view = memoryview(arr)
+    if not view.c_contiguous:
+        raise InvalidArray("Array must be C-contiguous")
+
+    if view.ndim > 255:
+        raise InvalidArray("Array has too many dimensions")
+
+    header = struct.pack(f">4sB{view.ndim}I", dtype(view).encode("ascii"), view.ndim, *view.shape)
+    length = -(-(len(MAGIC) + 1 + len(header)) // 8) * 8
+    header = MAGIC + struct.pack(">B", length) + header
+    header += b"\x00" * (length - len(header))
+
+    return b"".join([header, view.cast("B")])
+
+def is_array(body):
+    """Returns whether a body was encoded with :py:func:`pack`
+
+    Args:
+        body (str|bytes): The body.
+
+    Returns:
+        bool: True if it is an array body, False otherwise.
+    """
+
+    return isinstance(body, (bytes, bytearray, memoryview)) and body[:3] == MAGIC
+
+def read_header(body):
+    """Decodes the header of an array body
+
+    Args:
+        body (bytes): The body.
+
+    Returns:
+        tuple[str, tuple[int], memoryview]: The type code, shape and a view
+            over the array's memory.
+
+    Raises:
+        InvalidArray: If the body is not a valid array body.
+    """
+
+    if not is_array(body):
+        raise InvalidArray("Not an array body")
+
+    view = memoryview(body).cast("B")
+    try:
+        length = view[3]
+        type_code, ndim = struct.unpack_from(">4sB", view, 4)
+        shape = struct.unpack_from(f">{ndim}I", view, 9)
+        type_code = type_code.rstrip(b"\x00").decode("ascii")
+
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise InvalidArray(f"Invalid array header: {e}")
+
+    return type_code, shape, view[length:]
+
+def unpack(body):
+    """Decodes an array body as a memoryview
+
+    The view is taken over the body itself unless the sender's byte order
+    differs, in which case the items are copied and swapped.
+
+    Args:
+        body (bytes): The body.
+
+    Returns:
+        memoryview: A view with the array's item format and shape.
+
+    Raises:
+        InvalidArray: If the body is not a valid array body or its item type
+            is not available on this platform.
+    """
+
+    type_code, shape, data = read_header(body)
+    order, type_ = type_code[0], type_code[1:]
+
+    if not type_ in _NATIVE:
+        raise InvalidArray(f"Unsupported item type '{type_code}'")
+
+    char = _NATIVE[type_]
+    if order != _BYTEORDER and struct.calcsize(char) > 1:
+        items = array.array(char)
+        try:
+            items.frombytes(data)
+
+        except ValueError as e:
+            raise InvalidArray(f"Invalid array data: {e}")
+
+        items.byteswap()
+        data = memoryview(items).cast("B")
+
+    try:
+        return data.cast(char, shape) if shape else data.cast(char)
+
+    except TypeError as e:
+        raise InvalidArray(f"Array size does not match its shape: {e}")
+
+def to_numpy(body):
+    """Decodes an array body as a NumPy array
+
+    The array is a read-only view over the body.
+
+    Args:
+        body (bytes): The body.
+
+    Returns:
+        numpy.ndarray: The array.
+
+    Raises:
+        InvalidArray: If the body is not a valid array body.
+        ImportError: If NumPy is not installed.
+    """
+
+    if numpy is None:
+        raise ImportError("NumPy is required to decode arrays as NumPy arrays")
+
+    type_code, shape, data = read_header(body)
+    try:
+        return numpy.frombuffer(data, dtype=numpy.dtype(type_code)).reshape(shape)
+
+    except (TypeError, ValueError) as e:
+        raise InvalidArray(f"Invalid array: {e}")
@@ -16,6 +16,8 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from collections import deque
+import ssl
 
 class ByteStream:
     """Stream of bytes, simulates a file object"""
@@ -79,3 +81,81 @@ class ByteStream:
         self.clamp()
 
         return bytes_
+
+class SendQueue:
+    """Queue of bytes waiting to be written to a non-blocking socket
+
+    Consecutive small buffers are coalesced so that they are written with a
+    single system call.
+    """
+
+    def __init__(self, write_size=65536):
+        """Initializes a SendQueue instance
+
+        Args:
+            write_size (int, optional): Maximum size of a coalesced write.
+                Defaults to 65536.
+        """
+
+        self.buffers = deque()
+        self.queued = 0
+        self.write_size = write_size
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def append(self, bytes_):
+        """Queues bytes
+
+        Args:
+            bytes_ (bytes): The bytes to queue.
+        """
+
+        if bytes_:
+            self.buffers.append(bytes_)
+            self.queued += len(bytes_)
+
+    def clear(self):
+        """Drops all queued bytes"""
+
+        self.buffers.clear()
+        self.queued = 0
+
+    def send(self, sock):
+        """Writes as much of the queue as the socket accepts
+
+        Args:
+            sock (socket.socket): The non-blocking socket.
+
+        Raises:
+            OSError: If the socket is broken.
+        """
+
+        while self.buffers:
+            buffer = self.buffers[0]
+
+            if len(self.buffers) > 1 and len(buffer) < self.write_size:
+                parts = [self.buffers.popleft()]
+                size = len(buffer)
+
+                while self.buffers and size + len(self.buffers[0]) <= self.write_size:
+                    size += len(self.buffers[0])
+                    parts.append(self.buffers.popleft())
+
+                buffer = b"".join(parts)
+                self.buffers.appendleft(buffer)
+
+            try:
+                sent = sock.send(buffer)
+
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+
+            self.queued -= sent
+
+            if sent < len(buffer):
+                self.buffers[0] = memoryview(buffer)[sent:]
+                break
+
+            self.buffers.popleft()
+
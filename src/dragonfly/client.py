@@ -16,15 +16,97 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 from enum import IntEnum, auto
+from itertools import count
 import logging
+import random
+import re
 import selectors
 import socket
-from threading import Thread
+import ssl
+from threading import Condition, Lock, Thread, current_thread
+import time
 import types
 
+from dragonfly import arrays, loopback, shm
+from dragonfly.bytes import SendQueue
+from dragonfly.compression import DEFAULT_THRESHOLD
+from dragonfly.exceptions import InvalidPayload
 from dragonfly.message import *
 
+#: Host prefix of Unix domain socket addresses
+UNIX_SCHEME = "unix://"
+
+#: Host prefix of shared memory addresses (path of the server's handshake
+#: socket, see :py:mod:`dragonfly.shm`)
+SHM_SCHEME = "shm://"
+
+def parse_address(host, port):
+    """Returns the address of a server
+
+    Args:
+        host (str|dragonfly.server.Server): The server's host, ``unix://<path>``
+            for a Unix domain socket, ``shm://<path>`` for a shared memory
+            connection, or a server running in this process.
+        port (int): The server's port, ignored for local transports.
+
+    Returns:
+        str|tuple[str, int]|dragonfly.server.Server: The (host, port) pair,
+            the socket path, the ``shm://`` address or the server.
+    """
+
+    if not isinstance(host, str):
+        return host
+
+    if host.startswith(SHM_SCHEME):
+        return host
+
+    if host.startswith(UNIX_SCHEME):
+        return host[len(UNIX_SCHEME):]
+
+    return (host, port)
+
+def open_socket(address, timeout=None, doorbell=None):
+    """Opens a connected stream socket
+
+    Args:
+        address (str|tuple[str, int]): The address, as returned by
+            :py:func:`parse_address`.
+        timeout (float, optional): Connection timeout, in seconds. Defaults
+            to None (no timeout).
+        doorbell (dragonfly.loopback.Doorbell, optional): Wakeup signaled
+            by in-process connections. Defaults to None (a new one is
+            created).
+
+    Returns:
+        socket.socket|ShmSocket|LoopbackSocket: The socket.
+    """
+
+    if not isinstance(address, (str, tuple)):
+        return address.attach(doorbell)
+
+    if isinstance(address, str) and address.startswith(SHM_SCHEME):
+        return shm.connect(address[len(SHM_SCHEME):], timeout=timeout)
+
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address, timeout)
+        # Writes are already coalesced by the send queue
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+
+    except OSError:
+        sock.close()
+        raise
+
+    return sock
+
 class State(IntEnum):
     """Client state enum"""
 
@@ -33,201 +115,1807 @@ class State(IntEnum):
     RUNNING = auto()
     STOPPING = auto()
     CRASHED = auto()
+    RECONNECTING = auto()
+
+class MessageBuffer:
+    """Bounded buffer of received messages
+
+    Filled by the client's thread and read by consumer threads. The client's
+    thread never waits for room: it stops reading from the socket while the
+    buffer is full, so the buffer may only go over its size by the messages
+    of one read.
+    """
+
+    def __init__(self, maxsize, on_room=None):
+        """Initializes a MessageBuffer instance
+
+        Args:
+            maxsize (int): Maximum number of buffered messages.
+            on_room (callable, optional): Called without arguments when
+                consumers free room in a full buffer. Defaults to None.
+        """
+
+        self.maxsize = maxsize
+        self.on_room = on_room
+        self.items = deque()
+        self.lock = Condition()
+        self.closed = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def full(self):
+        """Returns whether the buffer is full
+
+        Returns:
+            bool: True if full, False otherwise or if the buffer is closed.
+        """
+
+        with self.lock:
+            return not self.closed and len(self.items) >= self.maxsize
+
+    def put(self, item):
+        """Adds an item, even if the buffer is full
+
+        Args:
+            item (any): The item.
+        """
+
+        with self.lock:
+            self.items.append(item)
+            self.lock.notify_all()
+
+    def get(self, max_n, timeout=None):
+        """Removes up to ``max_n`` items
+
+        Waits until ``max_n`` items are available, the timeout expires or
+        the buffer is closed.
+
+        Args:
+            max_n (int): Maximum number of items.
+            timeout (float, optional): Maximum time to wait, in seconds.
+                Defaults to None (no limit).
+
+        Returns:
+            list: The items.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        items = []
+
+        with self.lock:
+            was_full = len(self.items) >= self.maxsize
+            while len(items) < max_n:
+                while self.items and len(items) < max_n:
+                    items.append(self.items.popleft())
+
+                if was_full and len(self.items) < self.maxsize:
+                    was_full = False
+                    if self.on_room is not None:
+                        self.on_room()
+
+                self.lock.notify_all()
+                if len(items) == max_n or self.closed:
+                    break
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+
+                self.lock.wait(remaining)
+
+        return items
+
+    def close(self):
+        """Wakes up all waiting threads: the buffer won't be filled anymore"""
+
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+class LastValueCache:
+    """LRU cache of the last body received on each topic
+
+    Updated by the client's thread and read by other threads.
+    """
+
+    def __init__(self, maxsize):
+        """Initializes a LastValueCache instance
+
+        Args:
+            maxsize (int): Maximum number of cached topics.
+        """
+
+        self.maxsize = maxsize
+        self.values = OrderedDict()
+        self.lock = Condition()
+        self.seq = 0
+        self.closed = False
+
+    def __len__(self):
+        return len(self.values)
+
+    def update(self, topic, body):
+        """Sets the last value of a topic, evicting the least recently used
+        topic if the cache is full
+
+        Args:
+            topic (str): The topic.
+            body (str|bytes): The topic's last body.
+        """
+
+        with self.lock:
+            self.seq += 1
+            self.values[topic] = (self.seq, body)
+            self.values.move_to_end(topic)
+
+            if len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+
+            self.lock.notify_all()
+
+    def get(self, topic, default=None):
+        """Returns the last value of a topic
+
+        Args:
+            topic (str): The topic.
+            default (any, optional): Value returned if the topic is not
+                cached. Defaults to None.
+
+        Returns:
+            str|bytes: The topic's last body, or ``default``.
+        """
+
+        with self.lock:
+            if not topic in self.values:
+                return default
+
+            self.values.move_to_end(topic)
+            return self.values[topic][1]
+
+    def wait_for_update(self, topic, timeout=None):
+        """Waits for the next value of a topic
+
+        Args:
+            topic (str): The topic.
+            timeout (float, optional): Maximum time to wait, in seconds.
+                Defaults to None (no limit).
+
+        Returns:
+            str|bytes: The topic's new body, or None if the timeout expired
+                or the cache was closed.
+        """
+
+        with self.lock:
+            start = self.seq
+            updated = lambda: self.values.get(topic, (0, None))[0] > start or self.closed
+
+            if not self.lock.wait_for(updated, timeout) or self.closed:
+                return None
+
+            return self.values[topic][1]
+
+    def close(self):
+        """Wakes up all waiting threads: the cache won't be updated anymore"""
+
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+def link(source, target, index=None):
+    """Resolves a future with the outcome of another one
+
+    Args:
+        source (Future): The future to wait for.
+        target (Future): The future to resolve.
+        index (int, optional): If set, ``target`` is resolved with the
+            item at this index of ``source``'s result. Defaults to None.
+    """
+
+    def done(_):
+        if target.done():
+            return
+
+        try:
+            result = source.result()
+
+        except Exception as e:
+            target.set_exception(e)
+
+        else:
+            target.set_result(result if index is None else result[index])
+
+    source.add_done_callback(done)
+
+def gather(futures):
+    """Combines futures resolved with lists into a single future
+
+    Args:
+        futures (list[Future]): The futures.
+
+    Returns:
+        Future: Resolved with the concatenation of the futures' results, or
+            with the first exception raised.
+    """
+
+    result = Future()
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+
+        if last and not result.done():
+            try:
+                result.set_result([code for f in futures for code in f.result()])
+
+            except Exception as e:
+                result.set_exception(e)
+
+    if not futures:
+        result.set_result([])
+
+    for future in futures:
+        future.add_done_callback(done)
+
+    return result
 
 class Client:
-    """Dragonfly client"""
+    """Dragonfly client
+
+    Messages are not written by the calling thread: :py:meth:`send` queues
+    them and the client's thread writes them, coalescing queued messages into
+    larger writes. All public methods are thus thread-safe.
+
+    Public methods return a :py:class:`concurrent.futures.Future` resolved
+    with the server's ack code. The server acknowledges requests of a given
+    type in the order it receives them, so each ack resolves the oldest
+    pending future of its type. Requests can thus be pipelined and waited on
+    together, e.g. with :py:func:`concurrent.futures.wait`.
+    """
 
-    def __init__(self, username=None, password=None):
+    #: Maximum number of topics whose matching handlers are cached
+    ROUTE_CACHE_SIZE = 4096
+
+    #: Number of keepalive intervals without receiving anything after which
+    #: the connection is considered lost
+    KEEPALIVE_GRACE = 1.5
+
+    def __init__(self, username=None, password=None, compression=None,
+                 compression_threshold=DEFAULT_THRESHOLD,
+                 topic_alias_max=TOPIC_ALIAS_MAX, flush_latency=0,
+                 max_queue=1 << 24, dispatcher=None, max_buffered=0,
+                 reconnect=False, backoff_min=0.1, backoff_max=30,
+                 max_offline=1000, cache_size=0, ssl_context=None,
+                 keepalive=60):
         """Initializes a Client instance
 
         Args:
             username (str, optional): The client's username. Defaults to None.
             password (str, optional): The client's password. Defaults to None.
+            compression (str|list[str], optional): Compression codec(s) to
+                offer the server, by preference (see
+                :py:data:`dragonfly.compression.CODECS`). Defaults to None (no
+                compression).
+            compression_threshold (int, optional): Minimum size of a body to
+                be compressed, in bytes. Defaults to
+                :py:const:`dragonfly.compression.DEFAULT_THRESHOLD`.
+            topic_alias_max (int, optional): Maximum number of topic aliases
+                accepted from the server. Defaults to
+                :py:const:`dragonfly.message.TOPIC_ALIAS_MAX`.
+            flush_latency (float, optional): Maximum time, in seconds, a
+                message may wait in the send queue for more messages to be
+                written along with it. Defaults to 0 (written as soon as
+                possible).
+            max_queue (int, optional): Number of queued bytes above which
+                :py:meth:`send` blocks until the queue drains. Defaults to
+                16 MiB.
+            dispatcher (Dispatcher, optional): Thread pool running
+                :py:attr:`on_message` and :py:attr:`on_chunk`, so that slow
+                handlers do not stall the socket. It is started when
+                connecting and stopped once disconnected. Defaults to None
+                (callbacks run on the client's thread).
+            max_buffered (int, optional): If set, received messages are also
+                buffered, up to this number, to be read with
+                :py:meth:`iter_messages` and :py:meth:`get_batch`. When the
+                buffer is full, the client stops reading from the socket until
+                messages are consumed. Defaults to 0 (no buffering).
+            reconnect (bool, optional): Whether to reconnect automatically
+                when the connection is lost. Defaults to False.
+            backoff_min (float, optional): Base delay between reconnection
+                attempts, in seconds. It doubles after each failed attempt
+                and the actual delay is drawn uniformly below it, to spread
+                clients reconnecting at once. Defaults to 0.1.
+            backoff_max (float, optional): Maximum delay between reconnection
+                attempts, in seconds. Defaults to 30.
+            max_offline (int, optional): Maximum number of messages buffered
+                while reconnecting. Defaults to 1000.
+            cache_size (int, optional): If set, the last body received on
+                each topic is cached, for up to this number of topics, to be
+                read with :py:meth:`get` and :py:meth:`wait_for_update`.
+                Defaults to 0 (no cache).
+            ssl_context (ssl.SSLContext, optional): If set, TCP connections
+                use TLS. The session is kept to be resumed when reconnecting,
+                which spares the server a full handshake. Defaults to None.
+            keepalive (int, optional): Interval, in seconds, at which the
+                client pings the server when the connection is idle. The
+                server may lower it. If nothing is received within
+                :py:attr:`KEEPALIVE_GRACE` intervals of a ping, the
+                connection is considered lost. Defaults to 60 (0 to
+                disable).
         """
 
         self.username = username
         self.password = password
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.selector = selectors.DefaultSelector()
+        self.compression = [compression] if isinstance(compression, str) else compression
+        self.compression_threshold = compression_threshold
+        self.codec = None
+        self.aliases = TopicAliases(topic_alias_max)
+        self.socket = None
+        self.selector = None
+        self.wakeup_r, self.wakeup_w = None, None
+        self.doorbell = None
         self.thread = None
+        self.dispatcher = dispatcher
+        self.inbox = MessageBuffer(max_buffered, self.wakeup) if max_buffered else None
+        self.cache = LastValueCache(cache_size) if cache_size else None
+
+        # (pattern, compiled pattern, handler) tuples and handlers by topic
+        self.handlers = []
+        self.routes = {}
+
         self.state = State.STOPPED
+        self.stream_ids = count()
+        self.streams = {}
+
+        self.address = None
+        self.ssl_context = ssl_context
+
+        #: TLS session resumed by the next connection
+        self.tls_session = None
+
+        #: Token sparing the server the password check on the next CONNECT
+        self.resume_token = None
+
+        self.reconnect = reconnect
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.attempts = 0
+        self.max_offline = max_offline
+        self.offline = deque()
+        self.subscriptions = {}
+        self.resubscribe = []
+        self.session_ids = count()
+        self.sessions = {}
+
+        self.queue = SendQueue(SEND_SIZE)
+        self.lock = Condition()
+        self.flush_latency = flush_latency
+        self.max_queue = max_queue
+        self.queued_since = None
+        self.writing = False
+        self.reading = True
+        self.socket_data = None
+
+        self.keepalive = keepalive
+
+        #: Keepalive interval accepted by the server
+        self.keepalive_interval = 0
+        self.last_sent = None
+        self.last_received = None
+        self.pinged = False
+
+        # (future, request) pairs waiting for an ack, by ack type
+        self.pending = {
+            CONNECTED: deque(),
+            PUBLISHED: deque(),
+            SUBSCRIBED: deque(),
+            UNSUBSCRIBED: deque(),
+            BATCHED: deque()
+        }
 
         self.on_connected = lambda self, code: None
         self.on_disconnected = lambda self, code: None
         self.on_published = lambda self, code: None
         self.on_subscribed = lambda self, code: None
         self.on_unsubscribed = lambda self, code: None
+        self.on_batched = lambda self, codes: None
         self.on_message = lambda self, topic, msg: None
 
+        #: If set, streamed messages are passed chunk by chunk to
+        #: ``on_chunk(self, topic, data, last)`` instead of being reassembled
+        #: and passed to :py:attr:`on_message`. ``data`` is None if the stream
+        #: was aborted.
+        self.on_chunk = None
+
         self.logger = logging.getLogger("dragonfly")
 
     def connect(self, host="localhost", port=1869):
         """Connects to a server and starts listening
 
         Args:
-            host (str, optional): The server's host. Defaults to "localhost".
+            host (str|dragonfly.server.Server, optional): The server's host,
+                ``unix://<path>`` to connect through a Unix domain socket,
+                ``shm://<path>`` to connect through shared memory, or a
+                :py:class:`dragonfly.server.Server` instance running in this
+                process to exchange frames in memory. Defaults to
+                "localhost".
             port (int, optional): The server's port. Defaults to 1869.
+
+        Returns:
+            Future: Resolved with the CONNECTED code.
         """
 
         self.state = State.STARTING
-        self.socket.connect((host, port))
+        self.address = parse_address(host, port)
+
+        # Lets other threads wake the selector up when messages are queued,
+        # and in-process connections signal received data
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.doorbell = loopback.Doorbell(shm.Wakeup([self.wakeup_r.fileno(), self.wakeup_w.fileno()]))
+
+        try:
+            self.socket = open_socket(self.address, doorbell=self.doorbell)
+
+        except OSError:
+            self.wakeup_r.close()
+            self.wakeup_w.close()
+            raise
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, data=None)
+
+        # Aliases only live as long as a connection
+        self.aliases = TopicAliases(self.aliases.max_inbound)
+        future = self.open()
+
+        self.state = State.RUNNING
+
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+
+        self.thread = Thread(target=self.mainloop, daemon=True)
+        self.thread.start()
+
+        return future
+
+    def open(self):
+        """Registers the connected socket and sends the CONNECT message
+
+        Returns:
+            Future: Resolved with the CONNECTED code.
+        """
+
         self.socket.setblocking(False)
-        data = types.SimpleNamespace(addr=(host, port), inb=b"", outb=b"", step=0, length=0)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.selector.register(self.socket, events, data=data)
+        data = types.SimpleNamespace(addr=self.address, reader=FrameReader(), handshaking=False)
+        events = selectors.EVENT_READ
+        self.socket_data = data
+        self.writing = False
+        self.reading = True
+        self.keepalive_interval = 0
+        self.last_sent = self.last_received = time.monotonic()
+        self.pinged = False
+
+        if self.ssl_context is not None and isinstance(self.address, tuple):
+            # The handshake is driven by the event loop (see handshake), which
+            # starts it as soon as the socket is writable
+            self.socket = self.ssl_context.wrap_socket(
+                self.socket, server_hostname=self.address[0],
+                do_handshake_on_connect=False, session=self.tls_session)
+
+            data.handshaking = True
+            self.writing = True
+
+        self.watch()
+
+        return self.send(self.new_connect(), CONNECTED)
+
+    def new_connect(self):
+        """Creates the CONNECT message, with the options to negotiate
+
+        Returns:
+            Message: The CONNECT message.
+        """
 
         msg = Message(ORIGIN_CLIENT, CONNECT)
         msg.username = self.username
         msg.password = self.password
 
-        self.send(msg)
+        if self.compression:
+            msg.properties["compression"] = "|".join(self.compression)
+            msg.properties["compression_threshold"] = self.compression_threshold
 
-        self.state = State.RUNNING
+        if self.aliases.max_inbound:
+            msg.properties["topic_alias_max"] = self.aliases.max_inbound
 
-        self.thread = Thread(target=self.mainloop, daemon=True)
-        self.thread.start()
+        if self.resume_token is not None:
+            msg.properties["resume_token"] = self.resume_token
+
+        if self.keepalive:
+            msg.properties["keepalive"] = self.keepalive
+
+        return msg
 
     def disconnect(self):
         """Stops this client"""
 
-        self.state = State.STOPPING
-        self.send(Message(ORIGIN_CLIENT, CONNECT, 4)) # Disconnect
+        with self.lock:
+            offline = self.state == State.RECONNECTING
+            self.state = State.STOPPING
+            self.lock.notify_all()
+
+        # Consumers stop waiting, and a full buffer does not keep the
+        # client's thread from reading the end of the connection
+        if self.inbox is not None:
+            self.inbox.close()
+
+        if self.cache is not None:
+            self.cache.close()
+
+        if not offline:
+            self.send(Message(ORIGIN_CLIENT, CONNECT, 4)) # Disconnect
+
+        self.wakeup()
         self.thread.join()
 
+    def close_socket(self):
+        """Unregisters and closes the socket, if still open"""
+
+        if self.socket is not None and self.socket.fileno() != -1:
+            if not self.shares_wakeup() and self.socket in self.selector.get_map():
+                self.selector.unregister(self.socket)
+
+            self.socket.close()
+
     def disconnected(self):
         """Closes the socket"""
 
-        self.socket.close()
+        self.close_socket()
+        self.selector.unregister(self.wakeup_r)
+        self.doorbell.detach()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
         self.state = State.STOPPED
 
-    def mainloop(self):
-        """Main event loop"""
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
 
-        while self.state in [State.RUNNING, State.STOPPING]:
-            events = self.selector.select(timeout=None)
+        for session in list(self.sessions.values()):
+            session.disconnected()
+            session.on_disconnected(session, None)
 
-            for key, mask in events:
-                self.handle_msg(key, mask)
+        self.closed()
 
-    def send(self, msg):
-        """Sends a message throught the socket
+    def closed(self):
+        """Fails pending requests and closes the message buffer and cache"""
 
-        Args:
-            msg (Message): The message to send.
+        if self.inbox is not None:
+            self.inbox.close()
+
+        if self.cache is not None:
+            self.cache.close()
+
+        with self.lock:
+            self.queue.clear()
+            self.lock.notify_all()
+
+            futures = self.drop_pending()
+            futures += [future for _, _, future in self.offline if future is not None]
+            self.offline.clear()
+
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed"))
+
+    def drop_pending(self):
+        """Forgets the futures waiting for an ack
+
+        Must be called with :py:attr:`lock` held.
+
+        Returns:
+            list[Future]: The dropped futures.
         """
 
-        self.socket.sendall(msg.to_bytes())
+        futures = [f for pending in self.pending.values() for f, _ in pending]
+        for pending in self.pending.values():
+            pending.clear()
 
-    def handle_msg(self, key, mask):
-        """Handles an event
+        return futures
 
-        Args:
-            key (selectors.SelectorKey): The event's key.
-            mask (selectors._EventMask): The event's mask.
+    def lost(self):
+        """Forgets the state of a lost connection
+
+        Must be called with :py:attr:`lock` held.
+
+        Returns:
+            list[Future]: The futures of the requests in flight.
         """
 
-        sock = key.fileobj
-        data = key.data
+        self.resubscribe = list(self.subscriptions)
+        self.streams.clear()
+        futures = self.drop_pending()
 
-        # Ready to read
-        if mask & selectors.EVENT_READ:
-            recv_data = sock.recv(data.length if data.step == 1 else 7)
+        for session in self.sessions.values():
+            futures += session.lost()
 
-            if recv_data:
-                data.outb += recv_data
-                data.step += 1
+        return futures
 
-                if data.step == 1:
-                    data.length = struct.unpack(">I", data.outb[-4:])[0]
-                    if data.length == 0:
-                        data.step = 2
+    def replay(self):
+        """Reopens the connection's sessions after reconnecting
 
-                if data.step == 2:
-                    msg = Message()
-                    try:
-                        msg.from_bytes(data.outb)
+        Subscriptions are replayed in a single batch, followed by the messages
+        buffered while disconnected. Must be called with :py:attr:`lock` held.
+        """
 
-                    except:
-                        self.logger.warn("Malformed packet from %s", data.addr)
+        self.aliases = TopicAliases(self.aliases.max_inbound)
+        self.open()
 
-                    else:
-                        self.logger.debug("Received %s from %s", msg, data.addr)
-                        self.process_msg(msg)
+        if self.resubscribe:
+            self.send_batch([
+                Message(ORIGIN_CLIENT, SUBSCRIBE, topic=topic)
+                for topic in self.resubscribe
+            ])
 
-                    finally:
-                        data.step = 0
-                        data.outb = b""
+        offline, self.offline = self.offline, deque()
+        self.send_offline(offline)
 
-        # Ready to write
-        if mask & selectors.EVENT_WRITE:
-            pass
+        for session in list(self.sessions.values()):
+            if session.state == State.RUNNING:
+                session.replay()
 
-    def process_msg(self, msg):
-        """Processes a message
+    def connection_lost(self):
+        """Handles the connection being closed without a DISCONNECT
 
-        Args:
-            msg (Message): The message instance.
+        Either stops the client or starts reconnecting.
         """
 
-        msg_type = msg.type
-        if msg_type.origin == ORIGIN_SERVER:
-            if msg_type.type == CONNECTED:
-                code = msg.code
+        self.logger.warning("Connection to %s lost", self.address)
 
-                if msg_type.flags & 4:
-                    self.disconnected()
-                    self.on_disconnected(self, code)
+        with self.lock:
+            if not self.reconnect or self.state == State.STOPPING:
+                lost = True
 
-                else:
-                    self.on_connected(self, code)
+            else:
+                lost = False
+                self.close_socket()
+                self.state = State.RECONNECTING
+                self.attempts = 0
+                self.queue.clear()
+                self.lock.notify_all()
+                futures = self.lost()
 
-            elif msg_type.type == PUBLISHED:
-                code = msg.code
-                self.on_published(self, code)
+        if lost:
+            self.disconnected()
+            self.on_disconnected(self, None)
+            return
 
-            elif msg_type.type == SUBSCRIBED:
-                code = msg.code
-                self.on_subscribed(self, code)
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError("Connection lost"))
 
-            elif msg_type.type == UNSUBSCRIBED:
-                code = msg.code
-                self.on_unsubscribed(self, code)
+    def try_reconnect(self):
+        """Waits for the backoff delay and tries to reconnect once
 
-            elif msg_type.type == PUBLISH:
-                topic, body = msg.topic, msg.body
-                self.on_message(self, topic, body)
+        On success, the connection's state is restored with
+        :py:meth:`replay`.
+        """
 
-    #
-    # Public api
-    #
+        delay = min(self.backoff_max, self.backoff_min * 2 ** self.attempts)
+        self.attempts += 1
 
-    def subscribe(self, topic):
-        """Subscribes to a topic
+        with self.lock:
+            self.lock.wait_for(lambda: self.state != State.RECONNECTING, random.uniform(0, delay))
+
+            if self.state != State.RECONNECTING:
+                self.disconnected()
+                return
+
+        try:
+            self.socket = open_socket(self.address, self.backoff_max, self.doorbell)
+
+        except OSError as e:
+            self.logger.info("Cannot reconnect to %s: %s", self.address, e)
+            return
+
+        self.logger.info("Reconnected to %s after %d attempt(s)", self.address, self.attempts)
+
+        with self.lock:
+            if self.state != State.RECONNECTING:
+                self.socket.close()
+                self.disconnected()
+                return
+
+            self.state = State.RUNNING
+            self.replay()
+
+    def send_offline(self, entries):
+        """Sends messages buffered while disconnected
+
+        Consecutive PUBLISH, SUBSCRIBE and UNSUBSCRIBE messages are grouped in
+        BATCH frames.
 
         Args:
-            topic (str): The topic.
+            entries (list[tuple[Message, int, Future]]): (message, ack type,
+                future) tuples, as buffered by :py:meth:`send`.
         """
 
-        self.send(Message(ORIGIN_CLIENT, SUBSCRIBE, topic=topic))
+        group = []
 
-    def unsubscribe(self, topic):
-        """Unsubscribes from a topic
+        def send_group():
+            if group:
+                batch = Message(ORIGIN_CLIENT, BATCH, messages=[msg for msg, _, _ in group])
+                source = self.send(batch, BATCHED)
+                for i, (_, _, future) in enumerate(group):
+                    link(source, future, i)
+
+                group.clear()
+
+        for msg, ack_type, future in entries:
+            if msg.type.type in [PUBLISH, SUBSCRIBE, UNSUBSCRIBE] and future is not None:
+                group.append((msg, ack_type, future))
+                if len(group) == MAX_BATCH:
+                    send_group()
+
+            else:
+                send_group()
+                source = self.send(msg, ack_type)
+                if future is not None:
+                    link(source, future)
+
+        send_group()
+
+    def mainloop(self):
+        """Main event loop"""
+
+        while self.state in [State.RUNNING, State.STOPPING, State.RECONNECTING]:
+            if self.state == State.RECONNECTING:
+                self.try_reconnect()
+                continue
+
+            events = self.selector.select(timeout=self.next_timeout())
+
+            for key, mask in events:
+                # Closed while handling a previous event
+                if self.state == State.STOPPED:
+                    break
+
+                # Wake-up socket, also signaled by in-process connections
+                if key.data is None:
+                    self.doorbell.drain()
+                    if self.shares_wakeup() and self.connected():
+                        self.handle_msg(selectors.SelectorKey(self.socket, key.fd, selectors.EVENT_READ, self.socket_data), selectors.EVENT_READ)
+
+                elif key.fileobj is self.socket and self.connected():
+                    self.handle_msg(key, mask)
+
+            if not self.reading and self.connected() and not self.inbox.full():
+                self.reading = True
+                self.watch()
+
+            delay = self.flush_delay()
+            if self.connected() and delay is not None and delay <= 0:
+                self.flush()
+
+            delay = self.keepalive_delay()
+            if delay is not None and delay <= 0:
+                self.keep_alive()
+
+    def connected(self):
+        """Returns whether the socket is connected
+
+        Returns:
+            bool: True if connected (or disconnecting), False otherwise.
+        """
+
+        return self.state in [State.RUNNING, State.STOPPING]
+
+    def send(self, msg, ack_type=None):
+        """Queues a message to be sent through the socket
+
+        Topic aliases are assigned to PUBLISH messages when queued, so that
+        they are defined in the order the server receives them.
+
+        If more than :py:attr:`max_queue` bytes are queued, blocks until the
+        queue drains, unless called from the client's thread.
 
         Args:
-            topic (str): The topic.
+            msg (Message): The message to send.
+            ack_type (int, optional): The type of the ack answering this
+                message. Defaults to None (no ack expected).
+
+        Returns:
+            Future|None: Resolved with the ack's code (or list of codes for
+                BATCHED), if ``ack_type`` is set. Failed with ValueError if
+                the message cannot be encoded.
         """
 
-        self.send(Message(ORIGIN_CLIENT, UNSUBSCRIBE, topic=topic))
+        future = None if ack_type is None else Future()
 
-    def publish(self, topic, msg):
-        """Publishes a message to a topic
+        with self.lock:
+            self.wait_for_room()
+
+            if self.state == State.RECONNECTING:
+                return self.buffer_offline(msg, ack_type, future)
+
+            self.assign_aliases(msg)
+            data = msg.to_bytes()
+            if not data:
+                self.release_aliases(msg)
+                if future is not None:
+                    future.set_exception(ValueError("Cannot encode message"))
+
+                return future
+
+            if future is not None:
+                self.pending[ack_type].append((future, msg))
+
+            was_empty = not self.queue
+            self.queue.append(data)
+
+            if was_empty:
+                self.queued_since = time.monotonic()
+
+            wake = was_empty or self.queue.queued >= SEND_SIZE
+
+        if wake:
+            self.wakeup()
+
+        return future
+
+    def resolve(self, ack_type, result):
+        """Resolves the oldest future waiting for an ack
 
         Args:
-            topic (str): The topic to publish to.
-            msg (Message): The message to publish.
+            ack_type (int): The ack's type.
+            result (int|list[int]): The ack's code(s).
         """
 
-        self.send(Message(ORIGIN_CLIENT, PUBLISH, topic=topic, body=msg))
+        with self.lock:
+            pending = self.pending[ack_type]
+            future, request = pending.popleft() if pending else (None, None)
+
+            if request is not None:
+                self.track(request, result)
+
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def track(self, msg, result):
+        """Updates the subscription set replayed when reconnecting, once the
+        server acknowledged a request
+
+        Only successful codes (0x00, or 0x01 if the subscription already was
+        in the requested state) are applied. Must be called with
+        :py:attr:`lock` held.
+
+        Args:
+            msg (Message): The acknowledged message.
+            result (int|list[int]): The ack's code(s).
+        """
+
+        if msg.type.type == BATCH:
+            acks = zip(msg.messages, result)
+
+        else:
+            acks = [(msg, result)]
+
+        for sub, code in acks:
+            if not code in [0x00, 0x01]:
+                continue
+
+            if sub.type.type == SUBSCRIBE:
+                self.subscriptions[sub.topic] = True
+
+            elif sub.type.type == UNSUBSCRIBE:
+                self.subscriptions.pop(sub.topic, None)
+
+    def wait_for_room(self):
+        """Waits until less than :py:attr:`max_queue` bytes are queued
+
+        Does not wait on the client's thread. Must be called with
+        :py:attr:`lock` held.
+        """
+
+        running = self.thread is not None and self.thread.is_alive()
+        if running and current_thread() is not self.thread:
+            self.lock.wait_for(lambda: self.queue.queued < self.max_queue or not self.connected())
+
+    def assign_aliases(self, msg):
+        """Assigns topic aliases to the PUBLISH messages being sent
+
+        Args:
+            msg (Message): A message being sent.
+        """
+
+        for sub in msg.messages if msg.type.type == BATCH else [msg]:
+            if sub.type.type == PUBLISH:
+                sub.alias = self.aliases.assign(sub.topic)
+
+    def release_aliases(self, msg):
+        """Releases the topic aliases assigned to a message which could not
+        be encoded, so that they are defined by the next message using them
+
+        Args:
+            msg (Message): The message.
+        """
+
+        # Newest first, a release only undoes the last assignment
+        for sub in reversed(msg.messages if msg.type.type == BATCH else [msg]):
+            if sub.type.type == PUBLISH and sub.alias is not None and sub.alias[1]:
+                self.aliases.release(sub.topic)
+                sub.alias = None
+
+    def buffer_offline(self, msg, ack_type, future):
+        """Buffers a message sent while reconnecting
+
+        Must be called with :py:attr:`lock` held.
+
+        Args:
+            msg (Message): The message.
+            ack_type (int): The type of the ack answering this message.
+            future (Future): The message's future.
+
+        Returns:
+            Future: The message's future, failed with BufferError if the
+                buffer is full.
+        """
+
+        if len(self.offline) >= self.max_offline:
+            self.logger.warning("Offline buffer full, dropping %s", msg)
+            if future is not None:
+                future.set_exception(BufferError("Offline buffer full"))
+
+        else:
+            self.offline.append((msg, ack_type, future))
+
+        return future
+
+    def wakeup(self):
+        """Wakes the client's thread up"""
+
+        try:
+            self.doorbell.signal()
+
+        except (AttributeError, OSError):
+            # Not connected yet
+            pass
+
+    def flush_delay(self):
+        """Returns the time left before the send queue must be written
+
+        Returns:
+            float: The delay in seconds, or None if the queue is empty or is
+                already waiting for the socket to be writable.
+        """
+
+        with self.lock:
+            if not self.queue or self.writing:
+                return None
+
+            if self.queue.queued >= SEND_SIZE:
+                return 0
+
+            return self.queued_since + self.flush_latency - time.monotonic()
+
+    def keepalive_delay(self):
+        """Returns the time left before the keepalive must be checked
+
+        Returns:
+            float: The delay in seconds, or None if keepalive is disabled.
+        """
+
+        if not self.keepalive_interval or not self.connected():
+            return None
+
+        # Answers are not read meanwhile: only lets the server know the
+        # connection is alive
+        if not self.reading:
+            return self.last_sent + self.keepalive_interval - time.monotonic()
+
+        if self.pinged:
+            return self.last_received + self.keepalive_interval * self.KEEPALIVE_GRACE - time.monotonic()
+
+        # Idle in either direction: a connection which only sends could be
+        # half-open, and one which only receives could be dropped by the
+        # server
+        return min(self.last_sent, self.last_received) + self.keepalive_interval - time.monotonic()
+
+    def next_timeout(self):
+        """Returns the time the event loop may wait for events
+
+        Returns:
+            float: The delay in seconds, or None to wait indefinitely.
+        """
+
+        delays = [d for d in (self.flush_delay(), self.keepalive_delay()) if d is not None]
+
+        return max(0, min(delays)) if delays else None
+
+    def keep_alive(self):
+        """Pings the server, or drops the connection if it did not answer"""
+
+        if self.pinged and self.reading:
+            self.logger.warning("No answer from %s for %.1fs", self.address, time.monotonic() - self.last_received)
+            self.connection_lost()
+            return
+
+        self.pinged = self.reading
+        self.send(Message(ORIGIN_CLIENT, PING))
+
+    def flush(self):
+        """Writes as much of the send queue as the socket accepts
+
+        If the socket cannot take all of it, the rest is written when the
+        socket becomes writable again.
+        """
+
+        with self.lock:
+            queued = self.queue.queued
+            try:
+                self.queue.send(self.socket)
+
+            except OSError as e:
+                self.logger.error("Cannot send: %s", e)
+                self.queue.clear()
+                lost = True
+
+            else:
+                lost = False
+                if self.queue.queued < queued:
+                    self.last_sent = time.monotonic()
+
+            self.queued_since = time.monotonic() if self.queue else None
+            self.lock.notify_all()
+            writing = bool(self.queue)
+
+        if lost:
+            self.connection_lost()
+            return
+
+        if writing != self.writing:
+            self.writing = writing
+            self.watch()
+
+    def watch(self):
+        """Updates the events the socket is watched for
+
+        The socket is watched for reading unless :py:attr:`inbox` is full,
+        and for writing while the send queue is not empty.
+        """
+
+        events = selectors.EVENT_READ if self.reading else 0
+        if self.writing:
+            if getattr(self.socket, "wakes_on_space", False):
+                events |= selectors.EVENT_READ
+
+            else:
+                events |= selectors.EVENT_WRITE
+
+        if self.shares_wakeup():
+            # Handled whenever the wakeup socket is readable: only lets the
+            # loop check the socket again
+            if events:
+                self.doorbell.signal()
+
+            return
+
+        registered = self.socket in self.selector.get_map()
+        if not events:
+            if registered:
+                self.selector.unregister(self.socket)
+
+        elif registered:
+            self.selector.modify(self.socket, events, data=self.socket_data)
+
+        else:
+            self.selector.register(self.socket, events, data=self.socket_data)
+
+    def shares_wakeup(self):
+        """Returns whether the socket is signaled through the wakeup socket,
+        as in-process connections are
+
+        Returns:
+            bool: True if it is, False if it is watched on its own.
+        """
+
+        return self.doorbell is not None and getattr(self.socket, "wakeup", None) is self.doorbell
+
+    def handle_msg(self, key, mask):
+        """Handles an event
+
+        Args:
+            key (selectors.SelectorKey): The event's key.
+            mask (selectors._EventMask): The event's mask.
+        """
+
+        sock = key.fileobj
+        data = key.data
+
+        if data.handshaking:
+            self.handshake(key)
+            return
+
+        # Ready to read (not while the buffer is full, shared memory
+        # connections staying watched to signal room)
+        if mask & selectors.EVENT_READ and self.reading:
+            try:
+                recv_data = sock.recv(RECV_SIZE)
+
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                recv_data = None
+
+            except (ConnectionError, ssl.SSLError):
+                recv_data = b""
+
+            if recv_data == b"":
+                self.connection_lost()
+                return
+
+            if recv_data:
+                self.last_received = time.monotonic()
+                self.pinged = False
+
+            for frame in data.reader.feed(recv_data or b""):
+                msg = Message()
+                try:
+                    decoded = msg.from_bytes(frame, self.aliases)
+
+                except:
+                    decoded = False
+
+                if not decoded:
+                    self.logger.warning("Malformed packet from %s", data.addr)
+                    continue
+
+                self.logger.debug("Received %s from %s", msg, data.addr)
+                try:
+                    self.process_msg(msg)
+
+                except InvalidPayload as e:
+                    self.logger.warning("Malformed payload from %s: %s", data.addr, e)
+
+            if self.inbox is not None and self.connected() and self.inbox.full():
+                self.logger.debug("Buffer full, pausing reads from %s", data.addr)
+                self.reading = False
+                self.watch()
+
+        # Ready to write (shared memory connections signal room as a read)
+        writable = mask & selectors.EVENT_WRITE
+        if not writable and getattr(sock, "wakes_on_space", False):
+            writable = self.writing
+
+        if writable and self.connected():
+            self.flush()
+
+    def handshake(self, key):
+        """Advances the TLS handshake without blocking
+
+        Messages queued meanwhile (starting with CONNECT) are written once it
+        is done.
+
+        Args:
+            key (selectors.SelectorKey): The socket's key.
+        """
+
+        try:
+            key.fileobj.do_handshake()
+
+        except ssl.SSLWantReadError:
+            events = selectors.EVENT_READ
+
+        except ssl.SSLWantWriteError:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+
+        except OSError as e:
+            self.logger.error("TLS handshake with %s failed: %s", self.address, e)
+            self.connection_lost()
+            return
+
+        else:
+            key.data.handshaking = False
+            self.logger.debug("TLS handshake with %s done (resumed: %s)",
+                              self.address, key.fileobj.session_reused)
+
+            # The queue is written once the socket is writable
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+
+        self.selector.modify(key.fileobj, events, data=key.data)
+
+    def process_msg(self, msg):
+        """Processes a message
+
+        Args:
+            msg (Message): The message instance.
+        """
+
+        msg_type = msg.type
+        if msg_type.origin == ORIGIN_SERVER:
+            if msg_type.type == CONNECTED:
+                code = msg.code
+
+                if msg_type.flags & 4:
+                    self.disconnected()
+                    self.on_disconnected(self, code)
+
+                else:
+                    self.codec = msg.properties.get("compression")
+                    self.aliases.max_outbound = min(msg.get_int_property("topic_alias_max"), ALIAS_DEFINE)
+                    self.resume_token = msg.properties.get("resume_token")
+                    self.keepalive_interval = msg.get_int_property("keepalive")
+
+                    # Session tickets are sent before any message and a
+                    # session cannot be resumed once its connection failed
+                    if isinstance(self.socket, ssl.SSLSocket):
+                        self.tls_session = self.socket.session
+
+                    self.resolve(CONNECTED, code)
+                    self.on_connected(self, code)
+
+                    # The server closes refused connections
+                    if code & 0x80:
+                        self.disconnected()
+                        self.on_disconnected(self, code)
+
+            elif msg_type.type == PUBLISHED:
+                code = msg.code
+                self.resolve(PUBLISHED, code)
+                self.on_published(self, code)
+
+            elif msg_type.type == SUBSCRIBED:
+                code = msg.code
+                self.resolve(SUBSCRIBED, code)
+                self.on_subscribed(self, code)
+
+            elif msg_type.type == UNSUBSCRIBED:
+                code = msg.code
+                self.resolve(UNSUBSCRIBED, code)
+                self.on_unsubscribed(self, code)
+
+            elif msg_type.type == BATCHED:
+                self.resolve(BATCHED, msg.codes)
+                self.on_batched(self, msg.codes)
+
+            elif msg_type.type == PUBLISH:
+                topic, body = msg.topic, msg.body
+                self.deliver(topic, body)
+
+            elif msg_type.type == BATCH:
+                for sub in msg.messages:
+                    if sub.type.type == PUBLISH:
+                        self.deliver(sub.topic, sub.body)
+
+            elif msg_type.type == CHUNK:
+                self.process_chunk(msg)
+
+            elif msg_type.type == SESSION:
+                session = self.sessions.get(msg.session_id)
+                if session is not None:
+                    session.receive(msg.frame)
+
+            elif msg_type.type == PING:
+                self.send(Message(ORIGIN_CLIENT, PONG))
+
+    def deliver(self, topic, body):
+        """Passes a received message to :py:attr:`on_message` and the buffer
+
+        Args:
+            topic (str): The message's topic.
+            body (str|bytes): The message's body.
+        """
+
+        if self.cache is not None:
+            self.cache.update(topic, body)
+
+        if self.inbox is not None:
+            self.inbox.put((topic, body))
+
+        self.dispatch(topic, self.on_message, self, topic, body)
+
+        for handler in self.route(topic):
+            self.dispatch(topic, handler, self, topic, body)
+
+    def route(self, topic):
+        """Returns the handlers matching a topic
+
+        Results are cached per topic until handlers change.
+
+        Args:
+            topic (str): The topic.
+
+        Returns:
+            list[callable]: The handlers, in the order they were added.
+        """
+
+        routes = self.routes
+        handlers = routes.get(topic)
+
+        if handlers is None:
+            if len(routes) >= self.ROUTE_CACHE_SIZE:
+                routes.clear()
+
+            handlers = [fn for _, regex, fn in self.handlers if regex.match(topic)]
+            routes[topic] = handlers
+
+        return handlers
+
+    def dispatch(self, topic, fn, *args):
+        """Calls a message callback, through the dispatcher if any
+
+        Args:
+            topic (str): The message's topic.
+            fn (callable): The callback.
+            *args: The callback's arguments.
+        """
+
+        if self.dispatcher is None:
+            fn(*args)
+
+        else:
+            self.dispatcher.submit(topic, fn, *args)
+
+    def process_chunk(self, msg):
+        """Processes a CHUNK message
+
+        Args:
+            msg (Message): The CHUNK message.
+        """
+
+        flags = msg.type.flags
+
+        if flags & CHUNK_FIRST:
+            self.streams[msg.stream_id] = (msg.topic, [])
+
+        if not msg.stream_id in self.streams:
+            return
+
+        topic, chunks = self.streams[msg.stream_id]
+        if flags & (CHUNK_LAST | CHUNK_ABORT):
+            del self.streams[msg.stream_id]
+
+        if flags & CHUNK_ABORT:
+            self.logger.debug("Stream %d to '%s' aborted", msg.stream_id, topic)
+            if self.on_chunk is not None:
+                self.dispatch(topic, self.on_chunk, self, topic, None, True)
+
+        elif self.on_chunk is not None:
+            self.dispatch(topic, self.on_chunk, self, topic, msg.data, bool(flags & CHUNK_LAST))
+
+        else:
+            chunks.append(msg.data)
+            if flags & CHUNK_LAST:
+                self.deliver(topic, b"".join(chunks))
+
+    #
+    # Public api
+    #
+
+    def session(self, username=None, password=None, **kwargs):
+        """Creates a logical session sharing this client's connection
+
+        Each session has its own credentials, subscriptions, callbacks and
+        futures, but all share this client's socket and thread. Sessions
+        must be opened with :py:meth:`Session.connect`.
+
+        Args:
+            username (str, optional): The session's username. Defaults to
+                None.
+            password (str, optional): The session's password. Defaults to
+                None.
+            **kwargs: Other session options, see :py:class:`Client`.
+
+        Returns:
+            Session: The new session.
+        """
+
+        with self.lock:
+            id_ = next(self.session_ids) & 0xffffffff
+            session = Session(self, id_, username, password, **kwargs)
+            self.sessions[id_] = session
+
+        return session
+
+    def add_handler(self, pattern, fn):
+        """Adds a handler for messages whose topic matches a pattern
+
+        Patterns have the same semantics as on the server (regular expressions
+        matched at the start of the topic). Handlers are called like
+        :py:attr:`on_message`, which is still called for every message.
+
+        Args:
+            pattern (str): The topic pattern.
+            fn (callable): The handler, called as ``fn(self, topic, msg)``.
+        """
+
+        self.handlers = self.handlers + [(pattern, re.compile(pattern), fn)]
+        self.routes = {}
+
+    def remove_handler(self, pattern, fn):
+        """Removes a handler added with :py:meth:`add_handler`
+
+        Args:
+            pattern (str): The topic pattern.
+            fn (callable): The handler.
+        """
+
+        self.handlers = [
+            handler for handler in self.handlers
+            if handler[0] != pattern or handler[2] != fn
+        ]
+        self.routes = {}
+
+    def subscribe(self, topic):
+        """Subscribes to a topic
+
+        Args:
+            topic (str): The topic.
+
+        Returns:
+            Future: Resolved with the SUBSCRIBED code.
+        """
+
+        return self.send(Message(ORIGIN_CLIENT, SUBSCRIBE, topic=topic), SUBSCRIBED)
+
+    def unsubscribe(self, topic):
+        """Unsubscribes from a topic
+
+        Args:
+            topic (str): The topic.
+
+        Returns:
+            Future: Resolved with the UNSUBSCRIBED code.
+        """
+
+        return self.send(Message(ORIGIN_CLIENT, UNSUBSCRIBE, topic=topic), UNSUBSCRIBED)
+
+    def publish(self, topic, msg):
+        """Publishes a message to a topic
+
+        Args:
+            topic (str): The topic to publish to.
+            msg (str|bytes): The message to publish. Bytes-like objects are
+                sent as raw binary bodies.
+
+        Returns:
+            Future: Resolved with the PUBLISHED code.
+        """
+
+        return self.send(self.new_publish(topic, msg), PUBLISHED)
+
+    def publish_array(self, topic, arr):
+        """Publishes a typed numeric array as raw bytes
+
+        Receivers decode the body with :py:func:`dragonfly.arrays.unpack` (or
+        :py:func:`dragonfly.arrays.to_numpy`), which returns a view over the
+        received bytes.
+
+        Args:
+            topic (str): The topic to publish to.
+            arr (buffer): Any C-contiguous object supporting the buffer
+                protocol with numeric items, e.g. an ``array.array`` or a
+                NumPy array.
+
+        Raises:
+            InvalidArray: If the array cannot be encoded.
+
+        Returns:
+            Future: Resolved with the PUBLISHED code.
+        """
+
+        return self.publish(topic, arrays.pack(arr))
+
+    def new_publish(self, topic, msg):
+        """Creates a PUBLISH message using the negotiated compression
+
+        Args:
+            topic (str): The topic to publish to.
+            msg (str|bytes): The message to publish.
+
+        Returns:
+            Message: The PUBLISH message.
+        """
+
+        return Message(ORIGIN_CLIENT, PUBLISH, topic=topic, body=msg,
+                       codec=self.codec, threshold=self.compression_threshold)
+
+    def publish_stream(self, topic, source, chunk_size=CHUNK_SIZE):
+        """Publishes a large binary message in chunks
+
+        The server relays each chunk as soon as it receives it, so neither
+        side needs to hold the whole message. The stream is acknowledged by a
+        single PUBLISHED message once its last chunk has been received.
+
+        Args:
+            topic (str): The topic to publish to.
+            source (bytes|file|iterable): The message, either a bytes-like
+                object, a binary file object or an iterable of bytes-like
+                chunks.
+            chunk_size (int, optional): Size of the chunks read from bytes-like
+                objects and files. Defaults to :py:const:`CHUNK_SIZE`.
+
+        Returns:
+            Future: Resolved with the PUBLISHED code of the whole stream.
+        """
+
+        stream_id = next(self.stream_ids) & 0xffffffff
+
+        if hasattr(source, "read"):
+            chunks = iter(lambda: source.read(chunk_size), b"")
+
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            view = memoryview(source).cast("B")
+            chunks = (view[i:i+chunk_size] for i in range(0, len(view), chunk_size))
+
+        else:
+            chunks = iter(source)
+
+        flags = CHUNK_FIRST
+        data = next(chunks, b"")
+
+        for next_data in chunks:
+            self.send(Message(ORIGIN_CLIENT, CHUNK, flags, stream_id=stream_id, topic=topic, data=data))
+            flags, data = 0, next_data
+
+        last = Message(ORIGIN_CLIENT, CHUNK, flags | CHUNK_LAST, stream_id=stream_id, topic=topic, data=data)
+        return self.send(last, PUBLISHED)
+
+    def iter_messages(self, timeout=None):
+        """Iterates over buffered messages
+
+        Requires ``max_buffered`` to be set.
+
+        Args:
+            timeout (float, optional): Maximum time to wait for each message,
+                in seconds. Defaults to None (no limit).
+
+        Yields:
+            tuple[str, str|bytes]: (topic, body) pairs, until the connection
+                is closed or no message is received within ``timeout``.
+        """
+
+        while True:
+            batch = self.inbox.get(1, timeout)
+            if not batch:
+                return
+
+            yield batch[0]
+
+    def get_batch(self, max_n, max_wait=None):
+        """Gets several buffered messages at once
+
+        Requires ``max_buffered`` to be set.
+
+        Args:
+            max_n (int): Maximum number of messages to return.
+            max_wait (float, optional): Maximum time to wait for ``max_n``
+                messages, in seconds. Defaults to None (no limit).
+
+        Returns:
+            list[tuple[str, str|bytes]]: Up to ``max_n`` (topic, body) pairs,
+                fewer if ``max_wait`` expires or the connection is closed.
+        """
+
+        return self.inbox.get(max_n, max_wait)
+
+    def get(self, topic, default=None):
+        """Returns the last body received on a topic
+
+        Requires ``cache_size`` to be set.
+
+        Args:
+            topic (str): The topic.
+            default (any, optional): Value returned if nothing was received
+                on this topic (or it was evicted). Defaults to None.
+
+        Returns:
+            str|bytes: The last body, or ``default``.
+        """
+
+        return self.cache.get(topic, default)
+
+    def wait_for_update(self, topic, timeout=None):
+        """Waits for the next message on a topic
+
+        Requires ``cache_size`` to be set.
+
+        Args:
+            topic (str): The topic.
+            timeout (float, optional): Maximum time to wait, in seconds.
+                Defaults to None (no limit).
+
+        Returns:
+            str|bytes: The new body, or None if the timeout expired or the
+                connection was closed.
+        """
+
+        return self.cache.wait_for_update(topic, timeout)
+
+    def send_batch(self, msgs):
+        """Sends messages grouped in BATCH frames
+
+        Each BATCH frame is acknowledged by a single BATCHED message, see
+        :py:attr:`on_batched`.
+
+        Args:
+            msgs (list[Message]): The messages to send.
+
+        Returns:
+            Future: Resolved with the list of codes of all messages, in order.
+        """
+
+        futures = [
+            self.send(Message(ORIGIN_CLIENT, BATCH, messages=msgs[i:i+MAX_BATCH]), BATCHED)
+            for i in range(0, len(msgs), MAX_BATCH)
+        ]
+
+        return gather(futures)
+
+    def subscribe_many(self, topics):
+        """Subscribes to several topics at once
+
+        Args:
+            topics (list[str]): The topics.
+
+        Returns:
+            Future: Resolved with the list of codes, in order.
+        """
+
+        return self.send_batch([
+            Message(ORIGIN_CLIENT, SUBSCRIBE, topic=topic)
+            for topic in topics
+        ])
+
+    def unsubscribe_many(self, topics):
+        """Unsubscribes from several topics at once
+
+        Args:
+            topics (list[str]): The topics.
+
+        Returns:
+            Future: Resolved with the list of codes, in order.
+        """
+
+        return self.send_batch([
+            Message(ORIGIN_CLIENT, UNSUBSCRIBE, topic=topic)
+            for topic in topics
+        ])
+
+    def publish_many(self, msgs):
+        """Publishes several messages at once
+
+        Args:
+            msgs (list[tuple[str, str|bytes]]): (topic, message) pairs to
+                publish.
+
+        Returns:
+            Future: Resolved with the list of codes, in order.
+        """
+
+        return self.send_batch([
+            self.new_publish(topic, msg)
+            for topic, msg in msgs
+        ])
+
+class Session(Client):
+    """Logical session multiplexed over a client's connection
+
+    Messages are wrapped in SESSION messages tagged with the session's id
+    and sent through the parent client, which passes the session's messages
+    back to it. The server keeps a separate state for each session.
+    """
+
+    def __init__(self, parent, id_, username=None, password=None, **kwargs):
+        """Initializes a Session instance
+
+        Args:
+            parent (Client): The client whose connection is shared.
+            id_ (int): The session's id on this connection.
+            username (str, optional): The session's username. Defaults to
+                None.
+            password (str, optional): The session's password. Defaults to
+                None.
+            **kwargs: Other session options, see :py:class:`Client`.
+        """
+
+        super().__init__(username, password, dispatcher=parent.dispatcher, **kwargs)
+        self.parent = parent
+        self.id = id_
+        self.lock = parent.lock
+
+        # Kept alive by the parent's connection
+        self.keepalive = 0
+
+    def connect(self):
+        """Opens this session on the parent's connection
+
+        Returns:
+            Future: Resolved with the CONNECTED code.
+        """
+
+        self.state = State.RUNNING
+
+        return self.open()
+
+    def open(self):
+        """Sends the CONNECT message
+
+        Returns:
+            Future: Resolved with the CONNECTED code.
+        """
+
+        return self.send(self.new_connect(), CONNECTED)
+
+    def disconnect(self):
+        """Closes this session
+
+        :py:attr:`on_disconnected` is called once the server has closed it.
+        """
+
+        self.state = State.STOPPING
+        self.send(Message(ORIGIN_CLIENT, CONNECT, 4)) # Disconnect
+
+    def disconnected(self):
+        """Forgets this session"""
+
+        self.state = State.STOPPED
+        self.parent.sessions.pop(self.id, None)
+        self.closed()
+
+    def send(self, msg, ack_type=None):
+        """Queues a message on the parent's connection
+
+        Args:
+            msg (Message): The message to send.
+            ack_type (int, optional): The type of the ack answering this
+                message. Defaults to None (no ack expected).
+
+        Returns:
+            Future|None: Resolved with the ack's code, if ``ack_type`` is set.
+                Failed with ValueError if the message cannot be encoded.
+        """
+
+        future = None if ack_type is None else Future()
+
+        with self.lock:
+            self.parent.wait_for_room()
+
+            if self.parent.state == State.RECONNECTING:
+                return self.buffer_offline(msg, ack_type, future)
+
+            self.assign_aliases(msg)
+            data = msg.to_bytes()
+            if not data:
+                self.release_aliases(msg)
+                if future is not None:
+                    future.set_exception(ValueError("Cannot encode message"))
+
+                return future
+
+            if future is not None:
+                self.pending[ack_type].append((future, msg))
+
+            self.parent.send(Message(ORIGIN_CLIENT, SESSION, session_id=self.id, frame=data))
+
+        return future
+
+    def receive(self, frame):
+        """Processes a message received for this session
+
+        Args:
+            frame (bytes): The inner frame of a SESSION message.
+        """
+
+        msg = Message()
+        if msg.from_bytes(frame, self.aliases):
+            self.logger.debug("Received %s on session %d", msg, self.id)
+            try:
+                self.process_msg(msg)
+
+            except InvalidPayload as e:
+                self.logger.warning("Malformed payload on session %d: %s", self.id, e)
 
 if __name__ == "__main__":
     # pylint: disable=missing-function-docstring
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import zlib
+
+try:
+    import lzma
+
+except ImportError:
+    lzma = None
+
+from dragonfly.exceptions import InvalidPayload, UnsupportedCodec
+
+#: Default maximum size of a decompressed body, in bytes
+MAX_SIZE = 1 << 26
+
+def zlib_decompress(data, max_size):
+    """Decompresses zlib data, up to a given size
+
+    Args:
+        data (bytes): The compressed data.
+        max_size (int): Maximum size of the decompressed data, in bytes.
+
+    Returns:
+        bytes: The decompressed data.
+
+    Raises:
+        InvalidPayload: If the data is corrupt, truncated or decompresses
+            to more than ``max_size`` bytes.
+    """
+
+    decompressor = zlib.decompressobj()
+    try:
+        # A max_length of 0 means no limit
+        body = decompressor.decompress(data, max_size + 1)
+
+    except zlib.error as e:
+        raise InvalidPayload(f"Corrupt zlib data: {e}")
+
+    if len(body) > max_size:
+        raise InvalidPayload(f"Body larger than {max_size} bytes")
+
+    if not decompressor.eof:
+        raise InvalidPayload("Truncated zlib data")
+
+    return body
+
+def lzma_decompress(data, max_size):
+    """Decompresses lzma data, up to a given size
+
+    Args:
+        data (bytes): The compressed data.
+        max_size (int): Maximum size of the decompressed data, in bytes.
+
+    Returns:
+        bytes: The decompressed data.
+
+    Raises:
+        InvalidPayload: If the data is corrupt, truncated or decompresses
+            to more than ``max_size`` bytes.
+    """
+
+    decompressor = lzma.LZMADecompressor()
+    try:
+        body = decompressor.decompress(data, max_size + 1)
+
+    except lzma.LZMAError as e:
+        raise InvalidPayload(f"Corrupt lzma data: {e}")
+
+    if len(body) > max_size:
+        raise InvalidPayload(f"Body larger than {max_size} bytes")
+
+    if not decompressor.eof:
+        raise InvalidPayload("Truncated lzma data")
+
+    return body
+
+#: Available codecs, by name: (id, compress function, decompress function)
+CODECS = {
+    "zlib": (1, zlib.compress, zlib_decompress)
+}
+
+if lzma is not None:
+    CODECS["lzma"] = (2, lzma.compress, lzma_decompress)
+
+#: Default minimum size of a body to be compressed, in bytes
+DEFAULT_THRESHOLD = 256
+
+def codec_id(name):
+    """Returns the id of a codec
+
+    Args:
+        name (str): The codec's name.
+
+    Returns:
+        int: The codec's id.
+
+    Raises:
+        UnsupportedCodec: If the codec is not available.
+    """
+
+    if not name in CODECS:
+        raise UnsupportedCodec(f"Unsupported compression codec '{name}'")
+
+    return CODECS[name][0]
+
+def codec_name(id_):
+    """Returns the name of a codec
+
+    Args:
+        id_ (int): The codec's id.
+
+    Returns:
+        str: The codec's name.
+
+    Raises:
+        UnsupportedCodec: If the codec is not available.
+    """
+
+    for name, (codec_id_, _, _) in CODECS.items():
+        if codec_id_ == id_:
+            return name
+
+    raise UnsupportedCodec(f"Unsupported compression codec {id_}")
+
+def compress(name, data):
+    """Compresses data
+
+    Args:
+        name (str): The codec's name.
+        data (bytes): The data to compress.
+
+    Returns:
+        bytes: The compressed data.
+    """
+
+    codec_id(name)
+    return CODECS[name][1](data)
+
+def decompress(name, data, max_size=MAX_SIZE):
+    """Decompresses data
+
+    Args:
+        name (str): The codec's name.
+        data (bytes): The compressed data.
+        max_size (int, optional): Maximum size of the decompressed data, in
+            bytes, so that small compression bombs cannot exhaust memory.
+            Defaults to :py:const:`MAX_SIZE`.
+
+    Returns:
+        bytes: The decompressed data.
+
+    Raises:
+        InvalidPayload: If the data is corrupt or too large.
+    """
+
+    codec_id(name)
+    return CODECS[name][2](data, max_size)
+
+def negotiate(offered, accepted=None):
+    """Picks a codec
+
+    Args:
+        offered (list[str]): Codecs offered by the peer, by preference.
+        accepted (list[str], optional): Codecs accepted locally. Defaults to
+            None (all available codecs).
+
+    Returns:
+        str: The first offered codec which is available and accepted, or
+            None if there is none.
+    """
+
+    for name in offered:
+        if name in CODECS and (accepted is None or name in accepted):
+            return name
+
+    return None
@@ -186,6 +186,26 @@ class Config:
 
         return None
 
+    def find_user(self, username):
+        """Gets a user by name, without checking its password
+
+        Args:
+            username (str): The user's name.
+
+        Returns:
+            The user's configuration if found.
+            None if no user is configured or no user matches
+        """
+
+        if not self.users:
+            return None
+
+        for user in self.users:
+            if str(user["username"]) == username:
+                return user
+
+        return None
+
     def __getattr__(self, __name):
         if __name in self._config:
             return self._config[__name]
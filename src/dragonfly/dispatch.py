@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from collections import deque
+from enum import IntEnum, auto
+import logging
+from threading import Condition, Lock, Thread
+import zlib
+
+class Overflow(IntEnum):
+    """Policy applied when a worker's queue is full"""
+
+    #: Wait for the worker to catch up (slows the caller down)
+    BLOCK = auto()
+    #: Drop the new callback
+    DROP_NEW = auto()
+    #: Drop the oldest queued callback
+    DROP_OLDEST = auto()
+
+class Worker:
+    """Thread calling queued callbacks in order"""
+
+    def __init__(self, max_queue, overflow):
+        """Initializes a Worker instance
+
+        Args:
+            max_queue (int): Maximum number of queued callbacks.
+            overflow (Overflow): Policy applied when the queue is full.
+        """
+
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.queue = deque()
+        self.lock = Condition()
+        self.running = False
+        self.dispatched = 0
+        self.dropped = 0
+        self.thread = None
+        self.logger = logging.getLogger("dragonfly")
+
+    def start(self):
+        """Starts this worker's thread, unless it is still draining its queue"""
+
+        with self.lock:
+            self.running = True
+            if self.thread is None:
+                self.thread = Thread(target=self.mainloop, daemon=True)
+                self.thread.start()
+
+    def submit(self, fn, args):
+        """Queues a callback
+
+        Args:
+            fn (callable): The callback.
+            args (tuple): The callback's arguments.
+
+        Raises:
+            RuntimeError: If the worker is stopped.
+        """
+
+        with self.lock:
+            if not self.running:
+                raise RuntimeError("Dispatcher is stopped")
+
+            if len(self.queue) >= self.max_queue:
+                if self.overflow == Overflow.BLOCK:
+                    self.lock.wait_for(lambda: len(self.queue) < self.max_queue or not self.running)
+                    if not self.running:
+                        raise RuntimeError("Dispatcher is stopped")
+
+                elif self.overflow == Overflow.DROP_NEW:
+                    self.dropped += 1
+                    return
+
+                else:
+                    self.queue.popleft()
+                    self.dropped += 1
+
+            self.queue.append((fn, args))
+            self.lock.notify_all()
+
+    def mainloop(self):
+        """Calls queued callbacks until stopped and drained"""
+
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.queue or not self.running)
+                if not self.queue:
+                    self.thread = None
+                    return
+
+                fn, args = self.queue.popleft()
+                self.lock.notify_all()
+
+            try:
+                fn(*args)
+
+            except Exception:
+                self.logger.exception("Error in callback %s", fn)
+
+            self.dispatched += 1
+
+    def stop(self):
+        """Stops this worker once its queue is drained"""
+
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+
+    def join(self, timeout=None):
+        """Waits for this worker's thread to stop
+
+        Args:
+            timeout (float, optional): Maximum time to wait, in seconds.
+                Defaults to None (no limit).
+        """
+
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+class Dispatcher:
+    """Pool of threads calling client callbacks
+
+    Callbacks for a given topic are always run by the same worker, in the
+    order they were submitted, so per-topic ordering is preserved while
+    different topics are handled concurrently.
+
+    Starts and stops are counted, so that a dispatcher shared by several
+    clients runs until all of them stopped it. It can then be started again.
+    """
+
+    def __init__(self, workers=4, max_queue=1024, overflow=Overflow.BLOCK):
+        """Initializes a Dispatcher instance
+
+        Args:
+            workers (int, optional): Number of worker threads. Defaults to 4.
+            max_queue (int, optional): Maximum number of queued callbacks per
+                worker. Defaults to 1024.
+            overflow (Overflow, optional): Policy applied when a worker's
+                queue is full. Defaults to :py:attr:`Overflow.BLOCK`.
+        """
+
+        self.workers = [Worker(max_queue, overflow) for _ in range(workers)]
+        self.users = 0
+        self.lock = Lock()
+
+    def start(self):
+        """Starts the workers, if not running yet"""
+
+        with self.lock:
+            self.users += 1
+            if self.users == 1:
+                for worker in self.workers:
+                    worker.start()
+
+    def stop(self):
+        """Stops the workers once their queues are drained, if no other user
+        is left"""
+
+        with self.lock:
+            if not self.users:
+                return
+
+            self.users -= 1
+            if not self.users:
+                for worker in self.workers:
+                    worker.stop()
+
+    def join(self, timeout=None):
+        """Waits for the workers to stop
+
+        Args:
+            timeout (float, optional): Maximum time to wait for each worker,
+                in seconds. Defaults to None (no limit).
+        """
+
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def submit(self, topic, fn, *args):
+        """Queues a callback on the topic's worker
+
+        Args:
+            topic (str): The topic the callback relates to.
+            fn (callable): The callback.
+            *args: The callback's arguments.
+
+        Raises:
+            RuntimeError: If the dispatcher is stopped.
+        """
+
+        worker = self.workers[zlib.crc32(topic.encode("utf-8")) % len(self.workers)]
+        worker.submit(fn, args)
+
+    def depths(self):
+        """Returns the number of queued callbacks of each worker
+
+        Returns:
+            list[int]: The queue depths.
+        """
+
+        return [len(worker.queue) for worker in self.workers]
+
+    def metrics(self):
+        """Returns the dispatcher's metrics
+
+        Returns:
+            dict: Queue depths (``depths``, ``max_depth``), and total number of
+                callbacks run (``dispatched``) and dropped (``dropped``).
+        """
+
+        depths = self.depths()
+
+        return {
+            "depths": depths,
+            "max_depth": max(depths, default=0),
+            "dispatched": sum(worker.dispatched for worker in self.workers),
+            "dropped": sum(worker.dropped for worker in self.workers)
+        }
@@ -21,4 +21,19 @@ class InvalidMessageType(Exception):
     pass
 
 class MissingProperty(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class UnsupportedVersion(Exception):
+    pass
+
+class UnsupportedCodec(Exception):
+    pass
+
+class InvalidTopicAlias(Exception):
+    pass
+
+class InvalidArray(Exception):
+    pass
+
+class InvalidPayload(Exception):
+    pass
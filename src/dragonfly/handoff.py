@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Handoff of a server's sockets to its successor, for zero-downtime restarts
+
+A server started with a handoff path listens for a successor on a Unix
+domain socket at this path. A new server started with the same path
+connects to it and asks for its sockets: the old server sends its state as
+JSON, followed by the listening sockets' and the connections' descriptors
+(with ``SCM_RIGHTS``), then stops once the successor confirms it took them
+over. Connections are never closed, so clients do not notice the restart.
+
+The exchange is:
+
+1. successor: request, ``>BB`` (version, flags)
+2. old server: header, ``>BII`` (version, state size, number of
+   descriptors), the state, then the descriptors in batches of
+   :py:const:`MAX_FDS`, each sent along with one byte
+3. successor: confirmation, one null byte
+"""
+
+import base64
+import json
+import socket
+import struct
+
+#: Version of the handoff protocol
+VERSION = 0
+
+#: Request flag asking for the connections as well as the listening sockets
+FLAG_CLIENTS = 1
+
+#: Maximum number of descriptors sent at once (Linux accepts up to 253)
+MAX_FDS = 250
+
+#: Default timeout of each step of the handoff, in seconds
+TIMEOUT = 5
+
+REQUEST = struct.Struct(">BB")
+HEADER = struct.Struct(">BII")
+
+def encode_bytes(bytes_):
+    """Encodes bytes to be stored in the JSON state
+
+    Args:
+        bytes_ (bytes): The bytes.
+
+    Returns:
+        str: The base64 encoded bytes.
+    """
+
+    return base64.b64encode(bytes_).decode("ascii")
+
+def decode_bytes(str_):
+    """Decodes bytes stored in the JSON state
+
+    Args:
+        str_ (str): The base64 encoded bytes.
+
+    Returns:
+        bytes: The bytes.
+    """
+
+    return base64.b64decode(str_)
+
+def recv_exactly(control, size):
+    """Receives a given number of bytes
+
+    Args:
+        control (socket.socket): The blocking control socket.
+        size (int): The number of bytes.
+
+    Raises:
+        ConnectionError: If the connection is closed before.
+
+    Returns:
+        bytes: The received bytes.
+    """
+
+    data = bytearray()
+    while len(data) < size:
+        chunk = control.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff connection closed")
+
+        data += chunk
+
+    return bytes(data)
+
+def request(path, clients=True, timeout=TIMEOUT):
+    """Asks the server listening at a handoff path for its sockets (successor
+    side)
+
+    The handoff must then be confirmed with :py:func:`confirm`, after which
+    the old server stops.
+
+    Args:
+        path (str): The handoff path.
+        clients (bool, optional): Whether to take the connections over too.
+            Otherwise, the old server closes them and clients reconnect.
+            Defaults to True.
+        timeout (float, optional): Timeout of each step, in seconds.
+            Defaults to :py:const:`TIMEOUT`.
+
+    Raises:
+        OSError: If no server listens at this path or the handoff fails.
+
+    Returns:
+        tuple[socket.socket, dict, list[int]]: The control connection, the
+            old server's state and the received descriptors, in the order
+            the state refers to them.
+    """
+
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    fds = []
+
+    try:
+        control.settimeout(timeout)
+        control.connect(path)
+        control.sendall(REQUEST.pack(VERSION, FLAG_CLIENTS if clients else 0))
+
+        version, size, count = HEADER.unpack(recv_exactly(control, HEADER.size))
+        if version != VERSION:
+            raise ConnectionRefusedError(f"Unsupported handoff version {version}")
+
+        state = json.loads(recv_exactly(control, size))
+
+        while len(fds) < count:
+            msg, batch, _, _ = socket.recv_fds(control, 1, MAX_FDS)
+            if not msg:
+                raise ConnectionError("Handoff connection closed")
+
+            fds += batch
+
+    except (OSError, ValueError) as e:
+        control.close()
+        for fd in fds:
+            socket.close(fd)
+
+        if isinstance(e, OSError):
+            raise
+
+        raise ConnectionRefusedError(f"Invalid handoff state: {e}")
+
+    return control, state, fds
+
+def read_request(control):
+    """Reads a successor's request (old server side)
+
+    Does not wait if the control socket is non-blocking, so that servers can
+    call it once the socket is readable.
+
+    Args:
+        control (socket.socket): The accepted control connection.
+
+    Raises:
+        BlockingIOError: If the socket is non-blocking and the whole request
+            was not received yet.
+        OSError: If the request is invalid.
+
+    Returns:
+        bool: Whether the successor takes the connections over too.
+    """
+
+    # Left in the socket until complete
+    data = control.recv(REQUEST.size, socket.MSG_PEEK)
+    if not data:
+        raise ConnectionError("Handoff connection closed")
+
+    if len(data) < REQUEST.size:
+        raise BlockingIOError()
+
+    version, flags = REQUEST.unpack(recv_exactly(control, REQUEST.size))
+    if version != VERSION:
+        raise ConnectionRefusedError(f"Unsupported handoff version {version}")
+
+    return bool(flags & FLAG_CLIENTS)
+
+def send_state(control, state, fds):
+    """Sends the state and the descriptors to the successor (old server side)
+
+    Args:
+        control (socket.socket): The control connection.
+        state (dict): The JSON serializable state.
+        fds (list[int]): The descriptors.
+
+    Raises:
+        OSError: If the successor is gone.
+    """
+
+    data = json.dumps(state).encode("utf-8")
+    control.sendall(HEADER.pack(VERSION, len(data), len(fds)) + data)
+
+    for i in range(0, len(fds), MAX_FDS):
+        socket.send_fds(control, [b"\x00"], fds[i:i+MAX_FDS])
+
+def confirm(control):
+    """Confirms that the sockets were taken over (successor side)
+
+    Args:
+        control (socket.socket): The control connection, closed afterwards.
+
+    Raises:
+        OSError: If the old server is gone, e.g. because it timed out.
+    """
+
+    with control:
+        control.sendall(b"\x00")
+
+def wait_confirmation(control):
+    """Waits for the successor to confirm it took the sockets over (old
+    server side)
+
+    Args:
+        control (socket.socket): The control connection.
+
+    Raises:
+        OSError: If the successor did not confirm in time.
+    """
+
+    if control.recv(1) != b"\x00":
+        raise ConnectionAbortedError("Handoff not confirmed")
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""In-process transport for clients running in the same process as the server
+
+A connection is a pair of in-memory pipes: frames written by a side are
+handed to the other side's pipe as bytes objects, without going through
+sockets. The server side of every loopback connection is watched through a
+single :py:class:`Hub`, with a single wakeup descriptor. The client side is
+signaled through the descriptor its selector already watches to be woken up
+by other threads (see :py:class:`Doorbell`), so connections use no
+descriptors of their own.
+
+Wakeups are only signaled when they are not signaled yet, and only drained
+once the pipe is empty, so that the system calls are limited to waking up a
+side which has to wait in its selector.
+
+Clients attach to a running server with
+:py:meth:`dragonfly.server.Server.attach`, usually through
+:py:meth:`dragonfly.client.Client.connect`.
+"""
+
+from collections import deque
+import selectors
+import threading
+
+from dragonfly.shm import Wakeup
+
+#: Default capacity of each pipe, in bytes
+PIPE_SIZE = 1 << 20
+
+class Pipe:
+    """One direction of a loopback connection
+
+    Written by one thread and read by another.
+    """
+
+    def __init__(self, capacity):
+        """Initializes a Pipe instance
+
+        Args:
+            capacity (int): Maximum number of buffered bytes.
+        """
+
+        self.capacity = capacity
+        self.chunks = deque()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        #: Set by the writer when it is waiting for room
+        self.waiting = False
+
+        #: Set when the writer closed its end
+        self.closed = False
+
+    def __len__(self):
+        return self.size
+
+    def free(self):
+        """Returns the number of bytes that can be written
+
+        Returns:
+            int: The free space, in bytes.
+        """
+
+        return self.capacity - self.size
+
+    def write(self, data):
+        """Writes as much data as fits
+
+        Args:
+            data (bytes-like): The data.
+
+        Returns:
+            int: The number of bytes written.
+        """
+
+        with self.lock:
+            count = min(len(data), self.capacity - self.size)
+            if count:
+                chunk = data if count == len(data) and isinstance(data, bytes) else bytes(data[:count])
+                self.chunks.append(chunk)
+                self.size += count
+
+            return count
+
+    def read(self, size):
+        """Reads up to ``size`` bytes
+
+        Args:
+            size (int): Maximum number of bytes.
+
+        Returns:
+            bytes: The data read.
+        """
+
+        with self.lock:
+            parts = []
+            count = 0
+
+            while self.chunks and count < size:
+                chunk = self.chunks.popleft()
+                if count + len(chunk) > size:
+                    self.chunks.appendleft(chunk[size - count:])
+                    chunk = chunk[:size - count]
+
+                parts.append(chunk)
+                count += len(chunk)
+
+            self.size -= count
+
+            return parts[0] if len(parts) == 1 else b"".join(parts)
+
+class Doorbell:
+    """Wakeup of a client side socket, skipping redundant system calls
+
+    The descriptor is only written to when it is not readable yet, and only
+    read from when it was written to.
+    """
+
+    def __init__(self, wakeup=None):
+        """Initializes a Doorbell instance
+
+        Args:
+            wakeup (dragonfly.shm.Wakeup, optional): Descriptor to signal,
+                usually the client's own wakeup, closed by its owner (see
+                :py:meth:`detach`). Defaults to None (a new one is created,
+                closed along with the doorbell).
+        """
+
+        self.wakeup = Wakeup() if wakeup is None else wakeup
+        self.owned = wakeup is None
+        self.lock = threading.Lock()
+        self.signaled = False
+        self.closed = False
+
+    @property
+    def fds(self):
+        return self.wakeup.fds
+
+    def fileno(self):
+        return self.wakeup.fileno()
+
+    def signal(self):
+        with self.lock:
+            if not self.signaled and not self.closed:
+                self.signaled = True
+                self.wakeup.signal()
+
+    def drain(self):
+        with self.lock:
+            if self.signaled and not self.closed:
+                self.signaled = False
+                self.wakeup.drain()
+
+    def detach(self):
+        """Stops using a descriptor its owner is about to close"""
+
+        with self.lock:
+            self.closed = True
+
+    def close(self):
+        if self.owned:
+            self.detach()
+            self.wakeup.close()
+
+class HubWakeup:
+    """Wakeup of a server side socket, signaling its :py:class:`Hub`
+
+    The socket is only queued on the hub when it is not queued yet: the hub
+    resets :py:attr:`signaled` when it yields the socket.
+    """
+
+    def __init__(self, hub):
+        """Initializes a HubWakeup instance
+
+        Args:
+            hub (Hub): The hub.
+        """
+
+        self.hub = hub
+        self.sock = None
+        self.lock = threading.Lock()
+        self.signaled = False
+
+    def fileno(self):
+        return -1
+
+    def signal(self):
+        with self.lock:
+            if self.signaled:
+                return
+
+            self.signaled = True
+
+        self.hub.notify(self.sock)
+
+    def reset(self):
+        """Lets the next signal queue the socket again"""
+
+        with self.lock:
+            self.signaled = False
+
+    def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+class LoopbackSocket:
+    """Socket-like end of a loopback connection
+
+    Only the methods used by the server and the client are provided. Like
+    :py:class:`dragonfly.shm.ShmSocket`, the socket only becomes readable:
+    it is signaled both when data is received and when room is freed for
+    sending.
+    """
+
+    #: Writing is retried when the socket is readable, instead of watching
+    #: it for writability
+    wakes_on_space = True
+
+    def __init__(self, rx, tx, wakeup, peer_wakeup, lock):
+        """Initializes a LoopbackSocket instance
+
+        Args:
+            rx (Pipe): The pipe this side reads from.
+            tx (Pipe): The pipe this side writes to.
+            wakeup (Doorbell|HubWakeup): This side's wakeup.
+            peer_wakeup (Doorbell|HubWakeup): The other side's wakeup.
+            lock (threading.Lock): Lock shared by both sides, guarding
+                closing.
+        """
+
+        self.rx = rx
+        self.tx = tx
+        self.wakeup = wakeup
+        self.peer_wakeup = peer_wakeup
+        self.lock = lock
+
+    def fileno(self):
+        return -1 if self.tx.closed else self.wakeup.fileno()
+
+    def setblocking(self, flag):
+        pass
+
+    def recv(self, size):
+        """Reads received data
+
+        Args:
+            size (int): Maximum number of bytes.
+
+        Raises:
+            BlockingIOError: If there is no data to read.
+
+        Returns:
+            bytes: The data, or b"" if the other side closed the connection.
+        """
+
+        data = self.rx.read(size)
+
+        if self.rx.waiting and data:
+            self.rx.waiting = False
+            self.peer_wakeup.signal()
+
+        if not len(self.rx):
+            self.wakeup.drain()
+
+        # Stay readable until the pipe is drained, checked after draining
+        # in case it was written in the meantime
+        if len(self.rx):
+            self.wakeup.signal()
+
+        elif not data and self.rx.closed:
+            return b""
+
+        if not data:
+            raise BlockingIOError()
+
+        return data
+
+    def send(self, data):
+        """Writes as much data as fits in the pipe
+
+        Args:
+            data (bytes-like): The data.
+
+        Raises:
+            BlockingIOError: If the pipe is full.
+
+        Returns:
+            int: The number of bytes written.
+        """
+
+        if self.tx.closed or self.rx.closed:
+            raise BrokenPipeError()
+
+        count = self.tx.write(data)
+        if count:
+            self.peer_wakeup.signal()
+
+        if count < len(data):
+            self.tx.waiting = True
+
+            # The peer may have read everything in the meantime
+            if self.tx.free():
+                self.tx.waiting = False
+                self.wakeup.signal()
+
+            if not count:
+                raise BlockingIOError()
+
+        return count
+
+    def close(self):
+        """Closes this end of the connection
+
+        Both sides may signal the wakeups until they are closed, so the
+        wakeups are only closed along with the last side.
+        """
+
+        with self.lock:
+            if self.tx.closed:
+                return
+
+            self.tx.closed = True
+            if self.rx.closed:
+                self.wakeup.close()
+                self.peer_wakeup.close()
+
+            else:
+                self.peer_wakeup.signal()
+
+class Hub:
+    """Watches the server side of loopback connections
+
+    Implements the part of :py:class:`selectors.BaseSelector` used by the
+    server's clients, and is itself registered to the server's selector
+    through a single wakeup descriptor.
+    """
+
+    def __init__(self, capacity=PIPE_SIZE):
+        """Initializes a Hub instance
+
+        Args:
+            capacity (int, optional): Capacity of each pipe, in bytes.
+                Defaults to :py:const:`PIPE_SIZE`.
+        """
+
+        self.capacity = capacity
+        self.wakeup = Wakeup()
+        self.signaled = False
+        self.keys = {}
+        self.ready = deque()
+        self.pending = deque()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        return self.wakeup.fileno()
+
+    def connect(self, doorbell=None):
+        """Opens a connection (client side, from any thread)
+
+        Args:
+            doorbell (Doorbell, optional): Wakeup of the client side.
+                Defaults to None (a new one is created).
+
+        Raises:
+            ConnectionRefusedError: If the hub is closed.
+
+        Returns:
+            LoopbackSocket: The client side of the connection.
+        """
+
+        if self.closed:
+            raise ConnectionRefusedError("Server is stopped")
+
+        c2s, s2c = Pipe(self.capacity), Pipe(self.capacity)
+        client_wakeup = Doorbell() if doorbell is None else doorbell
+        server_wakeup = HubWakeup(self)
+        lock = threading.Lock()
+        server_sock = LoopbackSocket(c2s, s2c, server_wakeup, client_wakeup, lock)
+        server_wakeup.sock = server_sock
+
+        self.pending.append(server_sock)
+        self.notify(None)
+
+        return LoopbackSocket(s2c, c2s, client_wakeup, server_wakeup, lock)
+
+    def accept(self):
+        """Returns the connections opened since the last call
+
+        Returns:
+            list[LoopbackSocket]: The server side of the connections.
+        """
+
+        conns = []
+        while self.pending:
+            conns.append(self.pending.popleft())
+
+        return conns
+
+    def notify(self, sock):
+        """Marks a socket as ready (from any thread)
+
+        Args:
+            sock (LoopbackSocket): The server side socket.
+        """
+
+        self.ready.append(sock)
+        with self.lock:
+            if not self.closed and not self.signaled:
+                self.signaled = True
+                self.wakeup.signal()
+
+    def register(self, sock, events, data=None):
+        self.keys[sock] = selectors.SelectorKey(sock, -1, events, data)
+        # Pending data or room may have been signaled while unregistered
+        sock.wakeup.reset()
+        sock.wakeup.signal()
+
+    def modify(self, sock, events, data=None):
+        self.register(sock, events, data)
+
+    def unregister(self, sock):
+        del self.keys[sock]
+
+    def select(self):
+        """Yields the sockets signaled since the last call
+
+        Sockets are checked as they are yielded, so that connections closed
+        while handling previous events are skipped.
+
+        Yields:
+            tuple[selectors.SelectorKey, int]: The key and the event mask.
+        """
+
+        with self.lock:
+            if self.signaled and not self.closed:
+                self.signaled = False
+                self.wakeup.drain()
+
+        seen = set()
+
+        # Sockets signaled while handling these wait for the next call
+        for _ in range(len(self.ready)):
+            sock = self.ready.popleft()
+            key = self.keys.get(sock)
+
+            # Before its data is read, so that data written from now on
+            # queues it again
+            if sock is not None:
+                sock.wakeup.reset()
+
+            if key is not None and not sock in seen:
+                seen.add(sock)
+                yield key, selectors.EVENT_READ
+
+    def close(self):
+        """Refuses new connections and closes pending ones"""
+
+        with self.lock:
+            self.closed = True
+            self.wakeup.close()
+
+        for sock in self.accept():
+            sock.close()
@@ -19,8 +19,9 @@
 import logging
 import struct
 
+from dragonfly import compression
 from dragonfly.bytes import ByteStream
-from dragonfly.exceptions import InvalidMessageType, MissingProperty
+from dragonfly.exceptions import InvalidMessageType, InvalidPayload, InvalidTopicAlias, MissingProperty, UnsupportedCodec, UnsupportedVersion
 
 CONNECT = 0
 CONNECTED = 1
@@ -30,6 +31,12 @@ SUBSCRIBE = 4
 SUBSCRIBED = 5
 UNSUBSCRIBE = 6
 UNSUBSCRIBED = 7
+BATCH = 8
+BATCHED = 9
+CHUNK = 10
+SESSION = 11
+PING = 12
+PONG = 13
 
 ORIGIN_SERVER = 0
 ORIGIN_CLIENT = 1
@@ -39,9 +46,49 @@ FLAG_1 = 2
 FLAG_2 = 4
 FLAG_3 = 8
 
+#: Flag marking an extended message type (type >= 8), see :py:class:`MessageType`
+FLAG_EXTENDED = FLAG_3
+
+#: PUBLISH flag: the body is binary
+PUBLISH_BINARY = FLAG_0
+#: PUBLISH flag: the body is compressed
+PUBLISH_COMPRESSED = FLAG_1
+#: PUBLISH flag: the topic is replaced by an alias
+PUBLISH_ALIAS = FLAG_2
+
+#: Bit of an alias field indicating that the alias is defined, i.e. that the
+#: topic follows
+ALIAS_DEFINE = 0x8000
+
+#: Default maximum number of topic aliases accepted per connection
+TOPIC_ALIAS_MAX = 1024
+
+#: CHUNK flag: first chunk of a stream, carries the topic
+CHUNK_FIRST = FLAG_0
+#: CHUNK flag: last chunk of a stream
+CHUNK_LAST = FLAG_1
+#: CHUNK flag: the stream has been aborted and must be discarded
+CHUNK_ABORT = FLAG_2
+
+#: Maximum number of sub-messages in a BATCH
+MAX_BATCH = 0xffff
+
+#: Size of a message header (version, type and body length)
+HEADER_SIZE = 7
+
+#: Maximum number of bytes read from a socket at once
+RECV_SIZE = 65536
+
+#: Maximum number of bytes written to a socket at once when coalescing frames
+SEND_SIZE = 65536
+
+#: Default size of the chunks of a streamed message
+CHUNK_SIZE = 65536
+
 _type_names = [
     "CONNECT", "CONNECTED", "PUBLISH", "PUBLISHED",
-    "SUBSCRIBE", "SUBSCRIBED", "UNSUBSCRIBE", "UNSUBSCRIBED"
+    "SUBSCRIBE", "SUBSCRIBED", "UNSUBSCRIBE", "UNSUBSCRIBED",
+    "BATCH", "BATCHED", "CHUNK", "SESSION", "PING", "PONG"
 ]
 
 def type_name(type_):
@@ -63,6 +110,10 @@ class MessageType:
     """Message type
 
     Contains information about origin, type and flags of the message.
+
+    The type field only holds 3 bits, so types 8 to 15 are encoded with
+    :py:const:`FLAG_EXTENDED` set and their lower 3 bits in the type field.
+    Extended types thus only have 3 flags available.
     """
 
     def __init__(self, byte):
@@ -70,6 +121,10 @@ class MessageType:
         self.type = (byte & 0x70) >> 4
         self.flags = byte & 0x0f
 
+        if self.flags & FLAG_EXTENDED:
+            self.type |= 8
+            self.flags &= ~FLAG_EXTENDED
+
     def __repr__(self):
         return f"{self.origin} {type_name(self.type)} {self.flags:04b}"
 
@@ -80,16 +135,58 @@ class MessageType:
             bytes: The encoded bytes.
         """
 
+        flags = self.flags
+        if self.type & 8:
+            flags |= FLAG_EXTENDED
+
         _ = (self.origin << 7) | \
-            (self.type << 4) | \
-            self.flags
+            ((self.type & 7) << 4) | \
+            flags
 
         return _.to_bytes(1, "big")
 
 class Message:
-    """Dragonfly message"""
+    """Dragonfly message
+
+    Protocol versions:
+        * 0: PUBLISH bodies are UTF-8 strings with a 2 byte length
+        * 1: PUBLISH bodies have a 4 byte length and may be raw bytes, in
+          which case :py:const:`PUBLISH_BINARY` is set
+
+    CONNECT and CONNECTED messages may end with :py:attr:`properties`, string
+    key-value pairs used to negotiate connection options.
+
+    If :py:attr:`codec` is set, PUBLISH bodies of at least
+    :py:attr:`threshold` bytes are compressed (v1 only) and
+    :py:const:`PUBLISH_COMPRESSED` is set. A compressed body is prefixed by
+    the codec's id and only decompressed when :py:attr:`body` is first
+    accessed, up to :py:attr:`max_size` bytes. Compressed bodies are cached
+    by codec, so that relaying a message to peers using the same codec does
+    not compress it again.
+
+    If :py:attr:`alias` is set, the PUBLISH topic is replaced by a 2 byte
+    alias (v1 only) and :py:const:`PUBLISH_ALIAS` is set. The alias is
+    defined on its first use by setting :py:const:`ALIAS_DEFINE` and
+    appending the topic. Aliases are assigned and resolved per connection,
+    see :py:class:`TopicAliases`.
+
+    Large bodies can be streamed as a sequence of CHUNK messages sharing a
+    stream id. The first chunk (:py:const:`CHUNK_FIRST`) carries the topic,
+    the last one has :py:const:`CHUNK_LAST` set. Chunk data is always binary.
+
+    SESSION messages carry a complete inner message (:py:attr:`frame`) of the
+    logical session identified by :py:attr:`session_id`, letting several
+    sessions share a connection. The inner frame is left encoded since it is
+    decoded with its session's topic aliases.
+
+    PING messages have no body and are answered with a PONG message, to keep
+    idle connections alive and detect dead peers.
+
+    Messages of any supported version can be decoded. Messages are encoded
+    according to their :py:attr:`version`.
+    """
 
-    VERSION = 0
+    VERSION = 1
 
     def __init__(self, origin=ORIGIN_SERVER, type_=CONNECT, flags=0, **kwargs):
         """Initializes a Message instance
@@ -99,14 +196,23 @@ class Message:
                 or ORIGIN_CLIENT. Defaults to ORIGIN_SERVER.
             type_ (int, optional): The message's type, one of [CONNECT, CONNECTED,
                 PUBLISH, PUBLISHED, SUBSCRIBE, SUBSCRIBED, UNSUBSCRIBE,
-                UNSUBSCRIBED]. Defaults to CONNECT.
+                UNSUBSCRIBED, BATCH, BATCHED, CHUNK, SESSION, PING, PONG].
+                Defaults to CONNECT.
             flags (int, optional): The message's flags. Default to 0.
             **kwargs: Additional message properties.
         """
 
         self.bytes = b""
         self.version = self.VERSION
-        self.type = MessageType(origin<<7 | type_<<4 | flags)
+        self.type = MessageType(origin<<7 | (type_ & 7)<<4 | flags)
+        self.type.type = type_
+        self.properties = {}
+        self.codec = None
+        self.threshold = compression.DEFAULT_THRESHOLD
+        self.binary = False
+        self.packed = {}
+        self.max_size = compression.MAX_SIZE
+        self.alias = None
         for k, v in kwargs.items():
             setattr(self, k, v)
 
@@ -114,11 +220,95 @@ class Message:
         #return f"<v{self.version} Message of type {self.type}>"
         return str(self.__dict__)
 
-    def from_bytes(self, bytes_):
+    @property
+    def body(self):
+        """The PUBLISH body, decompressed on first access
+
+        Raises:
+            InvalidPayload: If the compressed body is corrupt, larger than
+                :py:attr:`max_size` or not valid UTF-8 while not binary.
+        """
+
+        if not "_body" in self.__dict__:
+            if not self.packed:
+                raise AttributeError("'Message' object has no attribute 'body'")
+
+            codec, data = next(iter(self.packed.items()))
+            body = compression.decompress(codec, data, self.max_size)
+
+            try:
+                self._body = body if self.binary else body.decode("utf-8")
+
+            except UnicodeDecodeError as e:
+                raise InvalidPayload(f"Compressed body is not valid UTF-8: {e}")
+
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        self.binary = isinstance(value, (bytes, bytearray, memoryview))
+        self.packed = {}
+
+    def get_int_property(self, key, default=0):
+        """Returns an integer property
+
+        Args:
+            key (str): The property's key.
+            default (int, optional): Value returned if the property is missing
+                or invalid. Defaults to 0.
+
+        Returns:
+            int: The property's value.
+        """
+
+        try:
+            return int(self.properties.get(key, default))
+
+        except ValueError:
+            return default
+
+    def payload(self):
+        """Returns the PUBLISH body as bytes
+
+        Returns:
+            bytes: The raw body if binary, the UTF-8 encoded body otherwise.
+        """
+
+        if self.binary:
+            return memoryview(self.body).cast("B")
+
+        return (self.body or "").encode("utf-8")
+
+    def pack(self):
+        """Compresses the PUBLISH body with :py:attr:`codec`
+
+        Returns:
+            bytes: The compressed body, or None if the body should be sent
+                uncompressed (no codec, smaller than :py:attr:`threshold` or
+                incompressible).
+        """
+
+        if self.codec is None:
+            return None
+
+        if not self.codec in self.packed:
+            payload = self.payload()
+            if len(payload) < self.threshold:
+                return None
+
+            data = compression.compress(self.codec, payload)
+            self.packed[self.codec] = data if len(data) < len(payload) else None
+
+        return self.packed[self.codec]
+
+    def from_bytes(self, bytes_, aliases=None):
         """Parses a message from bytes
 
         Args:
             bytes_ (bytes): The message's bytes.
+            aliases (TopicAliases, optional): The connection's topic aliases,
+                used to resolve aliased topics. Defaults to None.
 
         Returns:
             True if the message has been successfully decoded, False otherwise.
@@ -128,48 +318,129 @@ class Message:
             self.bytes = bytes_
             stream = ByteStream(bytes_)
             self.version = struct.unpack(">H", stream.read(2))[0]
+            if self.version > self.VERSION:
+                raise UnsupportedVersion(f"Unsupported protocol version {self.version}")
+
             self.type = MessageType(stream.read(1)[0])
             self.body_length = struct.unpack(">I", stream.read(4))[0]
+            self.read_body(stream, aliases)
+
+        except struct.error:
+            logging.getLogger("dragonfly").error("Malformed message")
+            return False
 
-            if self.type.type == CONNECT:
-                self.username, self.password = None, None
+        except UnicodeDecodeError:
+            logging.getLogger("dragonfly").error("Cannot decode non utf-8 characters")
+            return False
 
-                if self.type.flags & FLAG_1:
-                    self.username = self.read_string(stream)
+        except (InvalidMessageType, InvalidTopicAlias, UnsupportedCodec, UnsupportedVersion) as e:
+            logging.getLogger("dragonfly").error(e)
+            return False
 
-                if self.type.flags & FLAG_0:
-                    self.password = self.read_string(stream)
+        return True
 
-            elif self.type.type == PUBLISH:
-                self.topic = self.read_string(stream)
-                self.body = self.read_string(stream)
+    def read_body(self, stream, aliases=None):
+        """Parses the message's body from a byte stream
 
-            elif self.type.type == SUBSCRIBE:
-                self.topic = self.read_string(stream)
+        The message's type must already be set.
+
+        Args:
+            stream (ByteStream): Input stream, positioned at the start of the body.
+            aliases (TopicAliases, optional): The connection's topic aliases,
+                used to resolve aliased topics. Defaults to None.
+
+        Raises:
+            struct.error: If the body is malformed.
+            UnicodeDecodeError: If a string is not valid UTF-8.
+            InvalidMessageType: If the type is unknown or not allowed here.
+            UnsupportedCodec: If the body is compressed with an unknown codec.
+            InvalidTopicAlias: If an alias is used but cannot be resolved.
+        """
+
+        if self.type.type == CONNECT:
+            self.username, self.password = None, None
+
+            if self.type.flags & FLAG_1:
+                self.username = self.read_string(stream)
+
+            if self.type.flags & FLAG_0:
+                self.password = self.read_string(stream)
+
+            self.properties = self.read_properties(stream)
+
+        elif self.type.type == PUBLISH:
+            if self.version >= 1 and self.type.flags & PUBLISH_ALIAS:
+                self.topic = self.read_alias(stream, aliases)
 
-            elif self.type.type == UNSUBSCRIBE:
+            else:
                 self.topic = self.read_string(stream)
 
-            elif self.type.type in [CONNECTED, PUBLISHED, SUBSCRIBED, UNSUBSCRIBED]:
-                self.code = struct.unpack(">B", stream.read(1))[0]
+            if self.version == 0:
+                self.body = self.read_string(stream)
+
+            elif self.type.flags & PUBLISH_COMPRESSED:
+                data = self.read_bytes(stream)
+                codec = compression.codec_name(struct.unpack(">B", data[:1])[0])
+                self.__dict__.pop("_body", None)
+                self.binary = bool(self.type.flags & PUBLISH_BINARY)
+                self.packed = {codec: data[1:]}
+
+            elif self.type.flags & PUBLISH_BINARY:
+                self.body = self.read_bytes(stream)
 
             else:
-                raise InvalidMessageType(f"{self.type.type} is not a valid message type")
+                self.body = self.read_bytes(stream).decode("utf-8")
 
-        except struct.error:
-            logging.getLogger("dragonfly").error("Malformed message")
-            return False
+        elif self.type.type == SUBSCRIBE:
+            self.topic = self.read_string(stream)
 
-        except UnicodeDecodeError:
-            logging.getLogger("dragonfly").error("Cannot decode non utf-8 characters")
-            return False
+        elif self.type.type == UNSUBSCRIBE:
+            self.topic = self.read_string(stream)
 
-        except InvalidMessageType as e:
-            logging.getLogger("dragonfly").error(e)
-            return False
+        elif self.type.type in [CONNECTED, PUBLISHED, SUBSCRIBED, UNSUBSCRIBED]:
+            self.code = struct.unpack(">B", stream.read(1))[0]
 
-        return True
+            if self.type.type == CONNECTED:
+                self.properties = self.read_properties(stream)
+
+        elif self.type.type == BATCH:
+            count = struct.unpack(">H", stream.read(2))[0]
+            self.messages = []
+
+            for _ in range(count):
+                msg = Message()
+                msg.version = self.version
+                msg.type = MessageType(stream.read(1)[0])
+                length = struct.unpack(">I", stream.read(4))[0]
+
+                if msg.type.type in [BATCH, BATCHED]:
+                    raise InvalidMessageType(f"{type_name(msg.type.type)} cannot be nested in a batch")
 
+                msg.read_body(ByteStream(stream.read(length)), aliases)
+                self.messages.append(msg)
+
+        elif self.type.type == BATCHED:
+            count = struct.unpack(">H", stream.read(2))[0]
+            self.codes = list(struct.unpack(f">{count}B", stream.read(count)))
+
+        elif self.type.type == CHUNK:
+            self.stream_id = struct.unpack(">I", stream.read(4))[0]
+            self.topic = None
+
+            if self.type.flags & CHUNK_FIRST:
+                self.topic = self.read_string(stream)
+
+            self.data = stream.read()
+
+        elif self.type.type == SESSION:
+            self.session_id = struct.unpack(">I", stream.read(4))[0]
+            self.frame = stream.read()
+
+        elif self.type.type in [PING, PONG]:
+            pass
+
+        else:
+            raise InvalidMessageType(f"{self.type.type} is not a valid message type")
 
     def to_bytes(self):
         """Formats the message to bytes
@@ -181,64 +452,184 @@ class Message:
         bytes_ = b""
 
         try:
-            body = b""
+            body = self.write_body()
 
-            if self.type.type == CONNECT:
-                if hasattr(self, "username") and self.username:
-                    self.type.flags |= FLAG_1
-                    body += self.write_string(self.username)
+            bytes_ = b"".join([
+                struct.pack(">H", self.version),
+                self.type.to_bytes(),
+                struct.pack(">I", len(body)),
+                body
+            ])
 
-                if hasattr(self, "password") and self.password:
-                    self.type.flags |= FLAG_0
-                    body += self.write_string(self.password)
+        except struct.error as e:
+            logging.getLogger("dragonfly").error("Cannot encode message: %s", e)
 
-            elif self.type.type == PUBLISH:
-                if not hasattr(self, "topic"):
-                    raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'topic'.")
+        except UnicodeEncodeError:
+            logging.getLogger("dragonfly").error("Cannot encode non utf-8 characters")
+
+        except InvalidMessageType as e:
+            logging.getLogger("dragonfly").error(e)
 
-                if not hasattr(self, "body"):
-                    raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'body'.")
+        except MissingProperty as e:
+            logging.getLogger("dragonfly").error(e)
 
+        except InvalidPayload as e:
+            logging.getLogger("dragonfly").error("Cannot encode message: %s", e)
+
+        except UnsupportedVersion as e:
+            logging.getLogger("dragonfly").error(e)
+
+        self.bytes = bytes_
+        return bytes_
+
+    def write_body(self):
+        """Formats the message's body to bytes
+
+        May set flags on the message's type, so it must be called before
+        encoding the type.
+
+        Returns:
+            bytes: The body's bytes.
+
+        Raises:
+            UnicodeEncodeError: If a string cannot be encoded in UTF-8.
+            InvalidMessageType: If the type is unknown or not allowed here.
+            MissingProperty: If a property required by the type is missing.
+            UnsupportedCodec: If :py:attr:`codec` is not available.
+            InvalidPayload: If a compressed body to encode with another codec
+                cannot be decompressed.
+            UnsupportedVersion: If a binary body is encoded in version 0.
+        """
+
+        body = b""
+
+        if self.type.type == CONNECT:
+            if hasattr(self, "username") and self.username:
+                self.type.flags |= FLAG_1
+                body += self.write_string(self.username)
+
+            if hasattr(self, "password") and self.password:
+                self.type.flags |= FLAG_0
+                body += self.write_string(self.password)
+
+            body += self.write_properties(self.properties)
+
+        elif self.type.type == PUBLISH:
+            if not hasattr(self, "topic"):
+                raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'topic'.")
+
+            # Checked without accessing it, so that it is not decompressed
+            if not "_body" in self.__dict__ and not self.packed:
+                raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'body'.")
+
+            if self.version >= 1 and self.alias is not None:
+                self.type.flags |= PUBLISH_ALIAS
+                body += self.write_alias(*self.alias)
+
+            else:
+                self.type.flags &= ~PUBLISH_ALIAS
                 body += self.write_string(self.topic)
+
+            if self.version == 0:
+                if self.binary:
+                    raise UnsupportedVersion("Binary bodies require protocol version 1")
+
                 body += self.write_string(self.body)
 
-            elif self.type.type == SUBSCRIBE:
-                if not hasattr(self, "topic"):
-                    raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'topic'.")
+            else:
+                self.type.flags &= ~(PUBLISH_BINARY | PUBLISH_COMPRESSED)
+                if self.binary:
+                    self.type.flags |= PUBLISH_BINARY
 
-                body += self.write_string(self.topic)
+                packed = self.pack()
+
+                if packed is None:
+                    body = b"".join([body, self.write_bytes(self.payload())])
+
+                else:
+                    self.type.flags |= PUBLISH_COMPRESSED
+                    codec = struct.pack(">B", compression.codec_id(self.codec))
+                    body = b"".join([body, self.write_bytes(codec + packed)])
+
+        elif self.type.type == SUBSCRIBE:
+            if not hasattr(self, "topic"):
+                raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'topic'.")
+
+            body += self.write_string(self.topic)
+
+        elif self.type.type == UNSUBSCRIBE:
+            if not hasattr(self, "topic"):
+                raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'topic'.")
+
+            body += self.write_string(self.topic)
+
+        elif self.type.type in [CONNECTED, PUBLISHED, SUBSCRIBED, UNSUBSCRIBED]:
+            if not hasattr(self, "code") or self.code is None:
+                self.code = 0
+
+            body += struct.pack(">B", self.code)
 
-            elif self.type.type == UNSUBSCRIBE:
+            if self.type.type == CONNECTED:
+                body += self.write_properties(self.properties)
+
+        elif self.type.type == BATCH:
+            if not hasattr(self, "messages"):
+                raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'messages'.")
+
+            if len(self.messages) > MAX_BATCH:
+                raise InvalidMessageType(f"A batch cannot hold more than {MAX_BATCH} messages")
+
+            body += struct.pack(">H", len(self.messages))
+            for msg in self.messages:
+                if msg.type.type in [BATCH, BATCHED]:
+                    raise InvalidMessageType(f"{type_name(msg.type.type)} cannot be nested in a batch")
+
+                # Sub-messages are read with the batch's version
+                msg.version = self.version
+                sub_body = msg.write_body()
+                body += msg.type.to_bytes()
+                body += struct.pack(">I", len(sub_body))
+                body += sub_body
+
+        elif self.type.type == BATCHED:
+            if not hasattr(self, "codes"):
+                raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'codes'.")
+
+            body += struct.pack(">H", len(self.codes))
+            body += struct.pack(f">{len(self.codes)}B", *self.codes)
+
+        elif self.type.type == CHUNK:
+            if not hasattr(self, "stream_id"):
+                raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'stream_id'.")
+
+            body += struct.pack(">I", self.stream_id)
+
+            if self.type.flags & CHUNK_FIRST:
                 if not hasattr(self, "topic"):
                     raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'topic'.")
 
                 body += self.write_string(self.topic)
 
-            elif self.type.type in [CONNECTED, PUBLISHED, SUBSCRIBED, UNSUBSCRIBED]:
-                if not hasattr(self, "code") or self.code is None:
-                    self.code = 0
+            data = getattr(self, "data", None)
+            if data:
+                body = b"".join([body, memoryview(data).cast("B")])
 
-                body += struct.pack(">B", self.code)
+        elif self.type.type == SESSION:
+            if not hasattr(self, "session_id"):
+                raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'session_id'.")
 
-            else:
-                raise InvalidMessageType(f"{self.type.type} is not a valid message type")
-
-            bytes_ += struct.pack(">H", self.version)
-            bytes_ += self.type.to_bytes()
-            bytes_ += struct.pack(">I", len(body))
-            bytes_ += body
+            if not hasattr(self, "frame"):
+                raise MissingProperty(f"The message is of type {type_name(self.type.type)} but is missing property 'frame'.")
 
-        except UnicodeEncodeError:
-            logging.getLogger("dragonfly").error("Cannot encode non utf-8 characters")
+            body += struct.pack(">I", self.session_id) + self.frame
 
-        except InvalidMessageType as e:
-            logging.getLogger("dragonfly").error(e)
+        elif self.type.type in [PING, PONG]:
+            pass
 
-        except MissingProperty as e:
-            logging.getLogger("dragonfly").error(e)
+        else:
+            raise InvalidMessageType(f"{self.type.type} is not a valid message type")
 
-        self.bytes = bytes_
-        return bytes_
+        return body
 
     def read_string(self, stream):
         """Reads a string from a byte stream
@@ -273,6 +664,268 @@ class Message:
 
         if string is None:
             string = ""
-        bytes_ = struct.pack(">H", len(string))
-        bytes_ += string.encode("utf-8")
+        encoded = string.encode("utf-8")
+        bytes_ = struct.pack(">H", len(encoded))
+        bytes_ += encoded
         return bytes_
+
+    def read_alias(self, stream, aliases):
+        """Reads an aliased topic from a byte stream
+
+        Args:
+            stream (ByteStream): Input stream.
+            aliases (TopicAliases): The connection's topic aliases.
+
+        Returns:
+            str: The topic.
+
+        Raises:
+            InvalidTopicAlias: If the alias cannot be defined or resolved.
+        """
+
+        if aliases is None:
+            raise InvalidTopicAlias("Topic aliases are not enabled on this connection")
+
+        alias = struct.unpack(">H", stream.read(2))[0]
+
+        if alias & ALIAS_DEFINE:
+            topic = self.read_string(stream)
+            aliases.define(alias & ~ALIAS_DEFINE, topic)
+            return topic
+
+        return aliases.resolve(alias)
+
+    def write_alias(self, alias, new):
+        """Formats an aliased topic to bytes
+
+        Args:
+            alias (int): The alias.
+            new (bool): Whether the alias is used for the first time, in which
+                case it is defined along with the topic.
+
+        Returns:
+            bytes: The encoded alias.
+        """
+
+        if new:
+            return struct.pack(">H", alias | ALIAS_DEFINE) + self.write_string(self.topic)
+
+        return struct.pack(">H", alias)
+
+    def read_properties(self, stream):
+        """Reads properties from a byte stream
+
+        Properties are key-value pairs of strings and span until the end of
+        the stream.
+
+        Args:
+            stream (ByteStream): Input stream.
+
+        Returns:
+            dict: The properties.
+        """
+
+        properties = {}
+        while stream.pos < len(stream.bytes):
+            key = self.read_string(stream)
+            properties[key] = self.read_string(stream)
+
+        return properties
+
+    def write_properties(self, properties):
+        """Formats properties to bytes
+
+        Args:
+            properties (dict): The properties. Values are converted to strings.
+
+        Returns:
+            bytes: The encoded properties.
+        """
+
+        bytes_ = b""
+        for key, value in properties.items():
+            bytes_ += self.write_string(key)
+            bytes_ += self.write_string(str(value))
+
+        return bytes_
+
+    def read_bytes(self, stream):
+        """Reads a byte string from a byte stream
+
+        A byte string is always preceeded by a 4 byte unsigned int indicating
+        its length.
+
+        Args:
+            stream (ByteStream): Input stream.
+
+        Returns:
+            bytes: The byte string.
+        """
+
+        length = struct.unpack(">I", stream.read(4))[0]
+        return stream.read(length)
+
+    def write_bytes(self, bytes_):
+        """Formats a byte string
+
+        A byte string is always preceeded by a 4 byte unsigned int indicating
+        its length.
+
+        Args:
+            bytes_ (bytes): The byte string, or any object supporting the
+                buffer protocol.
+
+        Returns:
+            bytes: The length-prefixed byte string.
+        """
+
+        bytes_ = memoryview(bytes_).cast("B")
+        return b"".join([struct.pack(">I", len(bytes_)), bytes_])
+
+class TopicAliases:
+    """Topic alias tables of a connection
+
+    Outbound aliases are assigned on first use, up to the maximum announced
+    by the peer. Inbound aliases are defined by the peer, up to the maximum
+    announced to it.
+    """
+
+    def __init__(self, max_inbound=0, max_outbound=0):
+        """Initializes a TopicAliases instance
+
+        Args:
+            max_inbound (int, optional): Maximum number of aliases accepted
+                from the peer. Defaults to 0.
+            max_outbound (int, optional): Maximum number of aliases accepted
+                by the peer. Defaults to 0.
+        """
+
+        self.max_inbound = min(max_inbound, ALIAS_DEFINE)
+        self.max_outbound = min(max_outbound, ALIAS_DEFINE)
+        self.inbound = {}
+        self.outbound = {}
+
+    def assign(self, topic):
+        """Returns the alias to use when sending a topic
+
+        Args:
+            topic (str): The topic.
+
+        Returns:
+            tuple: (alias, new) where new is True if the alias has just been
+                assigned and must be defined, or None if no alias is
+                available.
+        """
+
+        if topic in self.outbound:
+            return (self.outbound[topic], False)
+
+        if len(self.outbound) >= self.max_outbound:
+            return None
+
+        alias = len(self.outbound)
+        self.outbound[topic] = alias
+        return (alias, True)
+
+    def release(self, topic):
+        """Forgets the last assigned outbound alias, if it is a topic's
+
+        Used when the message defining it could not be sent.
+
+        Args:
+            topic (str): The topic.
+        """
+
+        if self.outbound.get(topic) == len(self.outbound) - 1:
+            del self.outbound[topic]
+
+    def define(self, alias, topic):
+        """Defines an inbound alias
+
+        Args:
+            alias (int): The alias.
+            topic (str): The topic.
+
+        Raises:
+            InvalidTopicAlias: If the alias exceeds the announced maximum.
+        """
+
+        if alias >= self.max_inbound:
+            raise InvalidTopicAlias(f"Topic alias {alias} exceeds maximum {self.max_inbound}")
+
+        self.inbound[alias] = topic
+
+    def resolve(self, alias):
+        """Resolves an inbound alias
+
+        Args:
+            alias (int): The alias.
+
+        Returns:
+            str: The topic.
+
+        Raises:
+            InvalidTopicAlias: If the alias is not defined.
+        """
+
+        if not alias in self.inbound:
+            raise InvalidTopicAlias(f"Unknown topic alias {alias}")
+
+        return self.inbound[alias]
+
+class FrameReader:
+    """Incremental frame reader
+
+    Reassembles complete message frames from the chunks of bytes received
+    on a stream socket, regardless of how frames are split or merged by the
+    transport.
+    """
+
+    def __init__(self):
+        """Initializes a FrameReader instance"""
+
+        self.header = bytearray()
+        self.frame = None
+        self.pos = 0
+
+    def feed(self, data):
+        """Feeds received bytes to the reader
+
+        Args:
+            data (bytes): The received bytes.
+
+        Returns:
+            list[bytes]: The frames completed by these bytes.
+        """
+
+        frames = []
+        view = memoryview(data)
+
+        while True:
+            if self.frame is None:
+                count = min(HEADER_SIZE - len(self.header), len(view))
+                self.header += view[:count]
+                view = view[count:]
+
+                if len(self.header) < HEADER_SIZE:
+                    break
+
+                length = struct.unpack_from(">I", self.header, 3)[0]
+                self.frame = bytearray(HEADER_SIZE + length)
+                self.frame[:HEADER_SIZE] = self.header
+                self.pos = HEADER_SIZE
+                self.header = bytearray()
+
+            count = min(len(self.frame) - self.pos, len(view))
+            self.frame[self.pos:self.pos+count] = view[:count]
+            self.pos += count
+            view = view[count:]
+
+            if self.pos == len(self.frame):
+                frames.append(bytes(self.frame))
+                self.frame = None
+
+            if not view:
+                break
+
+        return frames
@@ -16,19 +16,35 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from collections import deque
 from enum import IntEnum, auto
+import copy
+import errno
+import hashlib
+import hmac
 import logging
+import os
 import re
 import selectors
 import socket
-import struct
+import ssl
+import stat
+import time
 import types
 
+from dragonfly import compression, handoff, loopback, shm
+from dragonfly.bytes import SendQueue
 from dragonfly.config import Config
+from dragonfly.exceptions import InvalidPayload
+from dragonfly.timers import TimerWheel
 from dragonfly.message import ORIGIN_SERVER, ORIGIN_CLIENT
 from dragonfly.message import CONNECT, PUBLISH, SUBSCRIBE, UNSUBSCRIBE
 from dragonfly.message import CONNECTED, PUBLISHED, SUBSCRIBED, UNSUBSCRIBED
-from dragonfly.message import Message, type_name
+from dragonfly.message import BATCH, BATCHED, CHUNK, CHUNK_ABORT, CHUNK_FIRST, CHUNK_LAST, PING, PONG, SESSION
+from dragonfly.message import FrameReader, MAX_BATCH, Message, RECV_SIZE, SEND_SIZE, TOPIC_ALIAS_MAX, TopicAliases, type_name
+
+#: Prefix of shared subscriptions, ``$share/<group>/<pattern>``
+SHARE_PREFIX = "$share/"
 
 class State(IntEnum):
     """Server state enum"""
@@ -42,308 +58,1978 @@ class State(IntEnum):
 class Server:
     """Dragonfly server"""
 
-    def __init__(self, host="localhost", port=1869, config=None):
+    #: Number of queued outbound bytes above which a client pauses the
+    #: publishers streaming to it
+    QUEUE_HIGH_WATER = 1 << 20
+
+    #: Number of queued outbound bytes below which paused publishers resume
+    QUEUE_LOW_WATER = 1 << 18
+
+    #: Maximum number of logical sessions per connection
+    MAX_SESSIONS = 1 << 16
+
+    #: Default lifetime of resume tokens, in seconds
+    RESUME_TTL = 3600
+
+    #: Default length of the listening sockets' queues of pending
+    #: connections (capped by the system, e.g. net.core.somaxconn on Linux)
+    BACKLOG = 4096
+
+    #: Maximum number of connections accepted per readiness event, so that
+    #: established connections are not starved during connection storms
+    ACCEPT_BATCH = 64
+
+    #: Default time allowed to a new connection to send CONNECT, in seconds
+    CONNECT_TIMEOUT = 10
+
+    #: Number of keepalive intervals without receiving anything after which
+    #: a connection is closed
+    KEEPALIVE_GRACE = 1.5
+
+    #: Delay before reopening a lost bridge link, in seconds
+    BRIDGE_RETRY = 1
+
+    #: Keepalive interval requested by bridge links, in seconds
+    BRIDGE_KEEPALIVE = 60
+
+    def __init__(self, host="localhost", port=1869, config=None, unix_path=None,
+                 shm_path=None, ssl_context=None, handoff_path=None,
+                 handoff_clients=True, bridges=None):
         """Initializes a Server instance
 
         Args:
             host (str, optional): Socket host. Defaults to "localhost".
             port (int, optional): Socket port. Defaults to 1869.
             config (str, optional): Path to config file. Defaults to None.
+            unix_path (str, optional): If set, the server also listens on a
+                Unix domain socket at this path, for local clients. Defaults
+                to None.
+            shm_path (str, optional): If set, the server accepts shared
+                memory connections (see :py:mod:`dragonfly.shm`) through a
+                Unix domain socket at this path. Defaults to None.
+            ssl_context (ssl.SSLContext, optional): If set, connections to
+                the TCP socket use TLS. Clients reconnecting to the same
+                server can resume their TLS session, as long as the context
+                is the same. Defaults to None.
+            handoff_path (str, optional): If set, the server takes its
+                sockets over from the server listening at this path, if
+                any, which then stops, and itself listens there for a
+                successor (see :py:mod:`dragonfly.handoff`). Defaults to
+                None.
+            handoff_clients (bool, optional): Whether to take the
+                connections over along with the listening sockets. TLS,
+                shared memory and in-process connections cannot be handed
+                over and are closed by the old server. Defaults to True.
+            bridges (list[tuple[str, int]], optional): Addresses of peer
+                servers to bridge with (see :py:meth:`open_link`). Bridged
+                servers must all list each other. Defaults to None.
         """
 
         self.config_path = config
         self.config = Config(self.config_path)
 
+        # Without a configured key, tokens are only valid for this process
+        key = self.config.resume_key
+        self.resume_key = os.urandom(32) if key is None else str(key).encode("utf-8")
+
         self.host = host
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.ssl_context = ssl_context
+        self.unix_path = unix_path
+        self.unix_socket = None
+        if unix_path is not None:
+            self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        self.shm_path = shm_path
+        self.shm_socket = None
+        if shm_path is not None:
+            self.shm_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        #: Timers of the shared memory handshakes in progress, by control
+        #: socket
+        self.shm_handshakes = {}
+
+        self.loopback = loopback.Hub()
+
+        self.handoff_path = handoff_path
+        self.handoff_clients = handoff_clients
+        self.handoff_socket = None
+        self.handed_off = False
+
+        #: Timers of the successors' requests being read, by control socket
+        self.handoff_requests = {}
+
+        #: Identifies this server to its peers, so that it never bridges
+        #: with itself
+        self.node_id = str(self.config.node_id or os.urandom(8).hex())
+        self.bridges = bridges or []
+
+        #: Number of local subscribers by subscribed topic, bridge links
+        #: excluded
+        self.interest = {}
+
         self.selector = selectors.DefaultSelector()
+        self.timers = TimerWheel()
+
+        # Token bucket limiting the accept rate, initially full
+        self.accept_tokens = self.config.accept_rate or 0
+        self.accept_time = time.monotonic()
         self.clients = []
+        self.connections = 0
         self.topics = {}
+
+        #: Shared subscription groups, by (group, pattern)
+        self.groups = {}
+        self.next_stream_id = 0
         self.state = State.STOPPED
         self.logger = logging.getLogger("dragonfly")
 
-    def start(self):
-        """Starts this server"""
+    def start(self):
+        """Starts this server
+
+        Raises:
+            OSError: If the sockets cannot be bound, or were received from
+                the previous server but the handoff could not be confirmed.
+        """
+
+        self.state = State.STARTING
+        inherited = self.take_over() if self.handoff_path is not None else {}
+        took_over = bool(inherited)
+
+        self.socket = self.listen(self.socket, (self.host, self.port), inherited.pop("tcp", None))
+
+        if self.unix_socket is not None:
+            self.unix_socket = self.listen(self.unix_socket, self.unix_path, inherited.pop("unix", None))
+
+        if self.shm_socket is not None:
+            self.shm_socket = self.listen(self.shm_socket, self.shm_path, inherited.pop("shm", None))
+
+        # Served by the previous server only
+        for sock in inherited.values():
+            sock.close()
+
+        if self.handoff_path is not None:
+            # The previous server still listens until it stops: its socket
+            # file is replaced
+            if took_over and os.path.exists(self.handoff_path):
+                os.unlink(self.handoff_path)
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.handoff_socket = self.listen(sock, self.handoff_path)
+
+        self.selector.register(self.loopback, selectors.EVENT_READ, data=None)
+        self.state = State.RUNNING
+
+        for address in self.bridges:
+            self.open_link(address)
+
+        self.mainloop()
+
+    def listen(self, sock, address, inherited=None):
+        """Binds a listening socket, or replaces it by an inherited one
+
+        Args:
+            sock (socket.socket): The unbound socket.
+            address (tuple|str): The address to bind it to.
+            inherited (socket.socket, optional): The listening socket handed
+                over by the previous server, used instead. Defaults to None.
+
+        Returns:
+            socket.socket: The listening socket.
+        """
+
+        if inherited is not None:
+            sock.close()
+            sock = inherited
+
+        else:
+            # Left over by a server that did not stop cleanly: nothing
+            # accepts connections on it anymore
+            if isinstance(address, str) and os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    try:
+                        probe.connect(address)
+
+                    except ConnectionRefusedError:
+                        os.unlink(address)
+
+                    except OSError:
+                        pass
+
+            sock.bind(address)
+            sock.listen(self.backlog())
+
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, data=None)
+        self.logger.info("Dragonfly server listening on %r", sock.getsockname())
+
+        return sock
+
+    def stop(self):
+        """Closes this server's sockets"""
+
+        self.state = State.STOPPING
+        self.close_listeners()
+        self.loopback.close()
+        self.state = State.STOPPED
+
+    def close_listeners(self):
+        """Closes the listening sockets
+
+        Unix domain socket files are removed, unless the sockets were handed
+        over to a successor.
+        """
+
+        for sock, path in [(self.socket, None), (self.unix_socket, self.unix_path),
+                           (self.shm_socket, self.shm_path), (self.handoff_socket, self.handoff_path)]:
+            if sock is not None:
+                sock.close()
+                if path is not None and not self.handed_off and os.path.exists(path):
+                    os.unlink(path)
+
+    def take_over(self):
+        """Takes the sockets over from the server listening at the handoff
+        path
+
+        The connections handed over are restored with their state (see
+        :py:meth:`restore`).
+
+        Raises:
+            OSError: If the handoff could not be confirmed, in which case the
+                previous server keeps running.
+
+        Returns:
+            dict[str, socket.socket]: The listening sockets handed over, by
+                kind ("tcp", "unix" or "shm"), empty if there is no server
+                to take over from.
+        """
+
+        try:
+            control, state, fds = handoff.request(self.handoff_path, self.handoff_clients)
+
+        except OSError as e:
+            self.logger.info("No server to take over at '%s': %s", self.handoff_path, e)
+            return {}
+
+        socks = [socket.socket(fileno=fd) for fd in fds]
+
+        try:
+            handoff.confirm(control)
+
+        except OSError:
+            for sock in socks:
+                sock.close()
+
+            raise
+
+        self.restore(state, socks)
+        self.logger.info("Took %d connection(s) over from '%s'", len(state["clients"]), self.handoff_path)
+
+        return {kind: socks[i] for kind, i in state["listeners"].items()}
+
+    def accept_handoff(self):
+        """Accepts a successor's control connection
+
+        Its request is read once the socket is readable (see
+        :py:meth:`hand_off`), so that a silent successor does not stall the
+        event loop.
+        """
+
+        try:
+            control, _ = self.handoff_socket.accept()
+
+        except (BlockingIOError, InterruptedError):
+            return
+
+        control.setblocking(False)
+        timer = self.timers.schedule(handoff.TIMEOUT, self.drop_handoff_request, control, True)
+        self.handoff_requests[control] = timer
+        self.selector.register(control, selectors.EVENT_READ, data=types.SimpleNamespace(addr=self.handoff_path))
+
+    def drop_handoff_request(self, control, expired=False):
+        """Forgets a successor's request and closes its control socket
+
+        Args:
+            control (socket.socket): The control socket.
+            expired (bool, optional): Whether the request timed out.
+                Defaults to False.
+        """
+
+        timer = self.handoff_requests.pop(control)
+        if expired:
+            self.logger.warning("Handoff request timed out")
+
+        else:
+            self.timers.cancel(timer)
+
+        self.selector.unregister(control)
+        control.close()
+
+    def hand_off(self, control):
+        """Hands the sockets over to a successor, then stops
+
+        Called once the successor's control socket is readable. Connections
+        which cannot be handed over, or all of them if the successor does not
+        take them over, are closed once the successor confirmed the handoff:
+        their clients reconnect to it. If the handoff fails, this server
+        keeps running.
+
+        Args:
+            control (socket.socket): The successor's control socket.
+        """
+
+        try:
+            clients = handoff.read_request(control)
+
+        except (BlockingIOError, InterruptedError):
+            return
+
+        except OSError as e:
+            self.logger.error("Handoff failed: %s", e)
+            self.drop_handoff_request(control)
+            return
+
+        timer = self.handoff_requests.pop(control)
+        self.timers.cancel(timer)
+        self.selector.unregister(control)
+
+        with control:
+            try:
+                control.settimeout(handoff.TIMEOUT)
+                conns = []
+                if clients:
+                    conns = [client for client in self.clients if client is not None
+                             and client.conn is client and self.transferable(client)]
+
+                state, fds = self.save(conns)
+                handoff.send_state(control, state, fds)
+                handoff.wait_confirmation(control)
+
+            except OSError as e:
+                self.logger.error("Handoff failed: %s", e)
+                return
+
+        self.logger.info("Handed %d connection(s) over to a successor", len(conns))
+
+        # The successor owns the connections now: nothing may be sent to them
+        for client in conns:
+            client.unregister()
+            client.socket.close()
+
+            for session in client.sessions.values():
+                self.clients[session.id] = None
+
+            self.clients[client.id] = None
+
+        for client in self.clients:
+            if client is not None and client.conn is client:
+                self.close_conn(client.id)
+
+        self.handed_off = True
+        self.stop()
+
+    def transferable(self, client):
+        """Returns whether a connection can be handed over to a successor
+
+        Only plain TCP and Unix domain socket connections can: the state of
+        TLS, shared memory and in-process connections lives in this process.
+        Bridge links are reopened by the successor.
+
+        Args:
+            client (Client): The connection.
+
+        Returns:
+            bool: True if the connection can be handed over.
+        """
+
+        return type(client.socket) is socket.socket and not client.handshaking and client.link is None
+
+    def save(self, conns):
+        """Serializes the state handed over to a successor
+
+        Args:
+            conns (list[Client]): The connections handed over.
+
+        Returns:
+            tuple[dict, list[int]]: The JSON serializable state and the
+                descriptors it refers to.
+        """
+
+        state = {"listeners": {}, "clients": [], "next_stream_id": self.next_stream_id}
+        fds = []
+
+        for kind, sock in [("tcp", self.socket), ("unix", self.unix_socket), ("shm", self.shm_socket)]:
+            if sock is not None:
+                state["listeners"][kind] = len(fds)
+                fds.append(sock.fileno())
+
+        # Stream subscribers are referred to by (connection, session id)
+        index = {client.id: i for i, client in enumerate(conns)}
+
+        def ref(client):
+            if not client.conn.id in index or self.clients[client.id] is not client:
+                return None
+
+            return [index[client.conn.id], None if client.conn is client else client.session_id]
+
+        for client in conns:
+            reader = client.data.reader
+            entry = self.save_client(client, ref)
+            entry.update({
+                "fd": len(fds),
+                "addr": client.data.addr,
+                "reader": [handoff.encode_bytes(reader.header),
+                           None if reader.frame is None else handoff.encode_bytes(reader.frame),
+                           reader.pos],
+                "queue": handoff.encode_bytes(b"".join(client.queue.buffers)),
+                "sessions": [self.save_client(session, ref) for session in client.sessions.values()]
+            })
+
+            state["clients"].append(entry)
+            fds.append(client.socket.fileno())
+
+        return state, fds
+
+    def save_client(self, client, ref):
+        """Serializes the state of a connection or a logical session
+
+        Args:
+            client (Client): The connection or session.
+            ref (callable): Function returning the reference of a client in
+                the state, or None if it is not handed over.
+
+        Returns:
+            dict: The JSON serializable state.
+        """
+
+        streams = []
+        for stream_id, stream in client.streams.items():
+            subscribers = [r for r in map(ref, stream.subscribers) if r is not None]
+            streams.append([stream_id, stream.id, stream.code, subscribers])
+
+        return {
+            "session_id": getattr(client, "session_id", None),
+            "username": client.username,
+            "password": client.password,
+            "connected": client.connected,
+            "resumed": client.user is not None,
+            "topics": client.topics,
+            "version": client.version,
+            "codec": client.codec,
+            "threshold": client.threshold,
+            "aliases": [client.aliases.max_inbound, client.aliases.max_outbound,
+                        list(client.aliases.inbound.items()), list(client.aliases.outbound.items())],
+            "idle_timeout": client.idle_timeout,
+            "bridge": client.bridge,
+            "streams": streams
+        }
+
+    def restore(self, state, socks):
+        """Restores the connections handed over by the previous server
+
+        Args:
+            state (dict): The state, as returned by :py:meth:`save`.
+            socks (list[socket.socket]): The sockets it refers to.
+        """
+
+        conns = []
+        for entry in state["clients"]:
+            header, frame, pos = entry["reader"]
+            reader = FrameReader()
+            reader.header = bytearray(handoff.decode_bytes(header))
+            reader.frame = None if frame is None else bytearray(handoff.decode_bytes(frame))
+            reader.pos = pos
+
+            addr = entry["addr"]
+            addr = tuple(addr) if isinstance(addr, list) else addr
+
+            client = self.new_client(socks[entry["fd"]])
+            self.connections += 1
+            self.restore_client(client, entry)
+            for session_entry in entry["sessions"]:
+                self.restore_client(self.new_session(client, session_entry["session_id"]), session_entry)
+
+            client.queue.append(handoff.decode_bytes(entry["queue"]))
+            client.register(self.selector, types.SimpleNamespace(addr=addr, reader=reader, id=client.id))
+            self.watch(client, entry["idle_timeout"])
+            conns.append(client)
+
+        def resolve(ref):
+            conn = conns[ref[0]]
+            return conn if ref[1] is None else conn.sessions[ref[1]]
+
+        # Once all clients exist, as streams refer to them
+        for i, entry in enumerate(state["clients"]):
+            for session_entry in [entry] + entry["sessions"]:
+                client = resolve([i, session_entry["session_id"]])
+                for stream_id, relay_id, code, subscribers in session_entry["streams"]:
+                    client.streams[stream_id] = types.SimpleNamespace(
+                        id=relay_id, subscribers=list(map(resolve, subscribers)), code=code)
+
+        self.next_stream_id = state["next_stream_id"]
+
+    def restore_client(self, client, entry):
+        """Restores the state of a connection or a logical session
+
+        Args:
+            client (Client): The new connection or session.
+            entry (dict): Its state, as returned by :py:meth:`save_client`.
+        """
+
+        client.username = entry["username"]
+        client.password = entry["password"]
+        client.connected = entry["connected"]
+        if entry["resumed"]:
+            client.user = self.config.find_user(client.username)
+
+        client.version = entry.get("version", Message.VERSION)
+        client.codec = entry["codec"]
+        client.threshold = entry["threshold"]
+        client.bridge = entry["bridge"]
+
+        max_inbound, max_outbound, inbound, outbound = entry["aliases"]
+        client.aliases = TopicAliases(max_inbound, max_outbound)
+        client.aliases.inbound = dict(inbound)
+        client.aliases.outbound = dict(outbound)
+
+        for topic in entry["topics"]:
+            self.add_subscriber(client, topic)
+
+    def mainloop(self):
+        """Main event loop"""
+
+        while self.state == State.RUNNING:
+            events = self.selector.select(timeout=self.timers.timeout())
+
+            for key, mask in events:
+                # Stopped while handling a previous event
+                if self.state != State.RUNNING:
+                    break
+
+                # In-process connections
+                if key.fileobj is self.loopback:
+                    self.handle_loopback()
+
+                # Successor connecting
+                elif key.fileobj is self.handoff_socket:
+                    self.accept_handoff()
+
+                # Successor asking for the sockets
+                elif key.fileobj in self.handoff_requests:
+                    self.hand_off(key.fileobj)
+
+                # Shared memory connection's handshake
+                elif key.fileobj in self.shm_handshakes:
+                    self.shm_handshake(key.fileobj)
+
+                # Listening socket
+                elif key.data is None:
+                    self.new_conn(key.fileobj)
+
+                # Data
+                else:
+                    self.handle_msg(key, mask)
+
+            self.timers.advance()
+
+    def backlog(self):
+        """Returns the length of the queues of pending connections
+
+        Set by the ``backlog`` config option.
+
+        Returns:
+            int: The backlog.
+        """
+
+        backlog = self.config.backlog
+        return self.BACKLOG if backlog is None else backlog
+
+    def max_body(self):
+        """Returns the maximum size of a decompressed PUBLISH body
+
+        Set by the ``max_body`` config option. Compressed bodies expanding
+        beyond it are dropped.
+
+        Returns:
+            int: The size, in bytes.
+        """
+
+        max_body = self.config.max_body
+        return compression.MAX_SIZE if max_body is None else max_body
+
+    def new_conn(self, sock):
+        """Accepts pending connections on a listening socket
+
+        Up to :py:attr:`ACCEPT_BATCH` connections are accepted per call, the
+        others on the next iteration of the event loop.
+
+        Args:
+            sock (socket.socket): The listening socket.
+        """
+
+        for _ in range(self.ACCEPT_BATCH):
+            try:
+                conn, addr = sock.accept()
+
+            except (BlockingIOError, InterruptedError):
+                return
+
+            except OSError as e:
+                # e.g. out of file descriptors: pending connections are
+                # accepted once some are closed
+                self.logger.error("Cannot accept connection: %s", e)
+                return
+
+            if self.admit(sock, conn):
+                self.open_conn(sock, conn, addr)
+
+    def admit(self, sock, conn):
+        """Applies admission control to an accepted connection
+
+        Connections over the ``max_connections`` config option, or the
+        ``accept_rate`` one (new connections per second, with bursts of up to
+        one second's worth), are rejected before any state is allocated for
+        them: plain and in-process connections receive a CONNECTED message
+        with code 0x83, TLS and shared memory ones are closed right away.
+        Shared memory handshakes in progress count as connections.
+
+        Args:
+            sock (socket.socket|dragonfly.loopback.Hub): The listening socket,
+                or the hub of in-process connections.
+            conn (socket.socket|dragonfly.loopback.LoopbackSocket): The
+                accepted connection.
+
+        Returns:
+            bool: True if the connection is admitted, False if it was
+                rejected.
+        """
+
+        max_connections = self.config.max_connections
+        if max_connections and self.connections + len(self.shm_handshakes) >= max_connections:
+            reason = "connection limit reached"
+
+        elif not self.take_accept_token():
+            reason = "accept rate exceeded"
+
+        else:
+            return True
+
+        self.logger.debug("Rejecting connection: %s", reason)
+
+        if sock in [self.unix_socket, self.loopback] or (sock is self.socket and self.ssl_context is None):
+            try:
+                conn.setblocking(False)
+                conn.send(Message(ORIGIN_SERVER, CONNECTED, code=0x83).to_bytes())
+
+                # In-process connections deliver pending data once closed
+                if sock is not self.loopback:
+                    conn.shutdown(socket.SHUT_WR)
+
+            except OSError:
+                pass
+
+        conn.close()
+
+        return False
+
+    def take_accept_token(self):
+        """Consumes a token of the accept rate limiter
+
+        Returns:
+            bool: True if a connection may be accepted, False otherwise.
+        """
+
+        rate = self.config.accept_rate
+        if not rate:
+            return True
+
+        now = time.monotonic()
+        self.accept_tokens = min(rate, self.accept_tokens + (now - self.accept_time) * rate)
+        self.accept_time = now
+
+        if self.accept_tokens < 1:
+            return False
+
+        self.accept_tokens -= 1
+
+        return True
+
+    def open_conn(self, sock, conn, addr):
+        """Sets up an admitted connection
+
+        Args:
+            sock (socket.socket): The listening socket.
+            conn (socket.socket): The accepted connection.
+            addr: The peer's address.
+        """
+
+        if sock is self.shm_socket:
+            # Completed once the client's descriptors are received, within
+            # the time allowed to send CONNECT
+            conn.setblocking(False)
+            timeout = self.connect_timeout()
+            timer = self.timers.schedule(timeout, self.drop_shm_handshake, conn, True) if timeout else None
+            self.shm_handshakes[conn] = timer
+            self.selector.register(conn, selectors.EVENT_READ, data=types.SimpleNamespace(addr=addr))
+            return
+
+        if sock is self.unix_socket:
+            addr = self.unix_path
+
+        else:
+            # Writes are already coalesced by the outbound queues
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            if self.ssl_context is not None:
+                # The handshake is driven by the event loop (see handshake)
+                conn = self.ssl_context.wrap_socket(conn, server_side=True,
+                                                    do_handshake_on_connect=False)
+
+        self.add_conn(conn, addr)
+
+    def add_conn(self, conn, addr):
+        """Creates the client of a connection and starts watching it
+
+        Args:
+            conn (socket.socket|ShmSocket): The connection.
+            addr: The peer's address.
+        """
+
+        client = self.new_client(conn)
+        self.connections += 1
+        self.logger.debug("Accepted connection from %s", (addr, ))
+        conn.setblocking(False)
+        if isinstance(conn, ssl.SSLSocket):
+            client.handshaking = selectors.EVENT_READ
+
+        data = types.SimpleNamespace(addr=addr, reader=FrameReader(), id=client.id)
+        client.register(self.selector, data)
+        self.watch(client, self.connect_timeout())
+
+    def shm_handshake(self, control):
+        """Completes a shared memory handshake once its control socket is
+        readable
+
+        Args:
+            control (socket.socket): The control socket.
+        """
+
+        try:
+            conn = shm.finish_accept(control)
+
+        except (BlockingIOError, InterruptedError):
+            return
+
+        except OSError as e:
+            self.logger.warning("Shared memory handshake failed: %s", e)
+            conn = None
+
+        self.drop_shm_handshake(control)
+
+        if conn is not None:
+            self.add_conn(conn, f"shm:{self.shm_path}")
+
+    def drop_shm_handshake(self, control, expired=False):
+        """Forgets a shared memory handshake and closes its control socket
+
+        Args:
+            control (socket.socket): The control socket.
+            expired (bool, optional): Whether the handshake timed out.
+                Defaults to False.
+        """
+
+        timer = self.shm_handshakes.pop(control)
+        if expired:
+            self.logger.info("Shared memory handshake timed out")
+
+        elif timer is not None:
+            self.timers.cancel(timer)
+
+        self.selector.unregister(control)
+        control.close()
+
+    def attach(self, doorbell=None):
+        """Opens an in-process connection to this server
+
+        Can be called from any thread, usually through
+        :py:meth:`dragonfly.client.Client.connect`.
+
+        Args:
+            doorbell (dragonfly.loopback.Doorbell, optional): Wakeup of the
+                client side. Defaults to None (a new one is created).
+
+        Raises:
+            ConnectionRefusedError: If the server is stopped.
+
+        Returns:
+            dragonfly.loopback.LoopbackSocket: The client side of the
+                connection.
+        """
+
+        return self.loopback.connect(doorbell)
+
+    def handle_loopback(self):
+        """Accepts and handles events of in-process connections"""
+
+        for conn in self.loopback.accept():
+            if not self.admit(self.loopback, conn):
+                continue
+
+            client = self.new_client(conn)
+            self.connections += 1
+            self.logger.debug("Accepted in-process connection")
+            data = types.SimpleNamespace(addr="loopback", reader=FrameReader(), id=client.id)
+            client.register(self.loopback, data)
+            self.watch(client, self.connect_timeout())
+
+        for key, mask in self.loopback.select():
+            self.handle_msg(key, mask)
+
+    def close_conn(self, id_):
+        """Closes a previously established connection
+
+        Args:
+            id_ (int): The client's id.
+        """
+
+        client = self.clients[id_]
+
+        # Logical session: the connection stays open
+        if client.conn is not client:
+            self.logger.debug("Closing session %d on %s", client.session_id, client.conn)
+            del client.conn.sessions[client.session_id]
+            self.remove_client(id_)
+            return
+
+        for session in list(client.sessions.values()):
+            self.close_conn(session.id)
+
+        self.logger.debug("Closing connection %s", client.data.addr)
+        client.flush()
+        client.unregister()
+        client.socket.close()
+        self.remove_client(id_)
+        self.connections -= 1
+
+        if client.link is not None and self.state == State.RUNNING:
+            self.timers.schedule(self.BRIDGE_RETRY, self.open_link, client.link)
+
+    def handle_msg(self, key, mask):
+        """Handles an event
+
+        Args:
+            key (selectors.SelectorKey): The event's key.
+            mask (selectors._EventMask): The event's mask.
+        """
+
+        sock = key.fileobj
+        data = key.data
+
+        if self.clients[data.id].handshaking:
+            if not self.handshake(self.clients[data.id]):
+                return
+
+            # Records may have arrived along with the end of the handshake
+            mask = selectors.EVENT_READ
+
+        # Ready to read
+        if mask & selectors.EVENT_READ:
+            try:
+                recv_data = sock.recv(RECV_SIZE)
+
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                recv_data = None
+
+            except (ConnectionError, ssl.SSLError):
+                recv_data = b""
+
+            if recv_data:
+                client = self.clients[data.id]
+                client.last_seen = time.monotonic()
+
+                for frame in data.reader.feed(recv_data):
+                    msg = Message()
+                    if msg.from_bytes(frame, client.aliases):
+                        self.logger.debug("Received %s from %s", msg, data.addr)
+                        self.process_msg(msg, client)
+
+                    # Connection closed while processing
+                    if self.clients[data.id] is not client:
+                        return
+
+            elif recv_data is not None:
+                self.close_conn(data.id)
+                return
+
+        # Ready to write (shared memory connections signal room as a read)
+        writable = mask & selectors.EVENT_WRITE
+        if not writable and getattr(sock, "wakes_on_space", False):
+            writable = self.clients[data.id].queue
+
+        if writable:
+            client = self.clients[data.id]
+            client.flush()
+
+            if client.queued <= self.QUEUE_LOW_WATER:
+                for waiter in client.waiters:
+                    self.resume(waiter)
+
+                client.waiters = []
+
+    def handshake(self, client):
+        """Advances a client's TLS handshake without blocking
+
+        Args:
+            client (Client): The client.
+
+        Returns:
+            bool: True once the handshake is complete, False if it is still
+                in progress or failed (the connection is then closed).
+        """
+
+        try:
+            client.socket.do_handshake()
+
+        except ssl.SSLWantReadError:
+            client.handshaking = selectors.EVENT_READ
+
+        except ssl.SSLWantWriteError:
+            client.handshaking = selectors.EVENT_WRITE
+
+        except OSError as e:
+            self.logger.warning("TLS handshake with %s failed: %s", client.data.addr, e)
+            self.close_conn(client.id)
+            return False
+
+        else:
+            client.handshaking = 0
+            self.logger.debug("TLS handshake with %s done (resumed: %s)",
+                              client.data.addr, client.socket.session_reused)
+
+        client.update_events()
+
+        return not client.handshaking
+
+    def connect_timeout(self):
+        """Returns the time allowed to a new connection to send CONNECT
+
+        Set by the ``connect_timeout`` config option, 0 to disable it.
+
+        Returns:
+            float: The timeout, in seconds.
+        """
+
+        timeout = self.config.connect_timeout
+        return self.CONNECT_TIMEOUT if timeout is None else timeout
+
+    def watch(self, client, timeout):
+        """Closes a connection if nothing is received from it for a while
+
+        Replaces the connection's previous deadline. Incoming data only
+        updates :py:attr:`Client.last_seen`: the deadline is checked, and
+        pushed back if needed, when its timer expires.
+
+        Args:
+            client (Client): The connection.
+            timeout (float): The idle timeout, in seconds, 0 to disable it.
+        """
+
+        if client.timer is not None:
+            self.timers.cancel(client.timer)
+            client.timer = None
+
+        client.idle_timeout = timeout
+        if timeout:
+            client.timer = self.timers.schedule(timeout, self.check_idle, client)
+
+    def check_idle(self, client):
+        """Closes a connection whose idle deadline has passed
+
+        Args:
+            client (Client): The connection.
+        """
+
+        client.timer = None
+        if self.clients[client.id] is not client or not client.idle_timeout:
+            return
+
+        idle = time.monotonic() - client.last_seen
+        if idle >= client.idle_timeout:
+            self.logger.info("Closing connection %s, idle for %.1fs", client.data.addr, idle)
+            self.close_conn(client.id)
+
+        else:
+            client.timer = self.timers.schedule(client.idle_timeout - idle, self.check_idle, client)
+
+    def pause(self, client, blocker):
+        """Stops reading from a client until another one's queue drains
+
+        Logical sessions pause their whole connection.
+
+        Args:
+            client (Client): The client to pause.
+            blocker (Client): The client whose outbound queue is full.
+        """
+
+        client, blocker = client.conn, blocker.conn
+
+        if not client in blocker.waiters:
+            blocker.waiters.append(client)
+
+        if not client.paused:
+            self.logger.debug("Pausing %s until %s drains", client, blocker)
+            client.paused = True
+            client.update_events()
+
+    def resume(self, client):
+        """Resumes reading from a paused client
+
+        Args:
+            client (Client): The paused client.
+        """
+
+        if self.clients[client.id] is client and client.paused:
+            client.paused = False
+            client.update_events()
+
+    def new_client(self, sock):
+        """Registers new client
+
+        Args:
+            sock (socket.socket): The client socket.
+
+        Returns:
+            Client: The new client instance.
+        """
+
+        if not None in self.clients:
+            self.clients.append(None)
+
+        id_ = self.clients.index(None)
+        client = Client(sock, id_)
+        self.clients[id_] = client
+
+        return client
+
+    def new_session(self, conn, session_id):
+        """Registers a new logical session on a connection
+
+        Args:
+            conn (Client): The connection carrying the session.
+            session_id (int): The session's id on this connection.
+
+        Returns:
+            Session: The new session instance.
+        """
+
+        if not None in self.clients:
+            self.clients.append(None)
+
+        id_ = self.clients.index(None)
+        session = Session(conn, session_id, id_)
+        self.clients[id_] = session
+        conn.sessions[session_id] = session
+
+        return session
+
+    def remove_client(self, id_):
+        """Unregisters a client
+
+        Args:
+            id_ (int): The client's id.
+        """
+
+        client = self.clients[id_]
+        for topic in list(client.topics):
+            self.remove_subscriber(client, topic)
+
+        self.clients[id_] = None
+
+        if client.timer is not None:
+            self.timers.cancel(client.timer)
+            client.timer = None
+
+        for stream in client.streams.values():
+            self.abort_stream(stream)
+
+        for waiter in client.waiters:
+            self.resume(waiter)
+
+    def process_msg(self, msg, sender):
+        """Processes a message
+
+        Args:
+            msg (Message): The message instance.
+            sender (Client): The sender client.
+        """
+
+        type_ = msg.type
+        if type_.origin == ORIGIN_CLIENT:
+            if type_.type == CONNECT:
+                if type_.flags & 4:
+                    sender.send(Message(ORIGIN_SERVER, CONNECTED, 4, code=0x00))
+                    self.close_conn(sender.id)
+
+                elif sender.connected:
+                    # The identity is only checked once per connection
+                    self.logger.warning("%s sent a second CONNECT", sender)
+                    sender.send(Message(ORIGIN_SERVER, CONNECTED, code=0x82))
+
+                else:
+                    # Frames sent to the client use its protocol version
+                    sender.version = min(msg.version, Message.VERSION)
+                    sender.username = msg.username
+                    sender.password = msg.password
+                    sender.user = None
+
+                    token = msg.properties.get("resume_token")
+                    if token is not None and self.check_token(sender.username, token):
+                        sender.user = self.config.find_user(sender.username)
+
+                    ack = Message(ORIGIN_SERVER, CONNECTED)
+                    ack.code = 0x00
+
+                    bridge = msg.properties.get("bridge")
+
+                    if not self.check_auth(sender, CONNECT):
+                        ack.code = 0x81
+
+                    elif bridge == self.node_id:
+                        self.logger.warning("Refusing bridge link to self from %s", sender)
+                        ack.code = 0x83
+
+                    else:
+                        sender.connected = True
+                        sender.bridge = bridge
+                        self.negotiate(msg, sender, ack)
+
+                        token = self.issue_token(sender.username)
+                        if token is not None:
+                            ack.properties["resume_token"] = token
+
+                    sender.send(ack)
+
+                    # A refused connection or session is not kept waiting
+                    # for the connect timeout
+                    if ack.code:
+                        self.close_conn(sender.id)
+
+            elif type_.type == PUBLISH:
+                self.publish(msg, sender)
+
+            elif type_.type == SUBSCRIBE:
+                self.subscribe(msg, sender)
+
+            elif type_.type == UNSUBSCRIBE:
+                self.unsubscribe(msg, sender)
+
+            elif type_.type == BATCH:
+                self.batch(msg, sender)
+
+            elif type_.type == CHUNK:
+                self.chunk(msg, sender)
+
+            elif type_.type == SESSION:
+                self.session(msg, sender)
+
+            elif type_.type == PING:
+                sender.send(Message(ORIGIN_SERVER, PONG))
+
+        elif sender.link is not None:
+            self.process_link_msg(msg, sender)
+
+    def session(self, msg, conn):
+        """Processes a SESSION message
+
+        The inner message is decoded with the session's topic aliases and
+        processed as if sent by the session. A session is opened by a CONNECT
+        inner message and closed by a disconnect or with its connection.
+
+        Args:
+            msg (Message): The SESSION message.
+            conn (Client): The connection carrying the session.
+        """
+
+        if conn.conn is not conn:
+            self.logger.warning("%s sent a nested session message", conn)
+            return
+
+        session = conn.sessions.get(msg.session_id)
+        inner = Message()
+
+        if session is None:
+            if not inner.from_bytes(msg.frame) or inner.type.type != CONNECT:
+                self.logger.warning("%s sent a message for unknown session %d", conn, msg.session_id)
+                return
+
+            if len(conn.sessions) >= self.MAX_SESSIONS:
+                ack = Message(ORIGIN_SERVER, CONNECTED, code=0x83, version=min(inner.version, Message.VERSION))
+                frame = Message(ORIGIN_SERVER, SESSION, session_id=msg.session_id, frame=ack.to_bytes())
+                conn.send(frame)
+                return
+
+            session = self.new_session(conn, msg.session_id)
+
+        elif not inner.from_bytes(msg.frame, session.aliases):
+            return
+
+        self.logger.debug("Received %s from %s", inner, session)
+        self.process_msg(inner, session)
+
+    def negotiate(self, msg, client, ack):
+        """Negotiates the connection options requested in a CONNECT message
+
+        Supported properties:
+            * compression: '|' separated codecs offered by the client, by
+              preference. The server picks the first one allowed by the
+              ``compression`` config option (all available codecs by default,
+              none if false).
+            * compression_threshold: minimum size of a body to be compressed.
+            * topic_alias_max: maximum number of topic aliases accepted by the
+              client. The server announces its own maximum, set by the
+              ``topic_alias_max`` config option, in the acknowledgement.
+            * keepalive: interval, in seconds, at which the client pings the
+              server when the connection is idle. It is capped by the
+              ``keepalive`` config option, which also applies to clients not
+              requesting any. The accepted interval is returned in the
+              acknowledgement, and the connection is closed after
+              :py:attr:`KEEPALIVE_GRACE` intervals without receiving
+              anything. Logical sessions share their connection's.
+
+        Args:
+            msg (Message): The CONNECT message.
+            client (Client): The sender client.
+            ack (Message): The CONNECTED acknowledgement, to which accepted
+                options are added.
+        """
+
+        offered = msg.properties.get("compression")
+        accepted = self.config.compression
+        if isinstance(accepted, str):
+            accepted = [accepted]
+
+        if offered and accepted is not False:
+            client.codec = compression.negotiate(offered.split("|"), accepted)
+
+            if client.codec:
+                client.threshold = msg.get_int_property("compression_threshold", compression.DEFAULT_THRESHOLD)
+                ack.properties["compression"] = client.codec
+
+        max_inbound = self.config.topic_alias_max
+        if max_inbound is None:
+            max_inbound = TOPIC_ALIAS_MAX
+
+        client.aliases = TopicAliases(max_inbound, msg.get_int_property("topic_alias_max"))
+        if max_inbound:
+            ack.properties["topic_alias_max"] = max_inbound
+
+        if client.conn is client:
+            keepalive = msg.get_int_property("keepalive")
+            max_keepalive = self.config.keepalive
+            if max_keepalive is not None and (not keepalive or keepalive > max_keepalive):
+                keepalive = max_keepalive
+
+            if keepalive:
+                ack.properties["keepalive"] = keepalive
+
+            self.watch(client, keepalive * self.KEEPALIVE_GRACE)
+
+    def open_link(self, address):
+        """Opens a bridge link to a peer server
+
+        The link is a connection to the peer, identified by this server's
+        :py:attr:`node_id` and authenticated with the ``bridge_username`` and
+        ``bridge_password`` config options. Through it, this server
+        subscribes to the topics its own clients subscribed to, so that the
+        peer only forwards matching messages, which are delivered to local
+        clients. Subscriptions of the peer's links do not count, and
+        forwarded messages are not relayed to other peers: each message
+        crosses at most one link, so that bridged servers can form a full
+        mesh without loops.
+
+        A lost link is reopened after :py:attr:`BRIDGE_RETRY` seconds.
+
+        Args:
+            address (tuple[str, int]): The peer's address.
+        """
+
+        if self.state != State.RUNNING:
+            return
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.logger.info("Cannot open bridge link to %s: %s", address, os.strerror(err))
+            self.timers.schedule(self.BRIDGE_RETRY, self.open_link, address)
+            return
+
+        link = self.new_client(sock)
+        link.link = address
+        self.connections += 1
+        data = types.SimpleNamespace(addr=address, reader=FrameReader(), id=link.id)
+        link.register(self.selector, data)
+        self.watch(link, self.connect_timeout())
+
+        # Queued until the connection is established
+        msg = Message(ORIGIN_CLIENT, CONNECT)
+        msg.username = self.config.bridge_username
+        msg.password = self.config.bridge_password
+        msg.properties["bridge"] = self.node_id
+        msg.properties["keepalive"] = self.BRIDGE_KEEPALIVE
+        link.send(msg)
+
+    def process_link_msg(self, msg, link):
+        """Processes a message received from a peer through a bridge link
+
+        Args:
+            msg (Message): The message instance.
+            link (Client): The link.
+        """
+
+        type_ = msg.type
+        if type_.type == CONNECTED:
+            if msg.code & 0x80 or type_.flags & 4:
+                self.logger.warning("Bridge link to %s refused (%#x)", link.link, msg.code)
+                self.close_conn(link.id)
+                return
+
+            self.logger.info("Bridge link to %s open", link.link)
+            link.connected = True
+
+            keepalive = msg.get_int_property("keepalive")
+            self.watch(link, keepalive * self.KEEPALIVE_GRACE)
+            if keepalive:
+                self.timers.schedule(keepalive, self.ping_link, link, keepalive)
+
+            # Summary of the current interest, then incremental updates
+            topics = [Message(ORIGIN_CLIENT, SUBSCRIBE, topic=topic) for topic in self.interest]
+            for i in range(0, len(topics), MAX_BATCH):
+                link.send(Message(ORIGIN_CLIENT, BATCH, messages=topics[i:i+MAX_BATCH]))
+
+        elif type_.type == PUBLISH:
+            self.apply_publish(msg, link)
+
+        elif type_.type == BATCH:
+            for sub in msg.messages:
+                if sub.type.type == PUBLISH:
+                    self.apply_publish(sub, link)
+
+        elif type_.type in [SUBSCRIBED, UNSUBSCRIBED]:
+            if msg.code & 0x80:
+                self.logger.warning("Bridge link to %s: %s refused (%#x)", link.link, type_name(type_.type), msg.code)
+
+        elif type_.type == BATCHED:
+            if any(code & 0x80 for code in msg.codes):
+                self.logger.warning("Bridge link to %s: subscriptions refused", link.link)
+
+    def ping_link(self, link, interval):
+        """Keeps a bridge link alive
+
+        Args:
+            link (Client): The link.
+            interval (int): The keepalive interval, in seconds.
+        """
+
+        if self.clients[link.id] is link:
+            link.send(Message(ORIGIN_CLIENT, PING))
+            self.timers.schedule(interval, self.ping_link, link, interval)
+
+    def links(self):
+        """Lists the open bridge links
+
+        Returns:
+            list[Client]: The links whose CONNECT was acknowledged.
+        """
+
+        return [client for client in self.clients
+                if client is not None and client.link is not None and client.connected]
+
+    def add_interest(self, client, topic):
+        """Counts a subscription and propagates new topics to peers
+
+        Args:
+            client (Client): The subscriber.
+            topic (str): The subscribed topic.
+        """
+
+        if client.bridge is not None:
+            return
+
+        self.interest[topic] = self.interest.get(topic, 0) + 1
+        if self.interest[topic] == 1:
+            for link in self.links():
+                link.send(Message(ORIGIN_CLIENT, SUBSCRIBE, topic=topic))
+
+    def remove_interest(self, client, topic):
+        """Uncounts a subscription and withdraws unused topics from peers
+
+        Args:
+            client (Client): The subscriber.
+            topic (str): The unsubscribed topic.
+        """
+
+        if client.bridge is not None:
+            return
+
+        self.interest[topic] -= 1
+        if not self.interest[topic]:
+            del self.interest[topic]
+            for link in self.links():
+                link.send(Message(ORIGIN_CLIENT, UNSUBSCRIBE, topic=topic))
+
+    def publish(self, msg, sender):
+        """Processes a PUBLISH message
+
+        Args:
+            msg (Message): The PUBLISH message.
+            sender (Client): The sender client.
+        """
+
+        ack = Message(ORIGIN_SERVER, PUBLISHED)
+        ack.code = self.apply_publish(msg, sender)
+        sender.send(ack)
+
+    def apply_publish(self, msg, sender, rights=None, outbox=None):
+        """Relays a published message to matching subscribers
+
+        The message is encoded once per distinct compression setting and
+        topic alias of the subscribers, so a compressed body is forwarded
+        untouched to those using the publisher's codec.
+
+        Args:
+            msg (Message): The PUBLISH message.
+            sender (Client): The sender client.
+            rights (list, optional): The sender's rights, as returned by
+                :py:meth:`get_rights`. Defaults to None (looked up).
+            outbox (dict, optional): If given, relayed messages are appended
+                to ``outbox[client_id]`` instead of being sent right away.
+                Defaults to None.
+
+        Returns:
+            int: The acknowledgement code.
+        """
+
+        # Bridged messages were checked by the server they were published on
+        bridged = sender.link is not None
+        if not bridged and not self.check_auth(sender, PUBLISH, msg.topic, rights=rights):
+            return 0x81
+
+        # Not the body, which would decompress it
+        self.logger.debug("%s published to '%s'", sender, msg.topic)
+        msg.type.origin = ORIGIN_SERVER
+        msg.max_size = self.max_body()
+        frames = {}
+        recipients = []
+        for topic, ids in self.topics.items():
+            if self.topic_match(topic, msg.topic):
+                recipients += ids
+
+        # One member per matching shared subscription group
+        for (_, pattern), group in self.groups.items():
+            if self.topic_match(pattern, msg.topic):
+                recipients.append(self.pick_member(group))
+
+        # Relaying with another codec decompresses the body: a corrupt one is
+        # dropped before reaching anyone
+        compressed = msg.packed and not "_body" in msg.__dict__
+        if compressed and any(not self.clients[id_].codec in msg.packed for id_ in recipients):
+            try:
+                msg.body
+
+            except InvalidPayload as e:
+                self.logger.warning("Dropping message published by %s: %s", sender, e)
+                return 0x82
+
+        for id_ in recipients:
+            # Bridged messages cross a single link, so never loop
+            if bridged and self.clients[id_].bridge is not None:
+                continue
+
+            if outbox is None:
+                client = self.clients[id_]
+                alias = client.aliases.assign(msg.topic)
+                setting = (client.version, client.codec, client.threshold, alias)
+
+                if not setting in frames:
+                    msg.version, msg.codec, msg.threshold, msg.alias = setting
+                    frames[setting] = msg.to_bytes()
+
+                # Empty if it cannot be encoded in the client's version
+                if frames[setting]:
+                    client.write(frames[setting])
+                    self.logger.debug("Relaying to %s", (client, ))
+
+            else:
+                outbox.setdefault(id_, []).append(msg)
+
+        return 0x00
+
+    def topic_match(self, pattern, topic):
+        """Returns wether `topic` matches `pattern`
+
+        Args:
+            pattern (str): Topic pattern.
+            topic (str): Topic to match.
+
+        Returns:
+            bool: True if topic matches, False otherwise.
+        """
+
+        return bool(re.match(pattern, topic))
+
+    def subscribe(self, msg, client):
+        """Processes a SUBSCRIBE message
+
+        Args:
+            msg (Message): The SUBSCRIBE message.
+            sender (Client): The sender client.
+        """
+
+        ack = Message(ORIGIN_SERVER, SUBSCRIBED)
+        ack.code = self.apply_subscribe(msg, client)
+        client.send(ack)
+
+    def apply_subscribe(self, msg, client, rights=None):
+        """Subscribes a client to a topic
+
+        Args:
+            msg (Message): The SUBSCRIBE message.
+            client (Client): The sender client.
+            rights (list, optional): The client's rights, as returned by
+                :py:meth:`get_rights`. Defaults to None (looked up).
+
+        Returns:
+            int: The acknowledgement code.
+        """
+
+        topic = msg.topic
+        group, pattern = self.split_share(topic)
+
+        if pattern is None:
+            return 0x82
+
+        if not self.check_auth(client, SUBSCRIBE, pattern, rights=rights):
+            return 0x81
+
+        if topic in client.topics:
+            return 0x01
+
+        self.add_subscriber(client, topic)
+
+        self.logger.debug("%s subscribed to '%s'", client, topic)
+
+        return 0x00
+
+    def unsubscribe(self, msg, client):
+        """Processes a UNSUBSCRIBE message
+
+        Args:
+            msg (Message): The UNSUBSCRIBE message.
+            sender (Client): The sender client.
+        """
+
+        ack = Message(ORIGIN_SERVER, UNSUBSCRIBED)
+        ack.code = self.apply_unsubscribe(msg, client)
+        client.send(ack)
 
-        self.state = State.STARTING
-        self.socket.bind((self.host, self.port))
-        self.socket.listen()
-        self.socket.setblocking(False)
-        self.selector.register(self.socket, selectors.EVENT_READ, data=None)
-        self.logger.info("Dragonfly server listening on ('%s', %d)", self.host, self.port)
-        self.state = State.RUNNING
+    def apply_unsubscribe(self, msg, client):
+        """Unsubscribes a client from a topic
 
-        self.mainloop()
+        Args:
+            msg (Message): The UNSUBSCRIBE message.
+            client (Client): The sender client.
 
-    def stop(self):
-        """Closes this server's socket"""
+        Returns:
+            int: The acknowledgement code.
+        """
 
-        self.state = State.STOPPING
-        self.socket.close()
-        self.state = State.STOPPED
+        topic = msg.topic
+        _, pattern = self.split_share(topic)
 
-    def mainloop(self):
-        """Main event loop"""
+        if pattern is None:
+            return 0x82
 
-        while self.state == State.RUNNING:
-            events = self.selector.select(timeout=None)
+        if not self.check_auth(client, UNSUBSCRIBE, pattern):
+            return 0x81
 
-            for key, mask in events:
-                # Listening socket
-                if key.data is None:
-                    self.new_conn(key.fileobj)
+        if not topic in client.topics:
+            return 0x01
 
-                # Data
-                else:
-                    self.handle_msg(key, mask)
+        self.remove_subscriber(client, topic)
 
-    def new_conn(self, sock):
-        """Accepts a new connection
+        self.logger.debug("%s unsubscribed from '%s'", client, topic)
 
-        Args:
-            sock (socket.socket): The incoming socket connection.
-        """
+        return 0x00
 
-        conn, addr = sock.accept()
-        client = self.new_client(conn)
-        self.logger.debug("Accepted connection from %s", (addr, ))
-        conn.setblocking(False)
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"", step=0, length=0, id=client.id)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.selector.register(conn, events, data=data)
+    def split_share(self, topic):
+        """Splits a shared subscription into its group and pattern
 
-    def close_conn(self, id_):
-        """Closes a previously established connection
+        A subscription to ``$share/<group>/<pattern>`` makes the client a
+        member of the group: each message matching the pattern is delivered
+        to a single member of the group (see :py:meth:`pick_member`).
 
         Args:
-            id_ (int): The client's id.
+            topic (str): The subscribed topic.
+
+        Returns:
+            tuple[str, str]: (group, pattern), group being None for regular
+                subscriptions and pattern None for invalid shared ones.
         """
 
-        client = self.clients[id_]
-        self.logger.debug("Closing connection %s", client.socket.getpeername())
-        self.selector.unregister(client.socket)
-        client.socket.close()
-        self.remove_client(id_)
+        if not topic.startswith(SHARE_PREFIX):
+            return None, topic
 
-    def handle_msg(self, key, mask):
-        """Handles an event
+        group, _, pattern = topic[len(SHARE_PREFIX):].partition("/")
+        if not group or not pattern:
+            return group, None
+
+        return group, pattern
+
+    def add_subscriber(self, client, topic):
+        """Registers a subscription
 
         Args:
-            key (selectors.SelectorKey): The event's key.
-            mask (selectors._EventMask): The event's mask.
+            client (Client): The subscriber.
+            topic (str): The subscribed topic.
         """
 
-        sock = key.fileobj
-        data = key.data
+        client.topics.append(topic)
+        group, pattern = self.split_share(topic)
 
-        # Ready to read
-        if mask & selectors.EVENT_READ:
-            recv_data = sock.recv(data.length if data.step == 1 else 7)
+        if group is None:
+            if not topic in self.topics:
+                self.topics[topic] = []
 
-            if recv_data:
-                data.outb += recv_data
-                data.step += 1
+            self.topics[topic].append(client.id)
 
-                if data.step == 1:
-                    data.length = struct.unpack(">I", data.outb[-4:])[0]
-                    if data.length == 0:
-                        data.step = 2
+        else:
+            if not (group, pattern) in self.groups:
+                self.groups[(group, pattern)] = types.SimpleNamespace(members=[], next=0)
 
-                if data.step == 2:
-                    msg = Message()
-                    if msg.from_bytes(data.outb):
-                        self.logger.debug("Received %s from %s", msg, data.addr)
-                        self.process_msg(msg, self.clients[data.id])
+            self.groups[(group, pattern)].members.append(client.id)
 
-                    data.step = 0
-                    data.outb = b""
+        self.add_interest(client, pattern)
 
-            else:
-                self.close_conn(data.id)
+    def remove_subscriber(self, client, topic):
+        """Unregisters a subscription
 
-        # Ready to write
-        if mask & selectors.EVENT_WRITE:
-            pass
+        Args:
+            client (Client): The subscriber.
+            topic (str): The subscribed topic.
+        """
 
-    def new_client(self, sock):
-        """Registers new client
+        client.topics.remove(topic)
+        group, pattern = self.split_share(topic)
+
+        if group is None:
+            self.topics[topic].remove(client.id)
+            if len(self.topics[topic]) == 0:
+                del self.topics[topic]
+
+        else:
+            members = self.groups[(group, pattern)].members
+            members.remove(client.id)
+            if len(members) == 0:
+                del self.groups[(group, pattern)]
+
+        self.remove_interest(client, pattern)
+
+    def pick_member(self, group):
+        """Picks the member of a shared subscription group receiving a
+        message
+
+        Members are picked in turn, or with the ``share_policy`` config
+        option set to ``least_queued``, the member with the fewest outbound
+        bytes queued is picked, in turn among equals, so that slow members
+        get fewer messages.
 
         Args:
-            sock (socket.socket): The client socket.
+            group (types.SimpleNamespace): The group.
 
         Returns:
-            Client: The new client instance.
+            int: The member's client id.
         """
 
-        if not None in self.clients:
-            self.clients.append(None)
+        members = group.members
+        start = group.next % len(members)
+        index = start
 
-        id_ = self.clients.index(None)
-        client = Client(sock, id_)
-        self.clients[id_] = client
+        if self.config.share_policy == "least_queued":
+            order = list(range(start, len(members))) + list(range(start))
+            index = min(order, key=lambda i: self.clients[members[i]].queued)
 
-        return client
+        group.next = index + 1
 
-    def remove_client(self, id_):
-        """Unregisters a client
+        return members[index]
+
+    def batch(self, msg, sender):
+        """Processes a BATCH message
+
+        Sub-messages are applied in order with a single rights lookup.
+        Relayed messages are grouped so that each subscriber receives at most
+        one frame, and the sender gets a single BATCHED acknowledgement
+        holding one code per sub-message.
 
         Args:
-            id_ (int): The client's id.
+            msg (Message): The BATCH message.
+            sender (Client): The sender client.
         """
 
-        client = self.clients[id_]
-        for topic in client.topics:
-            self.topics[topic].remove(id_)
+        rights = self.get_rights(sender)
+        outbox = {}
+        codes = []
 
-        self.clients[id_] = None
+        for sub in msg.messages:
+            if sub.type.type == PUBLISH:
+                codes.append(self.apply_publish(sub, sender, rights, outbox))
 
-    def process_msg(self, msg, sender):
-        """Processes a message
+            elif sub.type.type == SUBSCRIBE:
+                codes.append(self.apply_subscribe(sub, sender, rights))
+
+            elif sub.type.type == UNSUBSCRIBE:
+                codes.append(self.apply_unsubscribe(sub, sender))
+
+            else:
+                codes.append(0x82)
+
+        for id_, msgs in outbox.items():
+            client = self.clients[id_]
+            # A message matching several subscriptions appears several
+            # times, and each occurrence must carry its own alias (the first
+            # one defines it). Copies share the cache of compressed bodies.
+            msgs = [copy.copy(sub) for sub in msgs]
+            if client.version < 1:
+                # Binary bodies cannot be encoded in version 0
+                msgs = [sub for sub in msgs if not sub.binary]
+                if not msgs:
+                    continue
+
+            for sub in msgs:
+                sub.codec, sub.threshold = client.codec, client.threshold
+                sub.alias = client.aliases.assign(sub.topic)
+
+            if len(msgs) == 1:
+                client.send(msgs[0])
+
+            else:
+                client.send(Message(ORIGIN_SERVER, BATCH, messages=msgs))
+
+            self.logger.debug("Relaying %d message(s) to %s", len(msgs), (client, ))
+
+        sender.send(Message(ORIGIN_SERVER, BATCHED, codes=codes))
+
+    def chunk(self, msg, sender):
+        """Processes a CHUNK message
+
+        Chunks are relayed to subscribers as soon as they are received, the
+        subscribers being selected when the first chunk arrives. Whenever a
+        subscriber's outbound queue grows above :py:attr:`QUEUE_HIGH_WATER`,
+        the sender is paused until it drains, so that memory used by a stream
+        is bounded by a few chunks rather than by the whole message. The last
+        chunk is acknowledged with a PUBLISHED message.
 
         Args:
-            msg (Message): The message instance.
+            msg (Message): The CHUNK message.
             sender (Client): The sender client.
         """
 
-        type_ = msg.type
-        if type_.origin == ORIGIN_CLIENT:
-            if type_.type == CONNECT:
-                if type_.flags & 4:
-                    sender.send(Message(ORIGIN_SERVER, CONNECTED, 4, code=0x00))
-                    self.close_conn(sender.id)
+        flags = msg.type.flags
 
-                else:
-                    sender.username = msg.username
-                    sender.password = msg.password
+        if flags & CHUNK_FIRST:
+            if msg.stream_id in sender.streams:
+                self.abort_stream(sender.streams.pop(msg.stream_id))
 
-                    ack = Message(ORIGIN_SERVER, CONNECTED)
-                    ack.code = 0x00
+            sender.streams[msg.stream_id] = self.open_stream(msg, sender)
 
-                    if not self.check_auth(sender, CONNECT):
-                        ack.code = 0x81
+        elif not msg.stream_id in sender.streams:
+            self.logger.warning("%s sent a chunk for unknown stream %d", sender, msg.stream_id)
+            return
 
-                    else:
-                        sender.connected = True
+        stream = sender.streams[msg.stream_id]
+        if flags & (CHUNK_LAST | CHUNK_ABORT):
+            del sender.streams[msg.stream_id]
 
-                    sender.send(ack)
+        relay = Message(ORIGIN_SERVER, CHUNK, flags, stream_id=stream.id, topic=msg.topic, data=msg.data)
+        frames = {}
 
-            elif type_.type == PUBLISH:
-                self.publish(msg, sender)
+        for client in stream.subscribers:
+            if self.clients[client.id] is client:
+                client.write(self.encode_for(relay, client, frames))
 
-            elif type_.type == SUBSCRIBE:
-                self.subscribe(msg, sender)
+                if client.queued > self.QUEUE_HIGH_WATER:
+                    self.pause(sender, client)
 
-            elif type_.type == UNSUBSCRIBE:
-                self.unsubscribe(msg, sender)
+        if flags & CHUNK_LAST:
+            sender.send(Message(ORIGIN_SERVER, PUBLISHED, code=stream.code))
 
-    def publish(self, msg, sender):
-        """Processes a PUBLISH message
+    def open_stream(self, msg, sender):
+        """Opens a stream of chunks
+
+        Streams are only relayed to local subscribers: bridge peers neither
+        forward nor acknowledge chunks.
 
         Args:
-            msg (Message): The PUBLISH message.
+            msg (Message): The first CHUNK message of the stream.
             sender (Client): The sender client.
+
+        Returns:
+            types.SimpleNamespace: The stream, holding its relay id, its
+                subscribers and its acknowledgement code.
         """
 
-        ack = Message(ORIGIN_SERVER, PUBLISHED)
-        ack.code = 0x00
+        self.next_stream_id = (self.next_stream_id + 1) & 0xffffffff
+        stream = types.SimpleNamespace(id=self.next_stream_id, subscribers=[], code=0x00)
 
         if not self.check_auth(sender, PUBLISH, msg.topic):
-            ack.code = 0x81
+            stream.code = 0x81
+            return stream
 
-        else:
-            self.logger.debug("%s published '%s' to '%s'", sender, msg.body, msg.topic)
-            for topic, ids in self.topics.items():
-                if self.topic_match(topic, msg.topic):
-                    for id_ in ids:
-                        client = self.clients[id_]
-                        msg.type.origin = ORIGIN_SERVER
-                        client.send(msg)
-                        self.logger.debug("Relaying to %s", (client, ))
+        self.logger.debug("%s streams to '%s'", sender, msg.topic)
+        for topic, ids in self.topics.items():
+            if self.topic_match(topic, msg.topic):
+                for id_ in ids:
+                    client = self.clients[id_]
+                    if client.bridge is None and not client in stream.subscribers:
+                        stream.subscribers.append(client)
 
-        sender.send(ack)
+        # The whole stream goes to the same member of each group
+        for (_, pattern), group in self.groups.items():
+            if self.topic_match(pattern, msg.topic):
+                client = self.clients[self.pick_member(group)]
+                if not client in stream.subscribers:
+                    stream.subscribers.append(client)
 
-    def topic_match(self, pattern, topic):
-        """Returns wether `topic` matches `pattern`
+        return stream
+
+    def abort_stream(self, stream):
+        """Notifies the subscribers of a stream that it has been aborted
 
         Args:
-            pattern (str): Topic pattern.
-            topic (str): Topic to match.
+            stream (types.SimpleNamespace): The stream, as returned by
+                :py:meth:`open_stream`.
+        """
+
+        abort = Message(ORIGIN_SERVER, CHUNK, CHUNK_ABORT, stream_id=stream.id)
+        frames = {}
+
+        for client in stream.subscribers:
+            if self.clients[client.id] is client:
+                client.write(self.encode_for(abort, client, frames))
+
+    def encode_for(self, msg, client, frames):
+        """Encodes a message relayed to several clients, once per protocol
+        version
+
+        Args:
+            msg (Message): The message.
+            client (Client): The recipient.
+            frames (dict[int, bytes]): Frames already encoded, by version.
 
         Returns:
-            bool: True if topic matches, False otherwise.
+            bytes: The frame for this client.
         """
 
-        return bool(re.match(pattern, topic))
+        if not client.version in frames:
+            msg.version = client.version
+            frames[client.version] = msg.to_bytes()
 
-    def subscribe(self, msg, client):
-        """Processes a SUBSCRIBE message
+        return frames[client.version]
+
+    def issue_token(self, username):
+        """Creates a resume token for an authenticated user
+
+        The client presents it in its next CONNECT (``resume_token``
+        property), to be authenticated by :py:meth:`check_token` instead of
+        its password. Tokens are only issued when authentication is required
+        and expire after ``resume_ttl`` seconds (config option, 0 disables
+        them). They are signed with the ``resume_key`` config option, so
+        that they remain valid after a restart if it is set.
 
         Args:
-            msg (Message): The SUBSCRIBE message.
-            sender (Client): The sender client.
+            username (str): The user's name.
+
+        Returns:
+            str: The token, or None if tokens are disabled.
         """
 
-        topic = msg.topic
+        ttl = self.config.resume_ttl
+        if ttl is None:
+            ttl = self.RESUME_TTL
 
-        ack = Message(ORIGIN_SERVER, SUBSCRIBED)
-        ack.code = 0x00
+        if not self.config.require_auth or not ttl:
+            return None
 
-        if not self.check_auth(client, SUBSCRIBE, topic):
-            ack.code = 0x81
+        expiry = str(int(time.time() + ttl))
+        return f"{expiry}:{self.sign_token(username, expiry)}"
 
-        elif topic in client.topics:
-            ack.code = 0x01
+    def check_token(self, username, token):
+        """Checks a resume token issued by :py:meth:`issue_token`
 
-        else:
-            client.topics.append(topic)
-            if not topic in self.topics:
-                self.topics[topic] = []
+        Args:
+            username (str): The name the client connects with.
+            token (str): The token.
 
-            self.topics[topic].append(client.id)
+        Returns:
+            bool: True if the token was issued for this user and has not
+                expired, False otherwise.
+        """
 
-            self.logger.debug("%s subscribed to '%s'", client, topic)
+        expiry, _, signature = token.partition(":")
+        if not expiry.isdigit() or int(expiry) < time.time():
+            return False
 
-        client.send(ack)
+        return hmac.compare_digest(signature, self.sign_token(username, expiry))
 
-    def unsubscribe(self, msg, client):
-        """Processes a UNSUBSCRIBE message
+    def sign_token(self, username, expiry):
+        """Computes the signature of a resume token
 
         Args:
-            msg (Message): The UNSUBSCRIBE message.
-            sender (Client): The sender client.
-        """
+            username (str): The user's name.
+            expiry (str): The token's expiry, as a UNIX timestamp.
 
-        topic = msg.topic
+        Returns:
+            str: The hex signature.
+        """
 
-        ack = Message(ORIGIN_SERVER, UNSUBSCRIBED)
-        ack.code = 0x00
+        payload = f"{username or ''}\n{expiry}".encode("utf-8")
+        return hmac.new(self.resume_key, payload, hashlib.sha256).hexdigest()
 
-        if not self.check_auth(client, UNSUBSCRIBE, topic):
-            ack.code = 0x81
+    def get_rights(self, client):
+        """Lists the topic rights applying to a client
 
-        elif not topic in client.topics:
-            ack.code = 0x01
+        General rights come first so that user rights take precedence.
 
-        else:
-            client.topics.remove(topic)
+        Args:
+            client (Client): The client.
 
-            self.topics[topic].remove(client.id)
+        Returns:
+            list: (pattern, rights) tuples.
+        """
 
-            if len(self.topics[topic]) == 0:
-                del self.topics[topic]
+        rights = list((self.config.topics or {}).items())
+        user = client.user
+        if user is None:
+            user = self.config.get_user(client.username, client.password)
 
-            self.logger.debug("%s unsubscribed from '%s'", client, topic)
+        if user:
+            rights += list(user.get("topics", {}).items())
 
-        client.send(ack)
+        return rights
 
-    def check_auth(self, client, scope, *args):
+    def check_auth(self, client, scope, *args, rights=None):
         """Checks user rights in `scope`
 
         Args:
             client (Client): The client.
             scope (int): Message type.
+            rights (list, optional): The client's rights, as returned by
+                :py:meth:`get_rights`. Defaults to None (looked up).
 
         Returns:
             True if the client is authorized in this scope, False otherwise.
@@ -353,13 +2039,15 @@ class Server:
                 not a valid scope.
         """
 
-        user = self.config.get_user(client.username, client.password)
-
         if scope == CONNECT:
             if not self.config.require_auth:
                 return True
 
-            if user:
+            # Authenticated by a resume token
+            if client.user is not None:
+                return True
+
+            if self.config.get_user(client.username, client.password):
                 return True
 
             return False
@@ -371,17 +2059,15 @@ class Server:
                 return False
 
             auth = True
-            topics = list(self.config.topics.items())
+            if rights is None:
+                rights = self.get_rights(client)
 
-            if user:
-                topics += list(user["topics"].items())
-
-            for topic, rights in topics:
+            for topic, topic_rights in rights:
                 if self.topic_match(topic, pub_topic):
-                    if "!pub" in rights:
+                    if "!pub" in topic_rights:
                         auth = False
 
-                    elif "pub" in rights:
+                    elif "pub" in topic_rights:
                         auth = True
 
             return auth
@@ -393,17 +2079,15 @@ class Server:
                 return False
 
             auth = True
-            topics = list(self.config.topics.items())
-
-            if user:
-                topics += list(user["topics"].items())
+            if rights is None:
+                rights = self.get_rights(client)
 
-            for topic, rights in topics:
+            for topic, topic_rights in rights:
                 if self.topic_match(topic, sub_topic):
-                    if "!sub" in rights:
+                    if "!sub" in topic_rights:
                         auth = False
 
-                    elif "sub" in rights:
+                    elif "sub" in topic_rights:
                         auth = True
 
             return auth
@@ -414,7 +2098,11 @@ class Server:
         raise NotImplementedError(f"{type_name(scope)} is not a scope")
 
 class Client:
-    """Represents a client"""
+    """Represents a client
+
+    Outbound messages are queued and written whenever the socket is ready, so
+    that the server never blocks on a slow client.
+    """
 
     def __init__(self, sock, id_):
         """Initializes a Client instance
@@ -428,12 +2116,114 @@ class Client:
         self.username = None
         self.password = None
         self.connected = False
+
+        #: Config of the user, once authenticated by a resume token
+        self.user = None
+
+        #: Time anything was last received from the client
+        self.last_seen = time.monotonic()
+        self.idle_timeout = 0
+        self.timer = None
         self.topics = []
         self.id = id_
+        self.codec = None
+        self.threshold = compression.DEFAULT_THRESHOLD
+        self.aliases = TopicAliases()
+
+        #: Protocol version of the frames sent to the client, from its CONNECT
+        self.version = Message.VERSION
+
+        self.queue = SendQueue(SEND_SIZE)
+
+        #: Total number of bytes ever queued
+        self.appended = 0
+
+        #: (end offset, session) of the sessions' frames still queued
+        self.marks = deque()
+
+        self.paused = False
+        self.waiters = []
+        self.streams = {}
+
+        self.selector = None
+        self.data = None
+        self.events = 0
+
+        #: Events the TLS handshake waits for, 0 once it is done
+        self.handshaking = 0
+
+        #: The connection carrying this client's messages
+        self.conn = self
+        self.sessions = {}
+
+        #: Address of the peer, if this is a bridge link opened by the server
+        self.link = None
+
+        #: Node id of the peer, if this is a bridge link opened by a peer
+        self.bridge = None
 
     def __repr__(self):
         return f"<Client {self.id} topics={self.topics}>"
 
+    @property
+    def queued(self):
+        """int: Number of outbound bytes waiting to be sent"""
+
+        return self.queue.queued
+
+    def register(self, selector, data):
+        """Registers this client's socket to a selector
+
+        Args:
+            selector (selectors.BaseSelector): The selector.
+            data (types.SimpleNamespace): The key's data.
+        """
+
+        self.selector = selector
+        self.data = data
+        self.update_events()
+
+    def unregister(self):
+        """Unregisters this client's socket from its selector"""
+
+        if self.events:
+            self.selector.unregister(self.socket)
+
+        self.events = 0
+        self.selector = None
+
+    def update_events(self):
+        """Updates the events this client's socket is watched for
+
+        Reading is disabled while the client is paused and writing is only
+        watched while the outbound queue is not empty. During the TLS
+        handshake, the events it waits for are watched instead.
+        """
+
+        if self.selector is None:
+            return
+
+        events = 0 if self.paused else selectors.EVENT_READ
+        if self.queue and not getattr(self.socket, "wakes_on_space", False):
+            events |= selectors.EVENT_WRITE
+
+        if self.handshaking:
+            events = self.handshaking
+
+        if events == self.events:
+            return
+
+        if not self.events:
+            self.selector.register(self.socket, events, data=self.data)
+
+        elif not events:
+            self.selector.unregister(self.socket)
+
+        else:
+            self.selector.modify(self.socket, events, data=self.data)
+
+        self.events = events
+
     def send(self, msg):
         """Sends a message through the socket
 
@@ -441,7 +2231,112 @@ class Client:
             msg (Message): The message to send.
         """
 
-        self.socket.sendall(msg.to_bytes())
+        msg.version = self.version
+        bytes_ = msg.to_bytes()
+        if bytes_:
+            self.write(bytes_)
+
+    def write(self, bytes_):
+        """Queues bytes to be sent through the socket
+
+        The queue is flushed right away if it was empty.
+
+        Args:
+            bytes_ (bytes): The bytes to send.
+        """
+
+        was_empty = not self.queue
+        self.queue.append(bytes_)
+        self.appended += len(bytes_)
+
+        if was_empty:
+            self.flush()
+
+    def flush(self):
+        """Sends as much of the outbound queue as the socket accepts"""
+
+        try:
+            self.queue.send(self.socket)
+
+        except OSError:
+            # The connection is closed when the socket is next read
+            self.queue.clear()
+
+        sent = self.appended - self.queue.queued
+        while self.marks and self.marks[0][0] <= sent:
+            self.marks.popleft()[1].frames -= 1
+
+        self.update_events()
+
+class Session(Client):
+    """Represents a logical session sharing its connection with others
+
+    Messages sent to the session are wrapped in SESSION messages and queued
+    on its connection.
+    """
+
+    #: Maximum number of frames a session may have queued on its connection,
+    #: further frames are dropped
+    MAX_QUEUED = 1 << 12
+
+    def __init__(self, conn, session_id, id_):
+        """Initializes a Session instance
+
+        Args:
+            conn (Client): The connection carrying the session.
+            session_id (int): The session's id on this connection.
+            id_ (int): The session's client id (see
+                :py:meth:`Server.new_session`).
+        """
+
+        super().__init__(conn.socket, id_)
+        self.conn = conn
+        self.session_id = session_id
+
+        #: Number of this session's frames queued on the connection
+        self.frames = 0
+
+    def __repr__(self):
+        return f"<Session {self.session_id} of {self.conn} topics={self.topics}>"
+
+    @property
+    def queued(self):
+        """int: Number of outbound bytes waiting to be sent on the connection"""
+
+        return self.conn.queued
+
+    def register(self, selector, data):
+        pass
+
+    def unregister(self):
+        pass
+
+    def update_events(self):
+        pass
+
+    def write(self, bytes_):
+        """Queues bytes on the connection, wrapped in a SESSION message
+
+        The bytes are dropped if :py:attr:`MAX_QUEUED` of the session's
+        frames are already queued.
+
+        Args:
+            bytes_ (bytes): The bytes to send.
+        """
+
+        if self.frames >= self.MAX_QUEUED:
+            logging.getLogger("dragonfly").warning("%s has too many queued frames, dropping one", self)
+            return
+
+        msg = Message(ORIGIN_SERVER, SESSION, session_id=self.session_id, frame=bytes_, version=self.conn.version)
+        bytes_ = msg.to_bytes()
+
+        self.frames += 1
+        self.conn.marks.append((self.conn.appended + len(bytes_), self))
+        self.conn.write(bytes_)
+
+    def flush(self):
+        self.conn.flush()
 
 if __name__ == "__main__":
     import threading
@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Shared memory transport for clients running on the same host as the server
+
+A connection is a shared memory block holding two single-producer,
+single-consumer ring buffers, one per direction, and a wakeup file descriptor
+per side (an eventfd, or a pipe where eventfd is not available). Frames are
+copied into the peer's ring and the peer is woken up, without going through
+the kernel's socket buffers.
+
+The client creates the block (an anonymous file, so nothing is left behind
+if a side crashes, sealed against resizing where supported) and the wakeup
+descriptors, then hands their descriptors to the server over a Unix domain
+socket (see :py:func:`connect` and :py:func:`accept`). Ring positions are
+written by the peer, so they are checked before use.
+
+:py:class:`ShmSocket` mimics a non-blocking socket so that shared memory
+connections are handled like any other by the server and the client.
+"""
+
+import fcntl
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+
+#: Default capacity of each ring buffer, in bytes
+RING_SIZE = 1 << 20
+
+#: Version of the handshake
+VERSION = 0
+
+#: Seals required on memfd blocks, so that the peer cannot resize them while
+#: mapped
+SEALS = getattr(fcntl, "F_SEAL_SHRINK", 0) | getattr(fcntl, "F_SEAL_GROW", 0)
+
+class Ring:
+    """Single-producer, single-consumer ring buffer over shared memory
+
+    The header holds the total number of bytes written (head) and read
+    (tail), a flag set by the producer when it is waiting for room and a flag
+    set when the producer closed its end.
+    """
+
+    HEADER_SIZE = 64
+
+    def __init__(self, buf, capacity):
+        """Initializes a Ring instance
+
+        Args:
+            buf (memoryview): Shared memory holding the header and data.
+            capacity (int): Size of the data area, in bytes.
+        """
+
+        self.buf = buf
+        self.data = buf[self.HEADER_SIZE:self.HEADER_SIZE + capacity]
+        self.capacity = capacity
+
+    @property
+    def head(self):
+        return struct.unpack_from("<Q", self.buf, 0)[0]
+
+    @head.setter
+    def head(self, value):
+        struct.pack_into("<Q", self.buf, 0, value)
+
+    @property
+    def tail(self):
+        return struct.unpack_from("<Q", self.buf, 8)[0]
+
+    @tail.setter
+    def tail(self, value):
+        struct.pack_into("<Q", self.buf, 8, value)
+
+    @property
+    def waiting(self):
+        return bool(self.buf[16])
+
+    @waiting.setter
+    def waiting(self, value):
+        self.buf[16] = int(value)
+
+    @property
+    def closed(self):
+        return bool(self.buf[17])
+
+    @closed.setter
+    def closed(self, value):
+        self.buf[17] = int(value)
+
+    def __len__(self):
+        return self.used(self.head, self.tail)
+
+    def used(self, head, tail):
+        """Returns the number of bytes between two positions of the ring
+
+        Args:
+            head (int): The head.
+            tail (int): The tail.
+
+        Raises:
+            BrokenPipeError: If the positions are further apart than the
+                capacity, which only a misbehaving peer can cause.
+
+        Returns:
+            int: The number of bytes.
+        """
+
+        used = head - tail
+        if not 0 <= used <= self.capacity:
+            raise BrokenPipeError("Corrupt ring positions")
+
+        return used
+
+    def free(self):
+        """Returns the number of bytes that can be written
+
+        Returns:
+            int: The free space, in bytes.
+        """
+
+        return self.capacity - len(self)
+
+    def write(self, data):
+        """Writes as much data as fits (producer side)
+
+        Args:
+            data (bytes-like): The data.
+
+        Raises:
+            BrokenPipeError: If the ring's positions are corrupt.
+
+        Returns:
+            int: The number of bytes written.
+        """
+
+        head = self.head
+        data = memoryview(data).cast("B")
+        count = min(len(data), self.capacity - self.used(head, self.tail))
+        start = head % self.capacity
+        first = min(count, self.capacity - start)
+
+        self.data[start:start + first] = data[:first]
+        self.data[:count - first] = data[first:count]
+        self.head = head + count
+
+        return count
+
+    def read(self, size):
+        """Reads up to ``size`` bytes (consumer side)
+
+        Args:
+            size (int): Maximum number of bytes.
+
+        Raises:
+            BrokenPipeError: If the ring's positions are corrupt.
+
+        Returns:
+            bytes: The data read.
+        """
+
+        tail = self.tail
+        count = min(size, self.used(self.head, tail))
+        start = tail % self.capacity
+        first = min(count, self.capacity - start)
+
+        data = bytes(self.data[start:start + first])
+        if count > first:
+            data += bytes(self.data[:count - first])
+
+        self.tail = tail + count
+
+        return data
+
+    def release(self):
+        """Releases the views over the shared memory"""
+
+        self.data.release()
+        self.buf.release()
+
+class Wakeup:
+    """File descriptor used to wake up a side's selector"""
+
+    def __init__(self, fds=None):
+        """Initializes a Wakeup instance
+
+        Args:
+            fds (list[int], optional): An eventfd, or the read and write ends
+                of a pipe, received from the other side. Defaults to None
+                (new descriptors are created).
+        """
+
+        if fds is None:
+            if hasattr(os, "eventfd"):
+                fds = [os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)]
+
+            else:
+                fds = list(os.pipe())
+                for fd in fds:
+                    os.set_blocking(fd, False)
+
+        self.fds = fds
+
+    def fileno(self):
+        return self.fds[0]
+
+    def signal(self):
+        """Makes the descriptor readable"""
+
+        try:
+            os.write(self.fds[-1], (1).to_bytes(8, sys.byteorder))
+
+        except BlockingIOError:
+            # Already signaled
+            pass
+
+    def drain(self):
+        """Makes the descriptor not readable anymore"""
+
+        try:
+            os.read(self.fds[0], 4096)
+
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+
+        self.fds = []
+
+class ShmSocket:
+    """Socket-like end of a shared memory connection
+
+    Only the methods used by the server and the client are provided. The
+    descriptor to watch (:py:meth:`fileno`) only becomes readable: it is
+    signaled both when data is received and when room is freed for sending
+    (see :py:attr:`wakes_on_space`).
+    """
+
+    #: Writing is retried when :py:meth:`fileno` is readable, instead of
+    #: watching it for writability
+    wakes_on_space = True
+
+    def __init__(self, shm, rx, tx, wakeup, peer_wakeup):
+        """Initializes a ShmSocket instance
+
+        Args:
+            shm (mmap.mmap): The shared memory block.
+            rx (Ring): The ring this side reads from.
+            tx (Ring): The ring this side writes to.
+            wakeup (Wakeup): This side's wakeup descriptor.
+            peer_wakeup (Wakeup): The other side's wakeup descriptor.
+        """
+
+        self.shm = shm
+        self.rx = rx
+        self.tx = tx
+        self.wakeup = wakeup
+        self.peer_wakeup = peer_wakeup
+
+    def fileno(self):
+        return self.wakeup.fileno() if self.wakeup.fds else -1
+
+    def setblocking(self, flag):
+        pass
+
+    def recv(self, size):
+        """Reads received data
+
+        Args:
+            size (int): Maximum number of bytes.
+
+        Raises:
+            BlockingIOError: If there is no data to read.
+
+        Returns:
+            bytes: The data, or b"" if the other side closed the connection
+                or corrupted the ring.
+        """
+
+        self.wakeup.drain()
+        try:
+            data = self.rx.read(size)
+            pending = len(self.rx)
+
+        except BrokenPipeError:
+            return b""
+
+        if self.rx.waiting and data:
+            self.rx.waiting = False
+            self.peer_wakeup.signal()
+
+        if pending:
+            # Stay readable until the ring is drained
+            self.wakeup.signal()
+
+        elif not data:
+            if self.rx.closed:
+                return b""
+
+            raise BlockingIOError()
+
+        return data
+
+    def send(self, data):
+        """Writes as much data as fits in the ring
+
+        Args:
+            data (bytes-like): The data.
+
+        Raises:
+            BlockingIOError: If the ring is full.
+
+        Returns:
+            int: The number of bytes written.
+        """
+
+        if self.tx.closed or self.rx.closed:
+            raise BrokenPipeError()
+
+        count = self.tx.write(data)
+        if count:
+            self.peer_wakeup.signal()
+
+        if count < len(data):
+            self.tx.waiting = True
+
+            # The peer may have read everything in the meantime
+            if self.tx.free():
+                self.tx.waiting = False
+                self.wakeup.signal()
+
+            if not count:
+                raise BlockingIOError()
+
+        return count
+
+    def close(self):
+        """Closes this end of the connection"""
+
+        if not self.wakeup.fds:
+            return
+
+        self.tx.closed = True
+        self.peer_wakeup.signal()
+
+        self.rx.release()
+        self.tx.release()
+        self.shm.close()
+
+        self.wakeup.close()
+        if self.peer_wakeup is not self.wakeup:
+            self.peer_wakeup.close()
+
+def block_size(size):
+    """Returns the size of a block holding two rings
+
+    Args:
+        size (int): Capacity of each ring, in bytes.
+
+    Returns:
+        int: The size in bytes.
+    """
+
+    return 2 * (Ring.HEADER_SIZE + size)
+
+def create_block(size):
+    """Creates an anonymous shared memory file
+
+    Args:
+        size (int): Capacity of each ring, in bytes.
+
+    Returns:
+        int: The file descriptor.
+    """
+
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("dragonfly", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+
+    else:
+        with tempfile.TemporaryFile() as f:
+            fd = os.dup(f.fileno())
+
+    try:
+        os.ftruncate(fd, block_size(size))
+        if hasattr(os, "memfd_create"):
+            # Truncating a mapped block would crash the server with SIGBUS
+            fcntl.fcntl(fd, fcntl.F_ADD_SEALS, SEALS)
+
+    except OSError:
+        os.close(fd)
+        raise
+
+    return fd
+
+def rings(shm, size):
+    """Returns the two rings of a shared memory block
+
+    Args:
+        shm (mmap.mmap): The block.
+        size (int): Capacity of each ring, in bytes.
+
+    Returns:
+        tuple[Ring, Ring]: The client to server and server to client rings.
+    """
+
+    span = Ring.HEADER_SIZE + size
+    with memoryview(shm) as buf:
+        return Ring(buf[:span], size), Ring(buf[span:2 * span], size)
+
+def connect(path, size=RING_SIZE, timeout=None):
+    """Opens a shared memory connection to a server (client side)
+
+    Args:
+        path (str): Path of the server's shared memory Unix domain socket.
+        size (int, optional): Capacity of each ring, in bytes. Defaults to
+            :py:const:`RING_SIZE`.
+        timeout (float, optional): Handshake timeout, in seconds. Defaults to
+            None (no timeout).
+
+    Raises:
+        OSError: If the handshake fails.
+
+    Returns:
+        ShmSocket: The connection.
+    """
+
+    fd = create_block(size)
+    client_wakeup, server_wakeup = Wakeup(), Wakeup()
+
+    try:
+        shm = mmap.mmap(fd, block_size(size))
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control:
+            control.settimeout(timeout)
+            control.connect(path)
+
+            hello = struct.pack(">BIB", VERSION, size, len(client_wakeup.fds))
+            socket.send_fds(control, [hello], [fd] + client_wakeup.fds + server_wakeup.fds)
+
+            if control.recv(1) != b"\x00":
+                raise ConnectionRefusedError("Shared memory handshake refused")
+
+    except OSError:
+        client_wakeup.close()
+        server_wakeup.close()
+        raise
+
+    finally:
+        # The mapping keeps the block alive
+        os.close(fd)
+
+    tx, rx = rings(shm, size)
+
+    return ShmSocket(shm, rx, tx, client_wakeup, server_wakeup)
+
+def accept(control, timeout=1):
+    """Accepts a shared memory connection (server side)
+
+    Args:
+        control (socket.socket): The accepted Unix domain socket the client
+            sends the handshake on, closed afterwards.
+        timeout (float, optional): Handshake timeout, in seconds. Defaults
+            to 1.
+
+    Raises:
+        OSError: If the handshake fails.
+
+    Returns:
+        ShmSocket: The connection.
+    """
+
+    with control:
+        control.settimeout(timeout)
+        return finish_accept(control)
+
+def finish_accept(control):
+    """Completes the handshake of a shared memory connection (server side)
+
+    Does not wait if the control socket is non-blocking, so that servers can
+    call it once the socket is readable. The control socket is left open.
+
+    Args:
+        control (socket.socket): The accepted Unix domain socket the client
+            sends the handshake on.
+
+    Raises:
+        BlockingIOError: If the socket is non-blocking and the handshake was
+            not received yet.
+        OSError: If the handshake fails.
+
+    Returns:
+        ShmSocket: The connection.
+    """
+
+    msg, fds, _, _ = socket.recv_fds(control, 64, 5)
+
+    try:
+        version, size, count = struct.unpack_from(">BIB", msg)
+        if version != VERSION or len(fds) != 1 + 2 * count:
+            raise ValueError("unexpected version or descriptors")
+
+        if os.fstat(fds[0]).st_size < block_size(size):
+            raise ValueError("shared memory block too small")
+
+        if hasattr(os, "memfd_create") and fcntl.fcntl(fds[0], fcntl.F_GET_SEALS) & SEALS != SEALS:
+            raise ValueError("shared memory block not sealed")
+
+        shm = mmap.mmap(fds[0], block_size(size))
+
+    except (struct.error, ValueError, OSError) as e:
+        for fd in fds:
+            os.close(fd)
+
+        raise ConnectionRefusedError(f"Invalid shared memory handshake: {e}")
+
+    os.close(fds[0])
+    fds = fds[1:]
+    client_wakeup, server_wakeup = Wakeup(fds[:count]), Wakeup(fds[count:])
+
+    try:
+        control.sendall(b"\x00")
+
+    except OSError:
+        shm.close()
+        client_wakeup.close()
+        server_wakeup.close()
+        raise
+
+    rx, tx = rings(shm, size)
+
+    return ShmSocket(shm, rx, tx, server_wakeup, client_wakeup)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Hierarchical timer wheel
+
+Timers are kept in buckets by expiry tick, so that scheduling, cancelling
+and expiring a timer cost O(1) whatever the number of timers. The first
+level has one bucket per tick; each following level has buckets spanning a
+whole turn of the previous one, whose timers are moved down (cascaded) when
+the previous level wraps around.
+"""
+
+import time
+
+class Timer:
+    """A scheduled callback (see :py:meth:`TimerWheel.schedule`)"""
+
+    __slots__ = ("expiry", "callback", "args", "bucket")
+
+    def __init__(self, expiry, callback, args):
+        """Initializes a Timer instance
+
+        Args:
+            expiry (int): The tick the timer expires at.
+            callback (callable): The function called on expiry.
+            args (tuple): The function's arguments.
+        """
+
+        self.expiry = expiry
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+
+class TimerWheel:
+    """Hierarchical timer wheel
+
+    Expiry times are rounded up to the next tick. The wheel is driven by the
+    caller: :py:meth:`timeout` gives the time to wait for before calling
+    :py:meth:`advance`, which runs the expired timers' callbacks.
+    """
+
+    #: Number of bits of a tick number handled per level
+    BITS = 6
+
+    #: Number of buckets per level
+    SLOTS = 1 << BITS
+
+    def __init__(self, tick=0.1, levels=4, clock=time.monotonic):
+        """Initializes a TimerWheel instance
+
+        Args:
+            tick (float, optional): Resolution of the wheel, in seconds.
+                Defaults to 0.1.
+            levels (int, optional): Number of levels. Timers further than
+                ``SLOTS ** levels`` ticks are cascaded until they are within
+                reach. Defaults to 4 (about 19 days with the default tick).
+            clock (callable, optional): Function returning the current time,
+                in seconds. Defaults to :py:func:`time.monotonic`.
+        """
+
+        self.tick = tick
+        self.clock = clock
+        self.wheels = [[set() for _ in range(self.SLOTS)] for _ in range(levels)]
+        self.current = self.ticks(clock())
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def ticks(self, now):
+        """Converts a time to a tick number
+
+        Args:
+            now (float): The time, in seconds.
+
+        Returns:
+            int: The last tick started at this time.
+        """
+
+        return int(now / self.tick)
+
+    def schedule(self, delay, callback, *args):
+        """Schedules a callback
+
+        Args:
+            delay (float): Delay before the callback is called, in seconds.
+            callback (callable): The function to call.
+            *args: The function's arguments.
+
+        Returns:
+            Timer: The timer, to be cancelled with :py:meth:`cancel`.
+        """
+
+        # Rounded up, so that timers never expire early
+        expiry = max(self.ticks(self.clock() + delay) + 1, self.current + 1)
+        timer = Timer(expiry, callback, args)
+        self.insert(timer)
+        self.count += 1
+
+        return timer
+
+    def cancel(self, timer):
+        """Cancels a timer, if still pending
+
+        Args:
+            timer (Timer): The timer.
+        """
+
+        if timer.bucket is not None:
+            timer.bucket.discard(timer)
+            timer.bucket = None
+            self.count -= 1
+
+    def insert(self, timer):
+        """Puts a timer in the bucket of its expiry tick
+
+        Args:
+            timer (Timer): The timer.
+        """
+
+        delta = timer.expiry - self.current
+        level = 0
+        while delta >= self.SLOTS << (self.BITS * level) and level < len(self.wheels) - 1:
+            level += 1
+
+        # Out of reach: parked in the furthest bucket until it is cascaded
+        expiry = min(timer.expiry, self.current + (self.SLOTS << (self.BITS * level)) - 1)
+        slot = (expiry >> (self.BITS * level)) & (self.SLOTS - 1)
+
+        timer.bucket = self.wheels[level][slot]
+        timer.bucket.add(timer)
+
+    def timeout(self):
+        """Returns the time until :py:meth:`advance` has timers to expire
+
+        Only the first level is scanned: when its timers are further away,
+        the time until it wraps around (and the next level is cascaded) is
+        returned.
+
+        Returns:
+            float: The delay in seconds, or None if no timer is pending.
+        """
+
+        if not self.count:
+            return None
+
+        wheel = self.wheels[0]
+        mask = self.SLOTS - 1
+        for i in range(1, self.SLOTS - (self.current & mask) + 1):
+            if wheel[(self.current + i) & mask]:
+                break
+
+        return max(0, (self.current + i) * self.tick - self.clock())
+
+    def advance(self):
+        """Runs the callbacks of the timers expired since the last call
+
+        Returns:
+            int: The number of expired timers.
+        """
+
+        target = self.ticks(self.clock())
+        expired = 0
+
+        if not self.count:
+            self.current = max(self.current, target)
+
+        while self.current < target:
+            self.current += 1
+
+            # Cascades the buckets of the levels whose previous level wrapped,
+            # from the top so that cascaded timers are cascaded again if needed
+            level = 1
+            while level < len(self.wheels) and not self.current & ((1 << (self.BITS * level)) - 1):
+                level += 1
+
+            for level in range(level - 1, 0, -1):
+                slot = (self.current >> (self.BITS * level)) & (self.SLOTS - 1)
+                bucket = self.wheels[level][slot]
+                self.wheels[level][slot] = set()
+
+                for timer in bucket:
+                    self.insert(timer)
+
+            slot = self.current & (self.SLOTS - 1)
+            bucket = self.wheels[0][slot]
+            if not bucket:
+                continue
+
+            self.wheels[0][slot] = set()
+            for timer in bucket:
+                timer.bucket = None
+                self.count -= 1
+                expired += 1
+                timer.callback(*timer.args)
+
+        return expired
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import time
+from threading import Thread
+import unittest
+import sys
+
+sys.path.append("src")
+
+from dragonfly.server import Server, State
+
+class ServerTestCase(unittest.TestCase):
+    """Test case running servers in background threads
+
+    Servers are stopped at the end of the test, after tearDown.
+    """
+
+    def start_server(self, **kwargs):
+        """Creates and runs a server
+
+        Args:
+            **kwargs: The server's arguments. It listens on a random port
+                unless ``port`` is set.
+
+        Returns:
+            Server: The running server.
+        """
+
+        kwargs.setdefault("port", 0)
+        server = Server(**kwargs)
+        self.run_server(server)
+
+        return server
+
+    def run_server(self, server):
+        """Runs a server and waits for it to listen
+
+        Args:
+            server (Server): The server.
+
+        Returns:
+            threading.Thread: The thread running the server's main loop.
+        """
+
+        thread = Thread(target=server.start, daemon=True)
+        thread.start()
+        self.addCleanup(server.stop)
+
+        while server.state != State.RUNNING:
+            time.sleep(0.01)
+
+        return thread
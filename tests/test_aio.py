@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import unittest
+import sys
+
+sys.path.append("src")
+
+from dragonfly.aio import AsyncClient
+from tests.helpers import ServerTestCase
+
+class TestAsyncClient(ServerTestCase):
+    def setUp(self):
+        self.server = self.start_server()
+        self.port = self.server.socket.getsockname()[1]
+
+    def test_pubsub(self):
+        async def run():
+            client = AsyncClient()
+            self.assertEqual(await client.connect(port=self.port), 0)
+            self.assertEqual(await client.subscribe("a"), 0)
+            self.assertEqual(await client.subscribe("a"), 1)
+
+            codes = await asyncio.gather(*[
+                client.publish("a", str(i))
+                for i in range(10)
+            ])
+            self.assertEqual(codes, [0] * 10)
+
+            self.assertEqual(await client.unsubscribe("a"), 0)
+            await client.disconnect()
+
+            return [msg async for msg in client.messages()]
+
+        msgs = asyncio.run(run())
+        self.assertEqual(msgs, [("a", str(i)) for i in range(10)])
+
+    def test_unencodable(self):
+        async def run():
+            client = AsyncClient()
+            self.assertEqual(await client.connect(port=self.port), 0)
+            with self.assertRaises(ValueError), self.assertLogs("dragonfly", logging.ERROR):
+                await client.publish("a" * 70000, "x")
+
+            self.assertEqual(await client.subscribe("a"), 0)
+            self.assertEqual(await client.publish("a", "x"), 0)
+            await client.disconnect()
+
+        asyncio.run(run())
+
+    def test_keepalive_receive_only(self):
+        self.server.config._config["keepalive"] = 1
+
+        async def run():
+            subscriber = AsyncClient(keepalive=1)
+            publisher = AsyncClient(keepalive=1)
+            self.assertEqual(await subscriber.connect(port=self.port), 0)
+            self.assertEqual(await publisher.connect(port=self.port), 0)
+            self.assertEqual(await subscriber.subscribe("a"), 0)
+
+            # The subscriber only receives for more than 1.5 intervals
+            for i in range(12):
+                self.assertEqual(await publisher.publish("a", str(i)), 0)
+                await asyncio.sleep(0.2)
+
+            self.assertFalse(subscriber.task.done())
+            await publisher.disconnect()
+            await subscriber.disconnect()
+
+            return [msg async for msg in subscriber.messages()]
+
+        msgs = asyncio.run(run())
+        self.assertEqual(msgs, [("a", str(i)) for i in range(12)])
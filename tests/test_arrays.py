@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import array
+import struct
+import unittest
+import sys
+
+sys.path.append("src")
+
+from dragonfly import arrays
+from dragonfly.exceptions import InvalidArray
+
+class TestArrays(unittest.TestCase):
+    def test_roundtrip(self):
+        for fmt in "bBhHiIlLqQfd":
+            with self.subTest(fmt=fmt):
+                arr = array.array(fmt, range(5))
+                view = arrays.unpack(arrays.pack(arr))
+                self.assertEqual(view.tolist(), arr.tolist())
+                self.assertEqual(view.itemsize, arr.itemsize)
+
+    def test_shape(self):
+        arr = memoryview(array.array("f", range(6))).cast("B").cast("f", [2, 3])
+        body = arrays.pack(arr)
+        self.assertEqual(len(body) % 8, 0)
+
+        view = arrays.unpack(body)
+        self.assertEqual(view.shape, (2, 3))
+        self.assertEqual(view.tolist(), [[0, 1, 2], [3, 4, 5]])
+
+    def test_header(self):
+        body = arrays.pack(array.array("d", [1.5]))
+        order = "<" if sys.byteorder == "little" else ">"
+        self.assertEqual(body[:16], b"DFA\x10" + order.encode() + b"f8\x00\x01\x00\x00\x00\x01\x00\x00\x00")
+        self.assertEqual(body[16:], struct.pack("d", 1.5))
+
+    def test_byteorder(self):
+        other = ">" if sys.byteorder == "little" else "<"
+        body = b"DFA\x10" + other.encode() + b"i4\x00\x01\x00\x00\x00\x02\x00\x00\x00" + struct.pack(f"{other}2i", 1, 2)
+        self.assertEqual(arrays.unpack(body).tolist(), [1, 2])
+
+    def test_invalid(self):
+        with self.assertRaises(InvalidArray):
+            arrays.pack(memoryview(b"abcd").cast("B")[::2])
+
+        with self.assertRaises(InvalidArray):
+            arrays.unpack(b"not an array")
+
+        with self.assertRaises(InvalidArray):
+            # Shape does not match data
+            arrays.unpack(b"DFA\x10<i4\x00\x01\x00\x00\x00\x03\x00\x00\x00\x01\x00\x00\x00")
+
+        self.assertFalse(arrays.is_array("DFA"))
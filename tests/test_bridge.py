@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import queue
+import socket
+import sys
+from threading import Thread
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.append("src")
+
+from dragonfly.client import Client
+from dragonfly.message import CHUNK
+from dragonfly.server import Server, State
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def wait_for(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return predicate()
+
+class TestBridge(unittest.TestCase):
+    def setUp(self):
+        # Full mesh of three servers
+        self.ports = [free_port() for _ in range(3)]
+        self.servers = []
+        for port in self.ports:
+            server = Server(port=port, bridges=[("localhost", p) for p in self.ports if p != port])
+            Thread(target=server.start, daemon=True).start()
+            self.servers.append(server)
+
+        self.assertTrue(wait_for(lambda: all(len(server.links()) == 2 for server in self.servers)))
+
+        self.clients = []
+        self.received = []
+        for port in self.ports:
+            received = queue.Queue()
+            client = Client()
+            client.on_message = lambda client, topic, body, received=received: received.put((topic, body))
+            client.connect("localhost", port).result(1)
+            self.clients.append(client)
+            self.received.append(received)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.disconnect()
+
+        for server in self.servers:
+            server.stop()
+
+    def remote_topics(self, i):
+        """Topics subscribed to on server i by its peers' links"""
+
+        return sorted(topic for client in self.servers[i].clients
+                      if client is not None and client.bridge is not None
+                      for topic in client.topics)
+
+    def drain(self, i):
+        msgs = []
+        while not self.received[i].empty():
+            msgs.append(self.received[i].get())
+
+        return msgs
+
+    def test_forward(self):
+        self.clients[1].subscribe("a/.*").result(1)
+        self.clients[2].subscribe("a/x").result(1)
+        self.assertTrue(wait_for(lambda: self.remote_topics(0) == ["a/.*", "a/x"]))
+
+        self.clients[0].publish("a/x", b"1").result(1)
+        self.clients[0].publish("b", b"2").result(1)
+        self.clients[1].publish("a/x", b"3").result(1)
+
+        # Delivered once to each subscriber, wherever it is connected
+        self.assertEqual(self.received[1].get(timeout=1), ("a/x", b"1"))
+        self.assertEqual(self.received[1].get(timeout=1), ("a/x", b"3"))
+        self.assertEqual(self.received[2].get(timeout=1), ("a/x", b"1"))
+        self.assertEqual(self.received[2].get(timeout=1), ("a/x", b"3"))
+
+        time.sleep(0.1)
+        self.assertEqual([self.drain(i) for i in range(3)], [[], [], []])
+
+    def test_stream(self):
+        self.clients[0].subscribe("a").result(1)
+        self.clients[1].subscribe("a").result(1)
+        self.assertTrue(wait_for(lambda: self.remote_topics(0) == ["a"]))
+
+        # Streams stay on the server they are published to
+        received = []
+        process_link_msg = self.servers[1].process_link_msg
+
+        def record(msg, link):
+            received.append(msg.type.type)
+            process_link_msg(msg, link)
+
+        with patch.object(self.servers[1], "process_link_msg", record):
+            self.assertEqual(self.clients[0].publish_stream("a", b"x" * 100, chunk_size=10).result(1), 0)
+            self.assertEqual(self.received[0].get(timeout=1), ("a", b"x" * 100))
+
+            # The link still works
+            self.clients[0].publish("a", b"1").result(1)
+            self.assertEqual(self.received[1].get(timeout=1), ("a", b"1"))
+
+        self.assertNotIn(CHUNK, received)
+        self.assertEqual(self.received[0].get(timeout=1), ("a", b"1"))
+        self.assertEqual(self.drain(1), [])
+
+    def test_interest(self):
+        self.clients[1].subscribe("a").result(1)
+        self.clients[2].subscribe("a").result(1)
+        self.assertTrue(wait_for(lambda: self.remote_topics(0) == ["a", "a"]))
+
+        # Links do not propagate the interest they receive
+        self.assertEqual(self.servers[0].interest, {})
+
+        self.clients[2].unsubscribe("a").result(1)
+        self.assertTrue(wait_for(lambda: self.remote_topics(0) == ["a"]))
+
+        self.clients[1].disconnect()
+        self.assertTrue(wait_for(lambda: self.remote_topics(0) == []))
+        self.clients.pop(1)
+
+    def test_reconnect(self):
+        self.clients[1].subscribe("a").result(1)
+        self.assertTrue(wait_for(lambda: self.remote_topics(0) == ["a"]))
+
+        # The interest summary is sent again when the link is reopened
+        link = next(link for link in self.servers[1].links() if link.link[1] == self.ports[0])
+        link.socket.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(wait_for(lambda: self.remote_topics(0) == [], 1))
+        self.assertTrue(wait_for(lambda: self.remote_topics(0) == ["a"], 3))
+
+        self.clients[0].publish("a", b"1").result(1)
+        self.assertEqual(self.received[1].get(timeout=1), ("a", b"1"))
+
+class TestBridgeSelf(unittest.TestCase):
+    def test_self(self):
+        port = free_port()
+        server = Server(port=port, bridges=[("localhost", port)])
+        Thread(target=server.start, daemon=True).start()
+
+        self.assertTrue(wait_for(lambda: server.state == State.RUNNING))
+        time.sleep(0.2)
+        self.assertEqual(server.links(), [])
+        server.stop()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -21,7 +21,7 @@ import sys
 
 sys.path.append("src")
 
-from dragonfly.bytes import ByteStream
+from dragonfly.bytes import ByteStream, SendQueue
 
 class TestByteStream(unittest.TestCase):
     def setUp(self):
@@ -74,4 +74,48 @@ class TestByteStream(unittest.TestCase):
     
     def test_read_eof(self):
         self.stream.seek(0)
-        self.assertEqual(self.stream.read(10), b"\x00\x01\x02\x03\x04\x05\x06\x07")
\ No newline at end of file
+        self.assertEqual(self.stream.read(10), b"\x00\x01\x02\x03\x04\x05\x06\x07")
+
+class FakeSocket:
+    def __init__(self, capacity=None):
+        self.writes = []
+        self.capacity = capacity
+
+    def send(self, bytes_):
+        if self.capacity == 0:
+            raise BlockingIOError()
+
+        bytes_ = bytes(bytes_)
+        if self.capacity is not None:
+            bytes_ = bytes_[:self.capacity]
+            self.capacity -= len(bytes_)
+
+        self.writes.append(bytes_)
+        return len(bytes_)
+
+class TestSendQueue(unittest.TestCase):
+    def test_coalesce(self):
+        queue = SendQueue(write_size=8)
+        for bytes_ in [b"ab", b"cd", b"efgh", b"ij"]:
+            queue.append(bytes_)
+
+        sock = FakeSocket()
+        queue.send(sock)
+        self.assertEqual(sock.writes, [b"abcdefgh", b"ij"])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.queued, 0)
+
+    def test_partial(self):
+        queue = SendQueue()
+        queue.append(b"abcd")
+        queue.append(b"ef")
+
+        sock = FakeSocket(capacity=3)
+        queue.send(sock)
+        self.assertEqual(sock.writes, [b"abc"])
+        self.assertEqual(queue.queued, 3)
+
+        sock.capacity = None
+        queue.send(sock)
+        self.assertEqual(sock.writes, [b"abc", b"def"])
+        self.assertEqual(queue.queued, 0)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from collections import deque
+import logging
+from queue import Queue
+import selectors
+import socket
+from threading import Thread, Timer
+import time
+from types import SimpleNamespace
+import unittest
+from unittest.mock import Mock, patch
+import sys
+
+sys.path.append("src")
+
+from dragonfly.client import Client, LastValueCache, MessageBuffer, State
+from dragonfly.dispatch import Dispatcher
+from dragonfly.message import BATCH, BATCHED, CONNECT, CONNECTED, FrameReader, Message, PING, PONG, PUBLISH, PUBLISHED, SUBSCRIBED, UNSUBSCRIBE, UNSUBSCRIBED, ORIGIN_CLIENT, ORIGIN_SERVER
+from tests.helpers import ServerTestCase
+
+class TestClientQueue(unittest.TestCase):
+    def setUp(self):
+        self.client = Client(flush_latency=60)
+        self.client.selector = selectors.DefaultSelector()
+        self.client.socket, self.peer = socket.socketpair()
+        self.client.socket.setblocking(False)
+        self.client.selector.register(self.client.socket, selectors.EVENT_READ, data=None)
+
+    def tearDown(self):
+        self.client.selector.close()
+        self.client.socket.close()
+        self.peer.close()
+
+    def received(self, n):
+        self.peer.settimeout(1)
+        reader = FrameReader()
+        msgs = []
+        while len(msgs) < n:
+            for frame in reader.feed(self.peer.recv(1 << 20)):
+                msg = Message()
+                msg.from_bytes(frame)
+                msgs.append(msg)
+
+        return msgs
+
+    def publish(self, topic, n):
+        for i in range(n):
+            self.client.publish(topic, str(i))
+
+    def test_concurrent(self):
+        threads = [Thread(target=self.publish, args=(t, 100)) for t in "abcd"]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        # Nothing written until flushed
+        self.assertEqual(self.client.flush_delay() > 0, True)
+        self.client.flush()
+
+        msgs = self.received(400)
+        self.assertEqual(len(msgs), 400)
+        for topic in "abcd":
+            bodies = [msg.body for msg in msgs if msg.topic == topic]
+            self.assertEqual(bodies, [str(i) for i in range(100)])
+
+    def test_malformed(self):
+        # Unknown topic alias: decoding stops half way
+        frame = Message(ORIGIN_SERVER, PUBLISH, topic="a", body="x", alias=(3, False)).to_bytes()
+        self.peer.sendall(frame + Message(ORIGIN_SERVER, PUBLISH, topic="a", body="y").to_bytes())
+
+        key = SimpleNamespace(fileobj=self.client.socket, data=SimpleNamespace(handshaking=False, reader=FrameReader(), addr="peer"))
+        with self.assertLogs("dragonfly", logging.WARNING), patch.object(self.client, "process_msg") as process_msg:
+            self.client.handle_msg(key, selectors.EVENT_READ)
+
+        process_msg.assert_called_once()
+        self.assertEqual(process_msg.call_args.args[0].body, "y")
+
+    def test_flush_size(self):
+        self.client.publish("a", "x" * 70000)
+        self.assertEqual(self.client.flush_delay(), 0)
+
+    def test_unencodable(self):
+        self.client.aliases.max_outbound = 10
+        with self.assertLogs("dragonfly", logging.ERROR):
+            future = self.client.publish("a" * 70000, "x")
+
+        self.assertIsInstance(future.exception(0), ValueError)
+        self.assertEqual(self.client.aliases.outbound, {})
+
+        # The next ack resolves the next request
+        pub = self.client.publish("a", "x")
+        self.client.process_msg(Message(ORIGIN_SERVER, PUBLISHED, code=0))
+        self.assertEqual(pub.result(0), 0)
+        self.assertEqual(self.client.aliases.outbound, {"a": 0})
+
+    def test_futures(self):
+        subs = [self.client.subscribe(topic) for topic in "ab"]
+        pub = self.client.publish("a", "x")
+        batch = self.client.subscribe_many(["c", "d"])
+
+        self.client.process_msg(Message(ORIGIN_SERVER, SUBSCRIBED, code=0))
+        self.client.process_msg(Message(ORIGIN_SERVER, BATCHED, codes=[0, 1]))
+        self.client.process_msg(Message(ORIGIN_SERVER, SUBSCRIBED, code=1))
+
+        self.assertEqual([f.result(0) for f in subs], [0, 1])
+        self.assertEqual(batch.result(0), [0, 1])
+        self.assertFalse(pub.done())
+
+class TestMessageBuffer(unittest.TestCase):
+    def test_get(self):
+        buffer = MessageBuffer(10)
+        for i in range(5):
+            buffer.put(i)
+
+        self.assertEqual(buffer.get(3, 0), [0, 1, 2])
+        self.assertEqual(buffer.get(3, 0.01), [3, 4])
+        self.assertEqual(buffer.get(3, 0), [])
+
+    def test_close(self):
+        buffer = MessageBuffer(1)
+        buffer.put(0)
+        Thread(target=buffer.close).start()
+        self.assertEqual(buffer.get(2), [0])
+
+    def test_iter_messages(self):
+        client = Client(max_buffered=10)
+        client.process_msg(Message(ORIGIN_SERVER, PUBLISH, topic="a", body="0"))
+        client.process_msg(Message(ORIGIN_SERVER, PUBLISH, topic="b", body="1"))
+
+        self.assertEqual(list(client.iter_messages(timeout=0.01)), [("a", "0"), ("b", "1")])
+
+class TestClientBuffer(ServerTestCase):
+    def setUp(self):
+        self.server = self.start_server()
+
+        self.client = Client(max_buffered=2)
+        self.assertEqual(self.client.connect(self.server).result(1), 0)
+        self.assertEqual(self.client.subscribe("a").result(1), 0)
+
+        self.publisher = Client()
+        self.publisher.connect(self.server).result(1)
+        for i in range(5):
+            self.publisher.publish("a", str(i))
+
+    def tearDown(self):
+        self.publisher.disconnect()
+
+    def wait_buffered(self, n):
+        deadline = time.monotonic() + 1
+        while len(self.client.inbox) < n and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_paused(self):
+        self.wait_buffered(2)
+        self.assertFalse(self.client.reading)
+        self.assertEqual([body for _, body in self.client.get_batch(5, 1)], [str(i) for i in range(5)])
+
+        self.client.disconnect()
+
+    def test_disconnect_full(self):
+        self.wait_buffered(2)
+
+        thread = Thread(target=self.client.disconnect)
+        thread.start()
+        thread.join(1)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.client.state, State.STOPPED)
+
+class TestClientDispatcher(ServerTestCase):
+    def setUp(self):
+        self.server = self.start_server()
+
+    def test_reconnect(self):
+        dispatcher = Dispatcher(workers=2)
+        client = Client(dispatcher=dispatcher)
+        received = Queue()
+        client.on_message = lambda client, topic, body: received.put(body)
+
+        for body in ["1", "2"]:
+            self.assertEqual(client.connect(self.server).result(1), 0)
+            self.assertEqual(client.subscribe("a").result(1), 0)
+            self.assertEqual(client.publish("a", body).result(1), 0)
+            self.assertEqual(received.get(timeout=1), body)
+            client.disconnect()
+
+        dispatcher.join(1)
+        self.assertEqual(dispatcher.metrics()["dispatched"], 2)
+
+class TestClientHandlers(unittest.TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.calls = []
+
+    def handler(self, name):
+        return lambda client, topic, msg: self.calls.append((name, topic, msg))
+
+    def receive(self, topic):
+        self.client.process_msg(Message(ORIGIN_SERVER, PUBLISH, topic=topic, body="x"))
+
+    def test_route(self):
+        self.client.add_handler("sensor/.*/temp", self.handler("temp"))
+        self.client.add_handler("sensor/", self.handler("sensor"))
+
+        self.receive("sensor/a/temp")
+        self.receive("sensor/b/hum")
+        self.receive("other")
+        self.receive("sensor/a/temp")
+
+        self.assertEqual(self.calls, [
+            ("temp", "sensor/a/temp", "x"), ("sensor", "sensor/a/temp", "x"),
+            ("sensor", "sensor/b/hum", "x"),
+            ("temp", "sensor/a/temp", "x"), ("sensor", "sensor/a/temp", "x")
+        ])
+        self.assertEqual(self.client.routes["other"], [])
+
+    def test_remove(self):
+        handler = self.handler("a")
+        self.client.add_handler("a", handler)
+        self.receive("a")
+        self.client.remove_handler("a", handler)
+        self.receive("a")
+
+        self.assertEqual(self.calls, [("a", "a", "x")])
+
+class TestClientReconnect(unittest.TestCase):
+    setUp = TestClientQueue.setUp
+    tearDown = TestClientQueue.tearDown
+    received = TestClientQueue.received
+
+    def test_offline(self):
+        self.client.max_offline = 4
+        self.client.subscribe("a")
+        self.client.state = State.RECONNECTING
+
+        futures = [self.client.publish("a", str(i)) for i in range(3)]
+        futures.append(self.client.unsubscribe("a"))
+        dropped = self.client.publish("a", "3")
+
+        self.assertEqual(len(self.client.offline), 4)
+        self.assertIsInstance(dropped.exception(0), BufferError)
+        self.assertEqual(list(self.client.subscriptions), [])
+
+        self.client.state = State.RUNNING
+        offline, self.client.offline = self.client.offline, deque()
+        self.client.send_offline(offline)
+        self.client.flush()
+
+        msgs = self.received(2)
+        self.assertEqual(msgs[1].type.type, BATCH)
+        self.assertEqual([sub.type.type for sub in msgs[1].messages], [PUBLISH] * 3 + [UNSUBSCRIBE])
+
+        self.client.process_msg(Message(ORIGIN_SERVER, BATCHED, codes=[0, 0, 0x81, 0]))
+        self.assertEqual([f.result(0) for f in futures], [0, 0, 0x81, 0])
+
+    def test_track_acked(self):
+        self.client.subscribe("a")
+        self.client.subscribe("nsp")
+        self.client.subscribe_many(["b", "c"])
+        self.assertEqual(self.client.subscriptions, {})
+
+        self.client.process_msg(Message(ORIGIN_SERVER, SUBSCRIBED, code=0))
+        self.client.process_msg(Message(ORIGIN_SERVER, SUBSCRIBED, code=0x81))
+        self.client.process_msg(Message(ORIGIN_SERVER, BATCHED, codes=[0x01, 0x81]))
+        self.assertEqual(list(self.client.subscriptions), ["a", "b"])
+
+        self.client.unsubscribe("a")
+        self.assertEqual(list(self.client.subscriptions), ["a", "b"])
+        self.client.process_msg(Message(ORIGIN_SERVER, UNSUBSCRIBED, code=0))
+        self.assertEqual(list(self.client.subscriptions), ["b"])
+
+    def test_refused(self):
+        self.client.disconnected = Mock()
+        self.client.on_disconnected = Mock()
+        future = self.client.send(Message(ORIGIN_CLIENT, CONNECT, username="a"), CONNECTED)
+
+        # Not retried: the server closes the connection
+        self.client.process_msg(Message(ORIGIN_SERVER, CONNECTED, code=0x81))
+        self.assertEqual(future.result(0), 0x81)
+        self.client.disconnected.assert_called_once_with()
+        self.client.on_disconnected.assert_called_once_with(self.client, 0x81)
+
+class TestClientKeepalive(unittest.TestCase):
+    setUp = TestClientQueue.setUp
+    tearDown = TestClientQueue.tearDown
+    received = TestClientQueue.received
+
+    def test_ping(self):
+        client = self.client
+        client.state = State.RUNNING
+        client.flush_latency = 0
+        client.keepalive_interval = 10
+        client.last_sent = client.last_received = 0
+
+        with patch("dragonfly.client.time.monotonic", return_value=4):
+            self.assertEqual(client.keepalive_delay(), 6)
+
+        # Idle: pings and waits for an answer
+        with patch("dragonfly.client.time.monotonic", return_value=10):
+            client.keep_alive()
+            client.flush()
+            self.assertTrue(client.pinged)
+            self.assertEqual(client.keepalive_delay(), 5)
+
+        self.assertEqual(self.received(1)[0].type.type, PING)
+
+        # Unanswered
+        with patch.object(client, "connection_lost") as connection_lost:
+            client.keep_alive()
+            connection_lost.assert_called_once()
+
+    def test_pong(self):
+        self.client.state = State.RUNNING
+        self.client.process_msg(Message(ORIGIN_SERVER, PING))
+        self.client.flush()
+
+        self.assertEqual(self.received(1)[0].type.type, PONG)
+
+class TestLastValueCache(unittest.TestCase):
+    def test_lru(self):
+        cache = LastValueCache(2)
+        cache.update("a", "1")
+        cache.update("b", "2")
+        self.assertEqual(cache.get("a"), "1")
+
+        cache.update("c", "3")
+        self.assertEqual(cache.get("b", "-"), "-")
+        self.assertEqual(cache.get("a"), "1")
+        self.assertEqual(cache.get("c"), "3")
+
+    def test_wait_for_update(self):
+        cache = LastValueCache(10)
+        cache.update("a", "1")
+        self.assertIsNone(cache.wait_for_update("a", 0.01))
+
+        timer = Timer(0.01, cache.update, ("a", "2"))
+        timer.start()
+        self.assertEqual(cache.wait_for_update("a", 1), "2")
+
+    def test_client(self):
+        client = Client(cache_size=10)
+        client.process_msg(Message(ORIGIN_SERVER, PUBLISH, topic="a", body="0"))
+        client.process_msg(Message(ORIGIN_SERVER, PUBLISH, topic="a", body="1"))
+
+        self.assertEqual(client.get("a"), "1")
+        self.assertIsNone(client.get("b"))
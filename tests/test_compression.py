@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import unittest
+import sys
+
+sys.path.append("src")
+
+from dragonfly.bytes import ByteStream
+from dragonfly import compression
+from dragonfly.exceptions import InvalidPayload, UnsupportedCodec
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip(self):
+        data = b"dragonfly " * 100
+        for name in compression.CODECS:
+            with self.subTest(codec=name):
+                packed = compression.compress(name, data)
+                self.assertLess(len(packed), len(data))
+                self.assertEqual(compression.decompress(name, packed), data)
+
+    def test_corrupt(self):
+        data = b"dragonfly " * 100
+        for name in compression.CODECS:
+            with self.subTest(codec=name):
+                packed = compression.compress(name, data)
+                with self.assertRaises(InvalidPayload):
+                    compression.decompress(name, packed[:-8] + bytes(8))
+
+                with self.assertRaises(InvalidPayload):
+                    compression.decompress(name, packed[:len(packed) // 2])
+
+    def test_max_size(self):
+        data = bytes(1 << 20)
+        for name in compression.CODECS:
+            with self.subTest(codec=name):
+                packed = compression.compress(name, data)
+                self.assertEqual(compression.decompress(name, packed, len(data)), data)
+                with self.assertRaises(InvalidPayload):
+                    compression.decompress(name, packed, len(data) - 1)
+
+    def test_ids(self):
+        for name in compression.CODECS:
+            with self.subTest(codec=name):
+                self.assertEqual(compression.codec_name(compression.codec_id(name)), name)
+
+    def test_unsupported(self):
+        with self.assertRaises(UnsupportedCodec):
+            compression.codec_id("foo")
+
+        with self.assertRaises(UnsupportedCodec):
+            compression.codec_name(0)
+
+    def test_negotiate(self):
+        self.assertEqual(compression.negotiate(["foo", "zlib"]), "zlib")
+        self.assertEqual(compression.negotiate(["zlib"], ["lzma"]), None)
+        self.assertEqual(compression.negotiate([]), None)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from threading import Event, Thread
+import unittest
+import sys
+
+sys.path.append("src")
+
+from dragonfly.dispatch import Dispatcher, Overflow
+
+class TestDispatcher(unittest.TestCase):
+    def test_order(self):
+        dispatcher = Dispatcher(workers=3)
+        dispatcher.start()
+        calls = []
+        for i in range(100):
+            for topic in "abcd":
+                dispatcher.submit(topic, calls.append, (topic, i))
+
+        dispatcher.stop()
+        dispatcher.join()
+
+        for topic in "abcd":
+            self.assertEqual([i for t, i in calls if t == topic], list(range(100)))
+
+        self.assertEqual(dispatcher.metrics()["dispatched"], 400)
+
+    def test_overflow(self):
+        for overflow, expected in [(Overflow.DROP_NEW, [0, 1, 2]), (Overflow.DROP_OLDEST, [0, 3, 4])]:
+            with self.subTest(overflow=overflow):
+                dispatcher = Dispatcher(workers=1, max_queue=2, overflow=overflow)
+                dispatcher.start()
+                blocked, release = Event(), Event()
+                calls = []
+
+                def call(i):
+                    calls.append(i)
+                    if i == 0:
+                        blocked.set()
+                        release.wait()
+
+                dispatcher.submit("a", call, 0)
+                blocked.wait()
+                for i in range(1, 5):
+                    dispatcher.submit("a", call, i)
+
+                self.assertEqual(dispatcher.depths(), [2])
+                self.assertEqual(dispatcher.metrics()["dropped"], 2)
+
+                release.set()
+                dispatcher.stop()
+                dispatcher.join()
+                self.assertEqual(calls, expected)
+
+    def test_block_stopped(self):
+        dispatcher = Dispatcher(workers=1, max_queue=1, overflow=Overflow.BLOCK)
+        dispatcher.start()
+        blocked, release = Event(), Event()
+        calls, errors = [], []
+
+        def call(i):
+            calls.append(i)
+            if i == 0:
+                blocked.set()
+                release.wait()
+
+        def submit():
+            try:
+                dispatcher.submit("a", call, 2)
+
+            except RuntimeError as e:
+                errors.append(e)
+
+        dispatcher.submit("a", call, 0)
+        blocked.wait()
+        dispatcher.submit("a", call, 1)
+
+        thread = Thread(target=submit)
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        # Stopping wakes the blocked submitter up without queueing its callback
+        dispatcher.stop()
+        thread.join(1)
+        self.assertEqual(len(errors), 1)
+
+        release.set()
+        dispatcher.join()
+        self.assertEqual(calls, [0, 1])
+
+    def test_restart(self):
+        dispatcher = Dispatcher(workers=2)
+        calls = []
+        for _ in range(2):
+            dispatcher.start()
+            dispatcher.submit("a", calls.append, 1)
+            dispatcher.stop()
+            dispatcher.join()
+            self.assertRaises(RuntimeError, dispatcher.submit, "a", calls.append, 2)
+
+        self.assertEqual(calls, [1, 1])
+
+    def test_shared(self):
+        dispatcher = Dispatcher(workers=1)
+        dispatcher.start()
+        dispatcher.start()
+        dispatcher.stop()
+
+        calls = []
+        dispatcher.submit("a", calls.append, 1)
+        dispatcher.stop()
+        dispatcher.join()
+        self.assertEqual(calls, [1])
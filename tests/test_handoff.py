@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import os
+import queue
+import shutil
+import socket
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.append("src")
+
+from dragonfly import handoff
+from dragonfly.client import Client
+from dragonfly.message import CHUNK, CHUNK_FIRST, FrameReader, Message, ORIGIN_CLIENT, SUBSCRIBE
+from dragonfly.server import Server, State
+from tests.helpers import ServerTestCase
+
+class TestHandoffState(unittest.TestCase):
+    def setUp(self):
+        self.old = Server(port=0)
+        self.new = Server(port=0)
+        self.peers = []
+
+    def tearDown(self):
+        for server in [self.old, self.new]:
+            for client in server.clients:
+                if client is not None and client.conn is client:
+                    client.socket.close()
+
+            server.socket.close()
+
+        for peer in self.peers:
+            peer.close()
+
+    def new_client(self):
+        sock, peer = socket.socketpair()
+        self.peers.append(peer)
+        client = self.old.new_client(sock)
+        client.data = types.SimpleNamespace(addr=("localhost", 1234), reader=FrameReader(), id=client.id)
+        client.connected = True
+
+        return client
+
+    def test_round_trip(self):
+        pub, sub = self.new_client(), self.new_client()
+        session = self.old.new_session(sub, 3)
+        session.connected = True
+
+        for client in [sub, session]:
+            self.old.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="a"), client)
+
+        sub.aliases.max_outbound = 4
+        sub.aliases.assign("a")
+        self.old.chunk(Message(ORIGIN_CLIENT, CHUNK, CHUNK_FIRST, stream_id=7, topic="a", data=b"1"), pub)
+
+        # Half-received frame and unsent bytes
+        frame = Message(ORIGIN_CLIENT, SUBSCRIBE, topic="b").to_bytes()
+        pub.data.reader.feed(frame[:5])
+        pub.queue.append(b"pending")
+
+        state, fds = self.old.save([pub, sub])
+        state = json.loads(json.dumps(state))
+        self.assertEqual(len(fds), 3)
+
+        socks = [socket.socket(fileno=os.dup(fd)) for fd in fds]
+        socks[state["listeners"]["tcp"]].close()
+        self.new.restore(state, socks)
+
+        new_pub, new_sub = self.new.clients[0], self.new.clients[1]
+        new_session = new_sub.sessions[3]
+        self.assertEqual(self.new.topics, {"a": [new_sub.id, new_session.id]})
+        self.assertEqual(new_sub.aliases.outbound, {"a": 0})
+        self.assertEqual(new_pub.queued, len(b"pending"))
+
+        # Streams keep relaying to the same subscribers
+        stream = new_pub.streams[7]
+        self.assertEqual(stream.id, self.old.next_stream_id)
+        self.assertEqual(stream.subscribers, [new_sub, new_session])
+
+        # The frame is completed by the next bytes
+        self.assertEqual(new_pub.data.reader.feed(frame[5:]), [frame])
+
+class TestHandoff(ServerTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, "handoff.sock")
+
+    def start(self, **kwargs):
+        server = Server(port=0, handoff_path=self.path, **kwargs)
+        return server, self.run_server(server)
+
+    def test_handoff(self):
+        old, thread = self.start()
+        port = old.socket.getsockname()[1]
+
+        received = queue.Queue()
+        client = Client()
+        client.on_message = lambda client, topic, body: received.put((topic, body))
+        client.on_disconnected = lambda client, code: received.put(None)
+
+        self.assertEqual(client.connect("localhost", port).result(1), 0)
+        self.assertEqual(client.subscribe("a").result(1), 0)
+
+        new, _ = self.start()
+        thread.join(1)
+        self.assertEqual(old.state, State.STOPPED)
+        self.assertEqual(new.socket.getsockname()[1], port)
+
+        # Same connection and subscriptions
+        self.assertEqual(client.publish("a", b"hello").result(1), 0)
+        self.assertEqual(received.get(timeout=1), ("a", b"hello"))
+        self.assertEqual(new.connections, 1)
+
+        client.disconnect()
+
+    def test_silent_successor(self):
+        old, thread = self.start()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control:
+            control.connect(self.path)
+
+            # Clients are served while the request is awaited
+            client = Client()
+            self.assertEqual(client.connect("localhost", old.socket.getsockname()[1]).result(1), 0)
+            self.assertEqual(client.subscribe("a").result(1), 0)
+            client.disconnect()
+
+            # The request completes the handoff once received
+            control.sendall(handoff.REQUEST.pack(handoff.VERSION, 0))
+            control.settimeout(1)
+            version, _, _ = handoff.HEADER.unpack(handoff.recv_exactly(control, handoff.HEADER.size))
+            self.assertEqual(version, handoff.VERSION)
+
+    def test_without_clients(self):
+        old, thread = self.start()
+        client = Client()
+        lost = queue.Queue()
+        client.on_disconnected = lambda client, code: lost.put(code)
+        client.connect("localhost", old.socket.getsockname()[1]).result(1)
+
+        new, _ = self.start(handoff_clients=False)
+        thread.join(1)
+
+        self.assertIsNone(lost.get(timeout=1))
+        self.assertEqual(new.connections, 0)
+        self.assertTrue(os.path.exists(self.path))
+
+if __name__ == "__main__":
+    unittest.main()
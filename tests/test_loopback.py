@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import queue
+import unittest
+from unittest.mock import patch
+import sys
+
+sys.path.append("src")
+
+from dragonfly import loopback
+from dragonfly.client import Client
+from tests.helpers import ServerTestCase
+
+class TestPipe(unittest.TestCase):
+    def test_read_write(self):
+        pipe = loopback.Pipe(8)
+        self.assertEqual(pipe.write(b"abc"), 3)
+        self.assertEqual(pipe.write(memoryview(b"defghijk")), 5)
+        self.assertEqual(pipe.free(), 0)
+
+        # Reads split chunks
+        self.assertEqual(pipe.read(4), b"abcd")
+        self.assertEqual(pipe.read(100), b"efgh")
+        self.assertEqual(len(pipe), 0)
+
+class TestHub(unittest.TestCase):
+    def setUp(self):
+        self.hub = loopback.Hub(capacity=16)
+        self.client = self.hub.connect()
+        self.server, = self.hub.accept()
+        self.hub.register(self.server, 1, data="data")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        self.hub.close()
+
+    def test_select(self):
+        # Registering marks the socket as ready
+        self.assertEqual([key.data for key, mask in self.hub.select()], ["data"])
+        self.assertEqual(list(self.hub.select()), [])
+
+        self.client.send(b"abc")
+        self.client.send(b"def")
+        self.assertEqual(len(list(self.hub.select())), 1)
+        self.assertEqual(self.server.recv(64), b"abcdef")
+
+        self.hub.unregister(self.server)
+        self.client.send(b"ghi")
+        self.assertEqual(list(self.hub.select()), [])
+
+    def test_signal_once(self):
+        list(self.hub.select())
+
+        # Server side: the hub is signaled once until selected
+        with patch.object(self.hub.wakeup, "signal", wraps=self.hub.wakeup.signal) as signal:
+            for _ in range(3):
+                self.client.send(b"abc")
+
+            self.assertEqual(signal.call_count, 1)
+            self.assertEqual(len(list(self.hub.select())), 1)
+            self.assertEqual(self.server.recv(64), b"abc" * 3)
+
+            self.client.send(b"def")
+            self.assertEqual(signal.call_count, 2)
+
+        # Client side: drained once the pipe is empty
+        wakeup = self.client.wakeup.wakeup
+        with patch.object(wakeup, "signal", wraps=wakeup.signal) as signal, \
+             patch.object(wakeup, "drain", wraps=wakeup.drain) as drain:
+            for _ in range(3):
+                self.server.send(b"x")
+
+            self.assertEqual(signal.call_count, 1)
+            self.assertEqual(self.client.recv(2), b"xx")
+            drain.assert_not_called()
+            self.assertEqual(self.client.recv(64), b"x")
+            drain.assert_called_once()
+            self.assertRaises(BlockingIOError, self.client.recv, 64)
+            drain.assert_called_once()
+
+    def test_full(self):
+        self.assertEqual(self.server.send(b"x" * 20), 16)
+        self.assertRaises(BlockingIOError, self.server.send, b"y")
+
+        # Reading frees room and wakes the writer up
+        list(self.hub.select())
+        self.assertEqual(self.client.recv(8), b"x" * 8)
+        self.assertEqual(len(list(self.hub.select())), 1)
+        self.assertEqual(self.server.send(b"y" * 8), 8)
+
+    def test_close(self):
+        self.client.send(b"bye")
+        self.client.close()
+
+        self.assertEqual(self.server.recv(64), b"bye")
+        self.assertEqual(self.server.recv(64), b"")
+        self.assertRaises(BrokenPipeError, self.server.send, b"x")
+
+    def test_closed_hub(self):
+        self.hub.close()
+        self.assertRaises(ConnectionRefusedError, self.hub.connect)
+
+class TestLoopbackClient(ServerTestCase):
+    def setUp(self):
+        self.server = self.start_server()
+
+    def test_pubsub(self):
+        received = queue.Queue()
+        client = Client()
+        client.on_message = lambda client, topic, body: received.put((topic, body))
+
+        self.assertEqual(client.connect(self.server).result(1), 0)
+
+        # Signaled through the client's own wakeup socket
+        self.assertEqual(client.socket.fileno(), client.wakeup_r.fileno())
+        self.assertEqual([key.fileobj for key in client.selector.get_map().values()], [client.wakeup_r])
+
+        self.assertEqual(client.subscribe("a").result(1), 0)
+        self.assertEqual(client.publish("a", b"hello").result(1), 0)
+        self.assertEqual(received.get(timeout=1), ("a", b"hello"))
+
+        client.disconnect()
+        self.assertTrue(client.doorbell.closed)
+
+if __name__ == "__main__":
+    unittest.main()
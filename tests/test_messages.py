@@ -26,7 +26,9 @@ sys.path.append("src")
 from dragonfly.exceptions import InvalidMessageType
 from dragonfly.message import ORIGIN_SERVER, ORIGIN_CLIENT
 from dragonfly.message import CONNECT, CONNECTED, PUBLISH, PUBLISHED, SUBSCRIBE, SUBSCRIBED, UNSUBSCRIBE, UNSUBSCRIBED
-from dragonfly.message import Message, MessageType, type_name
+from dragonfly.message import BATCH, BATCHED, PING, PONG, PUBLISH_BINARY, PUBLISH_COMPRESSED, SESSION
+from dragonfly.exceptions import InvalidTopicAlias
+from dragonfly.message import FrameReader, Message, MessageType, TopicAliases, type_name
 
 class TestMessageDefaults(unittest.TestCase):
     def setUp(self):
@@ -84,11 +86,11 @@ class TestMessageEncoding(unittest.TestCase):
     def test_encode_origin(self):
         with self.subTest(origin=ORIGIN_SERVER):
             msg = Message(origin=ORIGIN_SERVER)
-            self.assertEqual(msg.to_bytes(), b"\x00\x00\x00\x00\x00\x00\x00")
+            self.assertEqual(msg.to_bytes(), b"\x00\x01\x00\x00\x00\x00\x00")
         
         with self.subTest(origin=ORIGIN_CLIENT):
             msg = Message(origin=ORIGIN_CLIENT)
-            self.assertEqual(msg.to_bytes(), b"\x00\x00\x80\x00\x00\x00\x00")
+            self.assertEqual(msg.to_bytes(), b"\x00\x01\x80\x00\x00\x00\x00")
 
     def test_encode_type(self):
         types = [CONNECT, CONNECTED, PUBLISH, PUBLISHED, SUBSCRIBE, SUBSCRIBED, UNSUBSCRIBE, UNSUBSCRIBED]
@@ -99,13 +101,13 @@ class TestMessageEncoding(unittest.TestCase):
                 b = (t << 4).to_bytes(1, "big")
                 length = 1
                 if t == PUBLISH:
-                    length = 4
+                    length = 6
                 elif t == CONNECT:
                     length = 0
                 elif t in [SUBSCRIBE, UNSUBSCRIBE]:
                     length = 2
                 
-                self.assertEqual(msg.to_bytes(), b"\x00\x00"+b+struct.pack(">I", length)+b"\x00"*length)
+                self.assertEqual(msg.to_bytes(), b"\x00\x01"+b+struct.pack(">I", length)+b"\x00"*length)
     
     def test_decode_connect(self):
         bytes_ = b"\x00\x00\x00\x00\x00\x00\x00"
@@ -200,37 +202,155 @@ class TestMessageEncoding(unittest.TestCase):
 
 
     def test_encode_connect(self):
-        bytes_ = b"\x00\x00\x00\x00\x00\x00\x00"
+        bytes_ = b"\x00\x01\x00\x00\x00\x00\x00"
         msg = Message(type_=CONNECT)
         self.assertEqual(msg.to_bytes(), bytes_)
 
     def test_encode_connect_username_password(self):
-        bytes_ = b"\x00\x00\x03\x00\x00\x00\x0b\x00\x04\x55\x73\x65\x72\x00\x03\x50\x77\x64"
+        bytes_ = b"\x00\x01\x03\x00\x00\x00\x0b\x00\x04\x55\x73\x65\x72\x00\x03\x50\x77\x64"
         msg = Message(type_=CONNECT, username="User", password="Pwd")
         self.assertEqual(msg.to_bytes(), bytes_)
     
     def test_encode_connect_username(self):
-        bytes_ = b"\x00\x00\x02\x00\x00\x00\x06\x00\x04\x55\x73\x65\x72"
+        bytes_ = b"\x00\x01\x02\x00\x00\x00\x06\x00\x04\x55\x73\x65\x72"
         msg = Message(type_=CONNECT, username="User")
         self.assertEqual(msg.to_bytes(), bytes_)
     
     def test_encode_connect_password(self):
-        bytes_ = b"\x00\x00\x01\x00\x00\x00\x05\x00\x03\x50\x77\x64"
+        bytes_ = b"\x00\x01\x01\x00\x00\x00\x05\x00\x03\x50\x77\x64"
         msg = Message(type_=CONNECT, password="Pwd")
         self.assertEqual(msg.to_bytes(), bytes_)
 
     def test_encode_publish(self):
-        bytes_ = b"\x00\x00\x20\x00\x00\x00\x09\x00\x01\x2e\x00\x04\x42\x6f\x64\x79"
+        # type: PUBLISH / length: 11 / topic: . / body: Body
+        bytes_ = b"\x00\x01\x20\x00\x00\x00\x0b\x00\x01\x2e\x00\x00\x00\x04\x42\x6f\x64\x79"
         msg = Message(type_=PUBLISH, topic=".", body="Body")
         self.assertEqual(msg.to_bytes(), bytes_)
 
+    def test_encode_publish_v0(self):
+        bytes_ = b"\x00\x00\x20\x00\x00\x00\x09\x00\x01\x2e\x00\x04\x42\x6f\x64\x79"
+        msg = Message(type_=PUBLISH, topic=".", body="Body", version=0)
+        self.assertEqual(msg.to_bytes(), bytes_)
+
+    def test_encode_publish_binary(self):
+        # type: PUBLISH, binary / length: 10 / topic: . / body: \x00\xff\x01
+        bytes_ = b"\x00\x01\x21\x00\x00\x00\x0a\x00\x01\x2e\x00\x00\x00\x03\x00\xff\x01"
+        for body in [b"\x00\xff\x01", bytearray(b"\x00\xff\x01"), memoryview(b"\x00\xff\x01")]:
+            with self.subTest(body=type(body)):
+                msg = Message(type_=PUBLISH, topic=".", body=body)
+                self.assertEqual(msg.to_bytes(), bytes_)
+
+    def test_decode_publish_binary(self):
+        bytes_ = b"\x00\x01\x21\x00\x00\x00\x0a\x00\x01\x2e\x00\x00\x00\x03\x00\xff\x01"
+        msg = Message()
+        self.assertTrue(msg.from_bytes(bytes_))
+        self.assertEqual(msg.topic, ".")
+        self.assertEqual(msg.body, b"\x00\xff\x01")
+
+    def test_publish_large_body(self):
+        body = b"\x2a" * 0x20000
+        msg = Message()
+        msg.from_bytes(Message(type_=PUBLISH, topic=".", body=body).to_bytes())
+        self.assertEqual(msg.body, body)
+
+    def test_non_ascii_length(self):
+        for version in [0, Message.VERSION]:
+            with self.subTest(version=version):
+                msg = Message()
+                msg.from_bytes(Message(type_=PUBLISH, topic="é", body="ü€", version=version).to_bytes())
+                self.assertEqual(msg.topic, "é")
+                self.assertEqual(msg.body, "ü€")
+
+    def test_connect_properties(self):
+        msg = Message(type_=CONNECT, username="User", properties={"a": "b", "c": 1})
+        bytes_ = msg.to_bytes()
+        self.assertEqual(bytes_[-12:], b"\x00\x01a\x00\x01b\x00\x01c\x00\x011")
+
+        msg = Message()
+        msg.from_bytes(bytes_)
+        self.assertEqual(msg.username, "User")
+        self.assertEqual(msg.properties, {"a": "b", "c": "1"})
+
+    def test_connected_properties(self):
+        msg = Message()
+        msg.from_bytes(Message(type_=CONNECTED, code=0, properties={"a": "b"}).to_bytes())
+        self.assertEqual(msg.code, 0)
+        self.assertEqual(msg.properties, {"a": "b"})
+
+    def test_compressed_publish(self):
+        for body in ["Body " * 100, b"\x00\x01" * 200]:
+            with self.subTest(body=type(body)):
+                bytes_ = Message(type_=PUBLISH, topic=".", body=body, codec="zlib").to_bytes()
+                self.assertLess(len(bytes_), len(body))
+
+                msg = Message()
+                msg.from_bytes(bytes_)
+                self.assertTrue(msg.type.flags & PUBLISH_COMPRESSED)
+                self.assertFalse("_body" in msg.__dict__)
+                self.assertEqual(msg.body, body)
+
+    def test_compressed_forward(self):
+        msg = Message()
+        msg.from_bytes(Message(type_=PUBLISH, topic=".", body="Body " * 100, codec="zlib").to_bytes())
+        msg.codec = "zlib"
+        msg.to_bytes()
+        self.assertFalse("_body" in msg.__dict__)
+
+    def test_compression_threshold(self):
+        msg = Message(type_=PUBLISH, topic=".", body="Body", codec="zlib")
+        msg.to_bytes()
+        self.assertFalse(msg.type.flags & PUBLISH_COMPRESSED)
+
+        msg = Message(type_=PUBLISH, topic=".", body=bytes(range(256)), codec="zlib", threshold=0)
+        msg.to_bytes()
+        self.assertFalse(msg.type.flags & PUBLISH_COMPRESSED)
+        self.assertTrue(msg.type.flags & PUBLISH_BINARY)
+
+    def test_unsupported_codec(self):
+        # type: PUBLISH, compressed / length: 8 / topic: . / codec: 255
+        with self.assertLogs("dragonfly", logging.ERROR):
+            msg = Message()
+            self.assertFalse(msg.from_bytes(b"\x00\x01\x22\x00\x00\x00\x08\x00\x01\x2e\x00\x00\x00\x01\xff"))
+
+    def test_encode_alias(self):
+        # type: PUBLISH, alias / length: 10 / alias: 0, defined / topic: . / body: 1
+        bytes_ = b"\x00\x01\x24\x00\x00\x00\x0a\x80\x00\x00\x01\x2e\x00\x00\x00\x01\x31"
+        msg = Message(type_=PUBLISH, topic=".", body="1", alias=(0, True))
+        self.assertEqual(msg.to_bytes(), bytes_)
+
+        # type: PUBLISH, alias / length: 7 / alias: 0 / body: 1
+        bytes_ = b"\x00\x01\x24\x00\x00\x00\x07\x00\x00\x00\x00\x00\x01\x31"
+        msg = Message(type_=PUBLISH, topic=".", body="1", alias=(0, False))
+        self.assertEqual(msg.to_bytes(), bytes_)
+
+    def test_decode_alias(self):
+        aliases = TopicAliases(1)
+        msg = Message()
+        msg.from_bytes(b"\x00\x01\x24\x00\x00\x00\x0a\x80\x00\x00\x01\x2e\x00\x00\x00\x01\x31", aliases)
+        self.assertEqual(msg.topic, ".")
+
+        msg = Message()
+        msg.from_bytes(b"\x00\x01\x24\x00\x00\x00\x07\x00\x00\x00\x00\x00\x01\x31", aliases)
+        self.assertEqual(msg.topic, ".")
+        self.assertEqual(msg.body, "1")
+
+    def test_decode_alias_disabled(self):
+        with self.assertLogs("dragonfly", logging.ERROR):
+            msg = Message()
+            self.assertFalse(msg.from_bytes(b"\x00\x01\x24\x00\x00\x00\x07\x00\x00\x00\x00\x00\x01\x31"))
+
+    def test_unsupported_version(self):
+        with self.assertLogs("dragonfly", logging.ERROR):
+            msg = Message()
+            self.assertFalse(msg.from_bytes(b"\xff\xff\x00\x00\x00\x00\x00"))
+
     def test_encode_subscribe(self):
-        bytes_ = b"\x00\x00\x40\x00\x00\x00\x03\x00\x01\x2e"
+        bytes_ = b"\x00\x01\x40\x00\x00\x00\x03\x00\x01\x2e"
         msg = Message(type_=SUBSCRIBE, topic=".")
         self.assertEqual(msg.to_bytes(), bytes_)
 
     def test_encode_unsubscribe(self):
-        bytes_ = b"\x00\x00\x60\x00\x00\x00\x03\x00\x01\x2e"
+        bytes_ = b"\x00\x01\x60\x00\x00\x00\x03\x00\x01\x2e"
         msg = Message(type_=UNSUBSCRIBE, topic=".")
         self.assertEqual(msg.to_bytes(), bytes_)
     
@@ -238,7 +358,7 @@ class TestMessageEncoding(unittest.TestCase):
         for t in [CONNECTED, PUBLISHED, SUBSCRIBED, UNSUBSCRIBED]:
             with self.subTest(type=t):
                 b = (t << 4).to_bytes(1, "big")
-                bytes_ = b"\x00\x00"+b+b"\x00\x00\x00\x01\x2a"
+                bytes_ = b"\x00\x01"+b+b"\x00\x00\x00\x01\x2a"
                 msg = Message(type_=t, code=42)
                 self.assertEqual(msg.to_bytes(), bytes_)
     
@@ -248,6 +368,134 @@ class TestMessageEncoding(unittest.TestCase):
             msg.type.type = 7239847598
             msg.to_bytes()
     
+    def test_encode_extended_type(self):
+        msg = Message(ORIGIN_CLIENT, BATCHED, codes=[])
+        self.assertEqual(msg.to_bytes(), b"\x00\x01\x98\x00\x00\x00\x02\x00\x00")
+
+    def test_decode_extended_type(self):
+        t = MessageType(0x98)
+        self.assertEqual(t.origin, ORIGIN_CLIENT)
+        self.assertEqual(t.type, BATCHED)
+        self.assertEqual(t.flags, 0)
+
+    def test_encode_batch(self):
+        # type: BATCH / length: 18 / count: 2
+        #   SUBSCRIBE / length: 3 / topic: .
+        #   UNSUBSCRIBE / length: 3 / topic: .
+        bytes_ = b"\x00\x01\x08\x00\x00\x00\x12\x00\x02" \
+            b"\x40\x00\x00\x00\x03\x00\x01\x2e" \
+            b"\x60\x00\x00\x00\x03\x00\x01\x2e"
+        msg = Message(type_=BATCH, messages=[
+            Message(type_=SUBSCRIBE, topic="."),
+            Message(type_=UNSUBSCRIBE, topic=".")
+        ])
+        self.assertEqual(msg.to_bytes(), bytes_)
+
+    def test_decode_batch(self):
+        msgs = [
+            Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="Body"),
+            Message(ORIGIN_CLIENT, SUBSCRIBE, topic="b")
+        ]
+        bytes_ = Message(ORIGIN_CLIENT, BATCH, messages=msgs).to_bytes()
+
+        msg = Message()
+        self.assertTrue(msg.from_bytes(bytes_))
+        self.assertEqual(msg.type.type, BATCH)
+        self.assertEqual(len(msg.messages), 2)
+        self.assertEqual(msg.messages[0].type.type, PUBLISH)
+        self.assertEqual(msg.messages[0].topic, "a")
+        self.assertEqual(msg.messages[0].body, "Body")
+        self.assertEqual(msg.messages[1].type.type, SUBSCRIBE)
+        self.assertEqual(msg.messages[1].topic, "b")
+
+    def test_nested_batch(self):
+        with self.assertLogs("dragonfly", logging.ERROR):
+            inner = Message(type_=BATCH, messages=[])
+            Message(type_=BATCH, messages=[inner]).to_bytes()
+
+        with self.assertLogs("dragonfly", logging.ERROR):
+            # BATCH of 1 BATCHED
+            bytes_ = b"\x00\x00\x08\x00\x00\x00\x09\x00\x01\x18\x00\x00\x00\x02\x00\x00"
+            self.assertFalse(Message().from_bytes(bytes_))
+
+    def test_session(self):
+        # type: SESSION / length: 12 / session id: 2
+        #   SUBSCRIBED / length: 1 / code: 0
+        bytes_ = b"\x00\x01\x38\x00\x00\x00\x0c\x00\x00\x00\x02" \
+            b"\x00\x01\x50\x00\x00\x00\x01\x00"
+        inner = Message(type_=SUBSCRIBED, code=0)
+        msg = Message(type_=SESSION, session_id=2, frame=inner.to_bytes())
+        self.assertEqual(msg.to_bytes(), bytes_)
+
+        msg = Message()
+        self.assertTrue(msg.from_bytes(bytes_))
+        self.assertEqual(msg.type.type, SESSION)
+        self.assertEqual(msg.session_id, 2)
+        self.assertEqual(msg.frame, inner.to_bytes())
+
+    def test_ping(self):
+        for type_, bytes_ in [(PING, b"\x00\x01\x48\x00\x00\x00\x00"),
+                              (PONG, b"\x00\x01\x58\x00\x00\x00\x00")]:
+            with self.subTest(type_=type_name(type_)):
+                self.assertEqual(Message(type_=type_).to_bytes(), bytes_)
+
+                msg = Message()
+                self.assertTrue(msg.from_bytes(bytes_))
+                self.assertEqual(msg.type.type, type_)
+
+    def test_batched(self):
+        bytes_ = b"\x00\x01\x18\x00\x00\x00\x05\x00\x03\x00\x01\x81"
+        msg = Message(type_=BATCHED, codes=[0x00, 0x01, 0x81])
+        self.assertEqual(msg.to_bytes(), bytes_)
+
+        msg = Message()
+        msg.from_bytes(bytes_)
+        self.assertEqual(msg.codes, [0x00, 0x01, 0x81])
+
+
+class TestFrameReader(unittest.TestCase):
+    def setUp(self):
+        self.reader = FrameReader()
+        self.frames = [
+            Message(type_=CONNECT).to_bytes(),
+            Message(type_=PUBLISH, topic=".", body=b"\x00" * 1000).to_bytes(),
+            Message(type_=SUBSCRIBE, topic=".").to_bytes()
+        ]
+
+    def test_merged(self):
+        self.assertEqual(self.reader.feed(b"".join(self.frames)), self.frames)
+
+    def test_split(self):
+        stream = b"".join(self.frames)
+        frames = []
+        for i in range(0, len(stream), 3):
+            frames += self.reader.feed(stream[i:i+3])
+
+        self.assertEqual(frames, self.frames)
+
+    def test_empty(self):
+        self.assertEqual(self.reader.feed(b""), [])
+
+
+class TestTopicAliases(unittest.TestCase):
+    def test_assign(self):
+        aliases = TopicAliases(max_outbound=2)
+        self.assertEqual(aliases.assign("a"), (0, True))
+        self.assertEqual(aliases.assign("b"), (1, True))
+        self.assertEqual(aliases.assign("a"), (0, False))
+        self.assertIsNone(aliases.assign("c"))
+
+    def test_define(self):
+        aliases = TopicAliases(max_inbound=2)
+        aliases.define(1, "a")
+        self.assertEqual(aliases.resolve(1), "a")
+
+        with self.assertRaises(InvalidTopicAlias):
+            aliases.define(2, "b")
+
+        with self.assertRaises(InvalidTopicAlias):
+            aliases.resolve(0)
+
 
 class TestMisc(unittest.TestCase):
     def test_type_name_unknown(self):
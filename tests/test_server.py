@@ -16,15 +16,21 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import selectors
+import socket
+import types
 import unittest
-from unittest.mock import patch, mock_open
+from unittest.mock import Mock, patch, mock_open
 import sys
 
 sys.path.append("src")
 
 from dragonfly.message import CONNECT, CONNECTED, PUBLISH, PUBLISHED, SUBSCRIBE, SUBSCRIBED, UNSUBSCRIBE, UNSUBSCRIBED
-from dragonfly.message import type_name
+from dragonfly.message import BATCH, BATCHED, CHUNK, CHUNK_ABORT, CHUNK_FIRST, CHUNK_LAST, ORIGIN_CLIENT, PING, PONG, SESSION
+from dragonfly.message import FrameReader, Message, PUBLISH_ALIAS, TopicAliases, type_name
 from dragonfly.server import Server, Client
+from dragonfly.timers import TimerWheel
 
 CONFIG = """
 # General
@@ -139,4 +145,781 @@ class TestServerAuth(unittest.TestCase):
         for t in [CONNECTED, PUBLISHED, SUBSCRIBED, UNSUBSCRIBED]:
             with self.subTest(scope=type_name(t)):
                 with self.assertRaises(NotImplementedError):
-                    self.auth(0, t)
\ No newline at end of file
+                    self.auth(0, t)
+
+class FakeSocket:
+    """Socket stub recording sent bytes"""
+
+    def __init__(self):
+        self.sent = b""
+        self.capacity = None
+
+    def send(self, bytes_):
+        count = len(bytes_)
+        if self.capacity is not None:
+            if self.capacity == 0:
+                raise BlockingIOError()
+
+            count = min(count, self.capacity)
+            self.capacity -= count
+
+        self.sent += bytes(bytes_[:count])
+        return count
+
+def sent(client, aliases=None):
+    """Decodes all messages sent to a server-side client"""
+
+    msgs = []
+    for frame in FrameReader().feed(client.socket.sent):
+        msg = Message()
+        msg.from_bytes(frame, aliases)
+        msgs.append(msg)
+
+    client.socket.sent = b""
+    return msgs
+
+class TestServerBatch(unittest.TestCase):
+    def setUp(self):
+        with patch("builtins.open", mock_open(read_data=CONFIG)):
+            self.server = Server(config="/dev/null")
+
+        self.clients = []
+        for i in range(3, 6):
+            c = self.server.new_client(FakeSocket())
+            c.username = f"user{i}"
+            c.password = f"pwd{i}"
+            c.connected = True
+            self.clients.append(c)
+
+    def tearDown(self):
+        self.server.socket.close()
+
+    def test_subscribe_many(self):
+        c = self.clients[0]
+        batch = Message(ORIGIN_CLIENT, BATCH, messages=[
+            Message(ORIGIN_CLIENT, SUBSCRIBE, topic="a"),
+            Message(ORIGIN_CLIENT, SUBSCRIBE, topic="a"),
+            Message(ORIGIN_CLIENT, SUBSCRIBE, topic="nsp"),
+            Message(ORIGIN_CLIENT, UNSUBSCRIBE, topic="b")
+        ])
+
+        with patch.object(self.server.config, "get_user", wraps=self.server.config.get_user) as get_user:
+            self.server.process_msg(batch, c)
+            self.assertEqual(get_user.call_count, 1)
+
+        msgs = sent(c)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0].type.type, BATCHED)
+        self.assertEqual(msgs[0].codes, [0x00, 0x01, 0x81, 0x01])
+        self.assertEqual(c.topics, ["a"])
+
+    def test_publish_many(self):
+        pub, sub1, sub2 = self.clients
+        self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="a"), sub1)
+        self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="b"), sub2)
+        sent(sub1)
+        sent(sub2)
+
+        batch = Message(ORIGIN_CLIENT, BATCH, messages=[
+            Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="1"),
+            Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="2"),
+            Message(ORIGIN_CLIENT, PUBLISH, topic="b", body="3"),
+            Message(ORIGIN_CLIENT, PUBLISH, topic="npub", body="4")
+        ])
+        self.server.process_msg(batch, pub)
+
+        self.assertEqual(sent(pub)[0].codes, [0x00, 0x00, 0x00, 0x81])
+
+        msgs = sent(sub1)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0].type.type, BATCH)
+        self.assertEqual([m.body for m in msgs[0].messages], ["1", "2"])
+
+        msgs = sent(sub2)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0].type.type, PUBLISH)
+        self.assertEqual(msgs[0].body, "3")
+
+    def test_publish_many_aliases(self):
+        pub, sub, _ = self.clients
+        sub.aliases = TopicAliases(0, 8)
+        self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="a"), sub)
+        self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="a.*"), sub)
+        sent(sub)
+
+        batch = Message(ORIGIN_CLIENT, BATCH, messages=[
+            Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="1")
+        ])
+        self.server.process_msg(batch, pub)
+        self.server.process_msg(Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="2"), pub)
+
+        aliases = TopicAliases(8)
+        msgs = sent(sub, aliases)
+        self.assertEqual(len(msgs), 3)
+        self.assertEqual([m.topic for m in msgs[0].messages], ["a", "a"])
+        self.assertEqual([m.body for m in msgs[0].messages], ["1", "1"])
+        self.assertEqual(msgs[1].topic, "a")
+        self.assertEqual(msgs[2].body, "2")
+        self.assertEqual(aliases.inbound, {0: "a"})
+
+class TestServerResumeToken(unittest.TestCase):
+    def setUp(self):
+        with patch("builtins.open", mock_open(read_data=CONFIG)):
+            self.server = Server(config="/dev/null")
+
+        # Refused connections are closed
+        self.server.close_conn = Mock()
+
+    def tearDown(self):
+        self.server.socket.close()
+
+    def connect(self, username, password, token=None):
+        c = self.server.new_client(FakeSocket())
+        properties = {"resume_token": token} if token else {}
+        msg = Message(ORIGIN_CLIENT, CONNECT, username=username, password=password, properties=properties)
+        self.server.process_msg(msg, c)
+
+        return c, sent(c)[0]
+
+    def test_resume(self):
+        _, ack = self.connect("user3", "pwd3")
+        token = ack.properties["resume_token"]
+
+        # The token replaces the password and the user's rights still apply
+        with patch.object(self.server.config, "get_user", wraps=self.server.config.get_user) as get_user:
+            c, ack = self.connect("user3", None, token)
+            self.assertEqual(ack.code, 0x00)
+            self.assertTrue(self.server.check_auth(c, SUBSCRIBE, "nsub"))
+            self.assertEqual(get_user.call_count, 0)
+
+        self.assertIn("resume_token", ack.properties)
+
+    def test_invalid(self):
+        _, ack = self.connect("user3", "pwd3")
+        token = ack.properties["resume_token"]
+        expiry, _, signature = token.partition(":")
+
+        for username, bad in [
+            ("user4", token),
+            ("user3", f"{int(expiry) + 1}:{signature}"),
+            ("user3", "garbage")
+        ]:
+            with self.subTest(username=username, token=bad):
+                _, ack = self.connect(username, None, bad)
+                self.assertEqual(ack.code, 0x81)
+                self.assertNotIn("resume_token", ack.properties)
+
+        # Falls back to the password
+        _, ack = self.connect("user4", "pwd4", token)
+        self.assertEqual(ack.code, 0x00)
+
+    def test_expired(self):
+        self.server.config._config["resume_ttl"] = -1
+        _, ack = self.connect("user3", "pwd3")
+
+        c, ack = self.connect("user3", None, ack.properties["resume_token"])
+        self.assertEqual(ack.code, 0x81)
+        self.server.close_conn.assert_called_once_with(c.id)
+
+    def test_second_connect(self):
+        _, ack = self.connect("user3", "pwd3")
+        c, ack = self.connect("user3", None, ack.properties["resume_token"])
+        self.assertEqual(ack.code, 0x00)
+
+        # Cannot switch to another identity on the same connection
+        msg = Message(ORIGIN_CLIENT, CONNECT, username="user4", password=None)
+        self.server.process_msg(msg, c)
+        ack = sent(c)[0]
+        self.assertEqual(ack.code, 0x82)
+        self.assertNotIn("resume_token", ack.properties)
+        self.assertEqual(c.username, "user3")
+
+    def test_disabled(self):
+        self.server.config._config["resume_ttl"] = 0
+        _, ack = self.connect("user3", "pwd3")
+        self.assertNotIn("resume_token", ack.properties)
+
+class TestServerKeepalive(unittest.TestCase):
+    def setUp(self):
+        with patch("builtins.open", mock_open(read_data=CONFIG)):
+            self.server = Server(config="/dev/null")
+
+        self.now = 0
+        clock = patch("dragonfly.server.time.monotonic", lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.server.timers = TimerWheel(clock=lambda: self.now)
+        self.server.close_conn = Mock()
+
+    def tearDown(self):
+        self.server.socket.close()
+
+    def new_client(self):
+        c = self.server.new_client(FakeSocket())
+        c.data = types.SimpleNamespace(addr="fake")
+
+        return c
+
+    def connect(self, keepalive=None):
+        c = self.new_client()
+        properties = {"keepalive": keepalive} if keepalive else {}
+        msg = Message(ORIGIN_CLIENT, CONNECT, username="user3", password="pwd3", properties=properties)
+        self.server.process_msg(msg, c)
+
+        return c, sent(c)[0]
+
+    def advance(self, now):
+        self.now = now
+        self.server.timers.advance()
+
+    def test_negotiate(self):
+        c, ack = self.connect(30)
+        self.assertEqual(ack.get_int_property("keepalive"), 30)
+        self.assertEqual(c.idle_timeout, 45)
+
+        c, ack = self.connect()
+        self.assertNotIn("keepalive", ack.properties)
+        self.assertIsNone(c.timer)
+
+        # Capped by the config, which also applies to clients without keepalive
+        self.server.config._config["keepalive"] = 10
+        for keepalive in [30, None]:
+            with self.subTest(keepalive=keepalive):
+                _, ack = self.connect(keepalive)
+                self.assertEqual(ack.get_int_property("keepalive"), 10)
+
+    def test_idle(self):
+        c, _ = self.connect(10)
+
+        # Received data pushes the deadline back
+        self.advance(10)
+        c.last_seen = 10
+        self.advance(15.1)
+        self.server.close_conn.assert_not_called()
+
+        self.advance(24.9)
+        self.server.close_conn.assert_not_called()
+
+        self.advance(25.2)
+        self.server.close_conn.assert_called_once_with(c.id)
+
+    def test_connect_timeout(self):
+        c = self.new_client()
+        self.server.watch(c, self.server.connect_timeout())
+
+        self.advance(Server.CONNECT_TIMEOUT + 0.2)
+        self.server.close_conn.assert_called_once_with(c.id)
+
+    def test_ping(self):
+        c, _ = self.connect()
+        self.server.process_msg(Message(ORIGIN_CLIENT, PING), c)
+        self.assertEqual([msg.type.type for msg in sent(c)], [PONG])
+
+class TestServerAdmission(unittest.TestCase):
+    def setUp(self):
+        with patch("builtins.open", mock_open(read_data=CONFIG)):
+            self.server = Server(port=0, config="/dev/null")
+
+        self.server.socket.bind(("localhost", 0))
+        self.server.socket.listen(self.server.backlog())
+        self.server.socket.setblocking(False)
+        self.peers = []
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.close()
+
+        for client in self.server.clients:
+            if client is not None:
+                client.socket.close()
+
+        self.server.socket.close()
+
+    def connect(self, n):
+        for _ in range(n):
+            peer = socket.create_connection(self.server.socket.getsockname())
+            peer.settimeout(1)
+            self.peers.append(peer)
+
+        # Lets the connections reach the accept queue
+        selectors.DefaultSelector().select(0.1)
+        self.server.new_conn(self.server.socket)
+
+    def rejected(self, peer):
+        msgs = []
+        for frame in FrameReader().feed(peer.recv(1024)):
+            msg = Message()
+            msg.from_bytes(frame)
+            msgs.append(msg)
+
+        self.assertEqual([(msg.type.type, msg.code) for msg in msgs], [(CONNECTED, 0x83)])
+        self.assertEqual(peer.recv(1024), b"")
+
+    def test_batch(self):
+        self.server.ACCEPT_BATCH = 2
+        self.connect(3)
+        self.assertEqual(self.server.connections, 2)
+
+        self.server.new_conn(self.server.socket)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_max_connections(self):
+        self.server.config._config["max_connections"] = 2
+        self.connect(3)
+
+        self.assertEqual(self.server.connections, 2)
+        self.rejected(self.peers[2])
+
+        # Room is made by closing connections
+        self.server.close_conn(0)
+        self.connect(1)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_accept_rate(self):
+        self.server.config._config["accept_rate"] = 2
+        self.server.accept_tokens = 2
+        self.connect(3)
+
+        self.assertEqual(self.server.connections, 2)
+        self.rejected(self.peers[2])
+
+    def test_shm_handshakes(self):
+        self.server.config._config["max_connections"] = 2
+        self.server.shm_handshakes[Mock()] = None
+        self.connect(2)
+
+        self.assertEqual(self.server.connections, 1)
+        self.rejected(self.peers[1])
+
+    def test_loopback(self):
+        self.server.config._config["max_connections"] = 1
+        socks = [self.server.attach() for _ in range(2)]
+        self.server.handle_loopback()
+        self.assertEqual(self.server.connections, 1)
+
+        msg = Message()
+        msg.from_bytes(socks[1].recv(1024))
+        self.assertEqual((msg.type.type, msg.code), (CONNECTED, 0x83))
+        self.assertEqual(socks[1].recv(1024), b"")
+
+        for sock in socks:
+            sock.close()
+
+class TestServerShare(unittest.TestCase):
+    setUp = TestServerBatch.setUp
+    tearDown = TestServerBatch.tearDown
+
+    def subscribe(self, client, topic):
+        return self.server.apply_subscribe(Message(ORIGIN_CLIENT, SUBSCRIBE, topic=topic), client)
+
+    def publish(self, n):
+        for i in range(n):
+            self.server.apply_publish(Message(ORIGIN_CLIENT, PUBLISH, topic="a", body=str(i)), self.clients[0])
+
+    def received(self):
+        return [[msg.body for msg in sent(c)] for c in self.clients]
+
+    def test_round_robin(self):
+        for c in self.clients[1:]:
+            self.assertEqual(self.subscribe(c, "$share/g/a"), 0x00)
+
+        self.assertEqual(self.subscribe(self.clients[0], "a"), 0x00)
+        self.publish(4)
+
+        # Regular subscribers still get everything
+        self.assertEqual(self.received(), [["0", "1", "2", "3"], ["0", "2"], ["1", "3"]])
+
+    def test_least_queued(self):
+        self.server.config._config["share_policy"] = "least_queued"
+        for c in self.clients[1:]:
+            self.subscribe(c, "$share/g/a")
+
+        # Stalled member
+        self.clients[1].socket.capacity = 0
+        self.publish(4)
+
+        self.assertEqual(self.received(), [[], [], ["1", "2", "3"]])
+        self.assertEqual(self.clients[1].queued, len(Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="0").to_bytes()))
+
+    def test_unsubscribe(self):
+        self.subscribe(self.clients[1], "$share/g/a")
+        self.subscribe(self.clients[2], "$share/h/a")
+        self.assertEqual(self.subscribe(self.clients[2], "$share/g"), 0x82)
+
+        self.server.remove_client(self.clients[1].id)
+        self.publish(1)
+        self.assertEqual(self.received()[2], ["0"])
+
+        msg = Message(ORIGIN_CLIENT, UNSUBSCRIBE, topic="$share/h/a")
+        self.assertEqual(self.server.apply_unsubscribe(msg, self.clients[2]), 0x00)
+        self.assertEqual(self.server.groups, {})
+
+    def test_auth(self):
+        # The pattern's rights apply
+        self.assertEqual(self.subscribe(self.clients[1], "$share/g/nsp"), 0x81)
+
+class TestServerCompression(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.clients = []
+        for codec in [None, "zlib", "zlib", None]:
+            c = self.server.new_client(FakeSocket())
+            properties = {"compression": codec} if codec else {}
+            self.server.process_msg(Message(ORIGIN_CLIENT, CONNECT, username=None, password=None, properties=properties), c)
+            self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="a"), c)
+            self.clients.append(c)
+
+    def tearDown(self):
+        self.server.socket.close()
+
+    def test_negotiate(self):
+        self.assertNotIn("compression", sent(self.clients[0])[0].properties)
+        self.assertEqual(sent(self.clients[1])[0].properties["compression"], "zlib")
+        self.assertEqual(self.clients[1].codec, "zlib")
+
+    def test_negotiate_disabled(self):
+        self.server.config._config["compression"] = False
+        c = self.server.new_client(FakeSocket())
+        self.server.process_msg(Message(ORIGIN_CLIENT, CONNECT, username=None, password=None, properties={"compression": "zlib"}), c)
+        self.assertIsNone(c.codec)
+        self.assertNotIn("compression", sent(c)[0].properties)
+
+    def test_forward(self):
+        for c in self.clients:
+            sent(c)
+
+        body = "Body " * 100
+        msg = Message()
+        msg.from_bytes(Message(ORIGIN_CLIENT, PUBLISH, topic="a", body=body, codec="zlib").to_bytes())
+
+        with patch("dragonfly.compression.compress") as compress:
+            self.server.process_msg(msg, self.clients[1])
+            compress.assert_not_called()
+
+        frames = [FrameReader().feed(c.socket.sent)[0] for c in self.clients]
+        self.assertEqual(frames[1], frames[2])
+        self.assertEqual(frames[0], frames[3])
+        self.assertLess(len(frames[1]), len(frames[0]))
+
+        for c in self.clients:
+            with self.subTest(client=c):
+                self.assertEqual(sent(c)[0].body, body)
+
+    def test_forward_same_codec(self):
+        for c in [self.clients[0], self.clients[3]]:
+            self.server.process_msg(Message(ORIGIN_CLIENT, UNSUBSCRIBE, topic="a"), c)
+
+        msg = Message()
+        msg.from_bytes(Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="Body " * 100, codec="zlib").to_bytes())
+
+        # Debug logs included
+        with self.assertLogs("dragonfly", logging.DEBUG), patch("dragonfly.compression.decompress") as decompress:
+            self.server.process_msg(msg, self.clients[1])
+            decompress.assert_not_called()
+
+    def test_corrupt(self):
+        for c in self.clients:
+            sent(c)
+
+        data = Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="Body " * 100, codec="zlib").to_bytes()
+        msg = Message()
+        msg.from_bytes(data[:-8] + bytes(8))
+
+        with self.assertLogs("dragonfly", logging.WARNING):
+            self.server.process_msg(msg, self.clients[1])
+
+        self.assertEqual(sent(self.clients[1])[0].code, 0x82)
+        for c in [self.clients[0], self.clients[2], self.clients[3]]:
+            with self.subTest(client=c):
+                self.assertEqual(c.socket.sent, b"")
+
+    def test_max_body(self):
+        for c in self.clients:
+            sent(c)
+
+        self.server.config._config["max_body"] = 100
+        msg = Message()
+        msg.from_bytes(Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="Body " * 100, codec="zlib").to_bytes())
+
+        with self.assertLogs("dragonfly", logging.WARNING):
+            self.server.process_msg(msg, self.clients[1])
+
+        self.assertEqual(sent(self.clients[1])[0].code, 0x82)
+        self.assertEqual(self.clients[0].socket.sent, b"")
+
+
+class TestServerAliases(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.clients = []
+        for max_ in [0, 8]:
+            c = self.server.new_client(FakeSocket())
+            properties = {"topic_alias_max": max_}
+            self.server.process_msg(Message(ORIGIN_CLIENT, CONNECT, username=None, password=None, properties=properties), c)
+            self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="long"), c)
+            sent(c)
+            self.clients.append(c)
+
+    def tearDown(self):
+        self.server.socket.close()
+
+    def test_inbound(self):
+        pub, sub = self.clients
+        aliases = TopicAliases(0, 8)
+        for _ in range(2):
+            msg = Message(ORIGIN_CLIENT, PUBLISH, topic="long/topic", body="1", alias=aliases.assign("long/topic"))
+            decoded = Message()
+            self.assertTrue(decoded.from_bytes(msg.to_bytes(), pub.aliases))
+            self.server.process_msg(decoded, pub)
+
+        self.assertEqual([m.body for m in sent(sub, TopicAliases(8))], ["1", "1"])
+
+    def test_inbound_unknown(self):
+        with self.assertLogs("dragonfly", logging.ERROR):
+            msg = Message(ORIGIN_CLIENT, PUBLISH, topic="long/topic", body="1", alias=(3, False))
+            self.assertFalse(Message().from_bytes(msg.to_bytes(), self.clients[0].aliases))
+
+    def test_outbound(self):
+        pub, sub = self.clients
+        for body in ["1", "2"]:
+            self.server.process_msg(Message(ORIGIN_CLIENT, PUBLISH, topic="long/topic", body=body), pub)
+
+        # Not enabled for the publisher, which is also subscribed
+        plain = [f for f in FrameReader().feed(pub.socket.sent) if f[2] >> 4 == PUBLISH]
+        self.assertEqual(len(plain[0]), len(plain[1]))
+
+        frames = FrameReader().feed(sub.socket.sent)
+        self.assertLess(len(frames[1]), len(frames[0]))
+        self.assertLess(len(frames[1]), len(plain[1]))
+
+        aliases = TopicAliases(8)
+        msgs = sent(sub, aliases)
+        self.assertTrue(all(m.type.flags & PUBLISH_ALIAS for m in msgs))
+        self.assertEqual([m.topic for m in msgs], ["long/topic", "long/topic"])
+        self.assertEqual(aliases.inbound, {0: "long/topic"})
+
+
+class TestServerVersion(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.clients = []
+        for version in [1, 0, 1]:
+            c = self.server.new_client(FakeSocket())
+            properties = {"compression": "zlib", "topic_alias_max": 8}
+            self.server.process_msg(Message(ORIGIN_CLIENT, CONNECT, username=None, password=None, properties=properties, version=version), c)
+            self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="a"), c)
+            self.clients.append(c)
+
+    def tearDown(self):
+        self.server.socket.close()
+
+    def versions(self, client):
+        return {frame[1] for frame in FrameReader().feed(client.socket.sent)}
+
+    def test_acks(self):
+        self.assertEqual(self.versions(self.clients[0]), {1})
+        self.assertEqual(self.versions(self.clients[1]), {0})
+
+    def test_publish(self):
+        pub, v0, v1 = self.clients
+        for c in self.clients:
+            sent(c)
+
+        body = "Body " * 100
+        self.server.process_msg(Message(ORIGIN_CLIENT, PUBLISH, topic="a", body=body), pub)
+        with self.assertLogs("dragonfly", logging.ERROR):
+            self.server.process_msg(Message(ORIGIN_CLIENT, PUBLISH, topic="a", body=b"binary"), pub)
+
+        self.server.process_msg(Message(ORIGIN_CLIENT, BATCH, messages=[
+            Message(ORIGIN_CLIENT, PUBLISH, topic="a", body="1"),
+            Message(ORIGIN_CLIENT, PUBLISH, topic="a", body=b"2")
+        ]), pub)
+
+        # Binary bodies are not sent to v0 clients
+        self.assertEqual(self.versions(v0), {0})
+        msgs = sent(v0)
+        self.assertEqual([m.body for m in msgs], [body, "1"])
+        self.assertTrue(all(m.version == 0 for m in msgs))
+
+        msgs = sent(v1, TopicAliases(8))
+        self.assertEqual([m.body for m in msgs[:2]], [body, b"binary"])
+        self.assertEqual([m.body for m in msgs[2].messages], ["1", b"2"])
+
+    def test_chunk(self):
+        pub, v0, v1 = self.clients
+        for c in self.clients:
+            sent(c)
+
+        self.server.process_msg(Message(ORIGIN_CLIENT, CHUNK, CHUNK_FIRST | CHUNK_LAST, stream_id=1, topic="a", data=b"x"), pub)
+        self.assertEqual(self.versions(v0), {0})
+        self.assertEqual(self.versions(v1), {1})
+
+
+class TestServerChunk(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.clients = []
+        for _ in range(3):
+            c = self.server.new_client(FakeSocket())
+            c.connected = True
+            self.clients.append(c)
+
+        pub, sub1, sub2 = self.clients
+        self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="a"), sub1)
+        self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="."), sub1)
+        self.server.process_msg(Message(ORIGIN_CLIENT, SUBSCRIBE, topic="b"), sub2)
+        sent(sub1)
+        sent(sub2)
+
+    def tearDown(self):
+        self.server.socket.close()
+
+    def chunk(self, flags, data, topic="a", stream_id=7):
+        self.server.process_msg(Message(ORIGIN_CLIENT, CHUNK, flags, stream_id=stream_id, topic=topic, data=data), self.clients[0])
+
+    def test_relay(self):
+        pub, sub1, sub2 = self.clients
+
+        self.chunk(CHUNK_FIRST, b"12")
+        msgs = sent(sub1)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0].type.type, CHUNK)
+        self.assertEqual(msgs[0].topic, "a")
+        self.assertEqual(msgs[0].data, b"12")
+        stream_id = msgs[0].stream_id
+
+        self.chunk(0, b"34")
+        self.chunk(CHUNK_LAST, b"56")
+        msgs = sent(sub1)
+        self.assertEqual([m.data for m in msgs], [b"34", b"56"])
+        self.assertTrue(all(m.stream_id == stream_id for m in msgs))
+        self.assertTrue(msgs[1].type.flags & CHUNK_LAST)
+
+        self.assertEqual(sent(sub2), [])
+        msgs = sent(pub)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0].type.type, PUBLISHED)
+        self.assertEqual(msgs[0].code, 0x00)
+        self.assertEqual(pub.streams, {})
+
+    def test_unknown_stream(self):
+        with self.assertLogs("dragonfly"):
+            self.chunk(0, b"34")
+
+    def test_publisher_disconnect(self):
+        pub, sub1, sub2 = self.clients
+        self.chunk(CHUNK_FIRST, b"12")
+        sent(sub1)
+
+        self.server.remove_client(pub.id)
+        msgs = sent(sub1)
+        self.assertEqual(len(msgs), 1)
+        self.assertTrue(msgs[0].type.flags & CHUNK_ABORT)
+
+    def test_backpressure(self):
+        pub, sub1, sub2 = self.clients
+        sub1.socket.capacity = 0
+        size = self.server.QUEUE_HIGH_WATER // 2
+
+        self.chunk(CHUNK_FIRST, bytes(size))
+        self.assertFalse(pub.paused)
+
+        self.chunk(0, bytes(size))
+        self.assertTrue(pub.paused)
+        self.assertIn(pub, sub1.waiters)
+
+        sub1.socket.capacity = None
+        key = types.SimpleNamespace(fileobj=sub1.socket, data=types.SimpleNamespace(id=sub1.id))
+        self.server.handle_msg(key, selectors.EVENT_WRITE)
+        self.assertEqual(sub1.queued, 0)
+        self.assertEqual(len(sent(sub1)), 2)
+        self.assertFalse(pub.paused)
+        self.assertEqual(sub1.waiters, [])
+
+class TestServerSession(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.conn = self.server.new_client(FakeSocket())
+
+    def tearDown(self):
+        self.server.socket.close()
+
+    def send(self, session_id, msg):
+        frame = Message(ORIGIN_CLIENT, SESSION, session_id=session_id, frame=msg.to_bytes())
+        self.server.process_msg(frame, self.conn)
+
+    def received(self):
+        """Decodes sent SESSION messages to (session_id, inner message) pairs"""
+
+        msgs = []
+        for msg in sent(self.conn):
+            self.assertEqual(msg.type.type, SESSION)
+            inner = Message()
+            inner.from_bytes(msg.frame)
+            msgs.append((msg.session_id, inner))
+
+        return msgs
+
+    def test_sessions(self):
+        self.send(1, Message(ORIGIN_CLIENT, CONNECT, username="a"))
+        self.send(2, Message(ORIGIN_CLIENT, CONNECT, username="b"))
+        self.send(1, Message(ORIGIN_CLIENT, SUBSCRIBE, topic="t"))
+        self.send(2, Message(ORIGIN_CLIENT, PUBLISH, topic="t", body="x"))
+
+        msgs = [(id_, msg.type.type) for id_, msg in self.received()]
+        self.assertEqual(msgs, [(1, CONNECTED), (2, CONNECTED), (1, SUBSCRIBED), (1, PUBLISH), (2, PUBLISHED)])
+
+        sessions = self.conn.sessions
+        self.assertEqual(sessions[1].username, "a")
+        self.assertEqual(sessions[1].topics, ["t"])
+        self.assertEqual(self.server.topics, {"t": [sessions[1].id]})
+
+    def test_unknown(self):
+        self.send(1, Message(ORIGIN_CLIENT, SUBSCRIBE, topic="t"))
+        self.assertEqual(self.received(), [])
+        self.assertEqual(self.conn.sessions, {})
+
+    def test_close(self):
+        self.send(1, Message(ORIGIN_CLIENT, CONNECT))
+        self.send(1, Message(ORIGIN_CLIENT, SUBSCRIBE, topic="t"))
+        session = self.conn.sessions[1]
+        self.send(1, Message(ORIGIN_CLIENT, CONNECT, 4))
+
+        self.assertEqual(self.received()[-1][1].type.flags, 4)
+        self.assertEqual(self.conn.sessions, {})
+        self.assertIsNone(self.server.clients[session.id])
+        self.assertEqual(self.server.topics, {})
+        self.assertIs(self.server.clients[self.conn.id], self.conn)
+
+    def test_refused(self):
+        with patch.object(self.server, "check_auth", return_value=False):
+            self.send(1, Message(ORIGIN_CLIENT, CONNECT, username="a"))
+
+        self.assertEqual(self.received()[0][1].code, 0x81)
+        self.assertEqual(self.conn.sessions, {})
+        self.assertIs(self.server.clients[self.conn.id], self.conn)
+
+    def test_max_queued(self):
+        self.send(1, Message(ORIGIN_CLIENT, CONNECT))
+        self.send(1, Message(ORIGIN_CLIENT, SUBSCRIBE, topic="t"))
+        self.send(2, Message(ORIGIN_CLIENT, CONNECT))
+        self.received()
+
+        session = self.conn.sessions[1]
+        self.conn.socket.capacity = 0
+
+        with patch.object(session, "MAX_QUEUED", 3):
+            for i in range(5):
+                self.send(2, Message(ORIGIN_CLIENT, PUBLISH, topic="t", body=str(i)))
+
+        # Only the subscribed session is capped
+        self.assertEqual(session.frames, 3)
+        self.assertEqual(self.conn.sessions[2].frames, 5)
+
+        self.conn.socket.capacity = None
+        self.conn.flush()
+        self.assertEqual(session.frames, 0)
+        self.assertEqual(self.conn.sessions[2].frames, 0)
+
+        msgs = [msg.body for id_, msg in self.received() if id_ == 1]
+        self.assertEqual(msgs, ["0", "1", "2"])
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append("src")
+
+from dragonfly import shm
+from dragonfly.client import Client
+from tests.helpers import ServerTestCase
+
+class TestRing(unittest.TestCase):
+    def setUp(self):
+        self.mem = bytearray(shm.Ring.HEADER_SIZE + 8)
+        self.ring = shm.Ring(memoryview(self.mem), 8)
+
+    def tearDown(self):
+        self.ring.release()
+
+    def test_wraparound(self):
+        self.assertEqual(self.ring.write(b"abcdef"), 6)
+        self.assertEqual(self.ring.read(4), b"abcd")
+
+        # Wraps around the end of the data area
+        self.assertEqual(self.ring.write(b"ghijklmn"), 6)
+        self.assertEqual(self.ring.free(), 0)
+        self.assertEqual(self.ring.write(b"o"), 0)
+        self.assertEqual(self.ring.read(100), b"efghijkl")
+        self.assertEqual(len(self.ring), 0)
+
+    def test_corrupt(self):
+        # Positions further apart than the capacity
+        self.ring.head = 100
+        self.assertRaises(BrokenPipeError, self.ring.read, 4)
+        self.ring.tail = 101
+        self.assertRaises(BrokenPipeError, self.ring.write, b"a")
+
+class TestShmSocket(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "shm.sock")
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen()
+
+        accepted = []
+        thread = threading.Thread(target=lambda: accepted.append(shm.accept(self.listener.accept()[0])))
+        thread.start()
+
+        self.client = shm.connect(self.path, size=16, timeout=1)
+        thread.join()
+        self.server = accepted[0]
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        self.listener.close()
+        os.unlink(self.path)
+        os.rmdir(self.tmp)
+
+    def test_exchange(self):
+        self.assertRaises(BlockingIOError, self.server.recv, 64)
+
+        self.assertEqual(self.client.send(b"hello"), 5)
+        self.assertEqual(self.server.recv(64), b"hello")
+        self.assertEqual(self.server.send(b"world"), 5)
+        self.assertEqual(self.client.recv(64), b"world")
+
+    def test_full(self):
+        self.assertEqual(self.client.send(b"x" * 20), 16)
+        self.assertRaises(BlockingIOError, self.client.send, b"y")
+        self.assertTrue(self.client.tx.waiting)
+
+        # Reading frees room and wakes the writer up
+        self.assertEqual(self.server.recv(8), b"x" * 8)
+        self.assertFalse(self.client.tx.waiting)
+        self.assertRaises(BlockingIOError, self.client.recv, 64)
+        self.assertEqual(self.client.send(b"y" * 8), 8)
+
+    def test_close(self):
+        self.client.send(b"bye")
+        self.client.close()
+
+        # Pending data is still delivered
+        self.assertEqual(self.server.recv(64), b"bye")
+        self.assertEqual(self.server.recv(64), b"")
+        self.assertRaises(BrokenPipeError, self.server.send, b"x")
+
+    def test_corrupt_ring(self):
+        self.server.rx.head = 1 << 40
+        self.assertEqual(self.server.recv(64), b"")
+
+    @unittest.skipUnless(hasattr(os, "memfd_create"), "no memfd")
+    def test_unsealed(self):
+        fd = os.memfd_create("dragonfly")
+        os.ftruncate(fd, shm.block_size(16))
+        wakeup = shm.Wakeup()
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control:
+                control.connect(self.path)
+                hello = struct.pack(">BIB", shm.VERSION, 16, len(wakeup.fds))
+                socket.send_fds(control, [hello], [fd] + wakeup.fds + wakeup.fds)
+                self.assertRaises(ConnectionRefusedError, shm.accept, self.listener.accept()[0])
+
+        finally:
+            os.close(fd)
+            wakeup.close()
+
+    def test_invalid_handshake(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control:
+            control.connect(self.path)
+            control.sendall(b"\xff")
+            self.assertRaises(ConnectionRefusedError, shm.accept, self.listener.accept()[0])
+
+class TestShmServer(ServerTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.tmp)
+        self.path = os.path.join(self.tmp, "shm.sock")
+
+        self.server = self.start_server(shm_path=self.path)
+        self.server.config._config["connect_timeout"] = 0.2
+
+    def test_silent_handshake(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control:
+            control.connect(self.path)
+
+            # Another client is served meanwhile
+            client = Client()
+            self.assertEqual(client.connect(f"shm://{self.path}").result(1), 0)
+            self.assertEqual(client.subscribe("a").result(1), 0)
+            client.disconnect()
+
+            # Closed once the connect timeout expires
+            control.settimeout(1)
+            self.assertEqual(control.recv(1), b"")
+            self.assertEqual(self.server.shm_handshakes, {})
+
+if __name__ == "__main__":
+    unittest.main()
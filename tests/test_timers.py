@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import unittest
+import sys
+
+sys.path.append("src")
+
+from dragonfly.timers import TimerWheel
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.wheel = TimerWheel(tick=1, levels=3, clock=lambda: self.now)
+        self.fired = []
+
+    def schedule(self, delay):
+        return self.wheel.schedule(delay, self.fired.append, delay)
+
+    def advance(self, now):
+        self.now = now
+        return self.wheel.advance()
+
+    def test_expiry(self):
+        for delay in [5, 1, 3]:
+            self.schedule(delay)
+
+        self.assertEqual(len(self.wheel), 3)
+        self.assertEqual(self.wheel.timeout(), 2)
+
+        # Never early, at most one tick late
+        self.assertEqual(self.advance(1.5), 0)
+        self.assertEqual(self.advance(4.5), 2)
+        self.assertEqual(self.fired, [1, 3])
+        self.assertEqual(self.wheel.timeout(), 1.5)
+
+        self.advance(10)
+        self.assertEqual(self.fired, [1, 3, 5])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertIsNone(self.wheel.timeout())
+
+    def test_cancel(self):
+        timer = self.schedule(2)
+        self.schedule(3)
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+
+        self.assertEqual(len(self.wheel), 1)
+        self.advance(10)
+        self.assertEqual(self.fired, [3])
+
+    def test_cascade(self):
+        # Beyond the first level, and beyond the whole wheel
+        delays = [70, 64 * 64 + 3, 64 ** 3 * 2 + 5]
+        for delay in delays:
+            self.schedule(delay)
+
+        for i, delay in enumerate(delays):
+            self.advance(delay)
+            self.assertEqual(self.fired, delays[:i])
+
+            self.advance(delay + 1)
+            self.assertEqual(self.fired, delays[:i + 1])
+
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_reschedule(self):
+        # Callbacks may schedule timers
+        def callback():
+            self.fired.append(self.now)
+            if len(self.fired) < 3:
+                self.wheel.schedule(2, callback)
+
+        self.wheel.schedule(2, callback)
+        for now in range(10):
+            self.advance(now)
+
+        self.assertEqual(self.fired, [3, 6, 9])
+
+if __name__ == "__main__":
+    unittest.main()
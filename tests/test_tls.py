@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import unittest
+import sys
+
+sys.path.append("src")
+
+from dragonfly.client import Client
+from tests.helpers import ServerTestCase
+
+@unittest.skipIf(shutil.which("openssl") is None, "requires the openssl command line tool")
+class TestTLS(ServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.cert = os.path.join(cls.tmp, "cert.pem")
+        cls.key = os.path.join(cls.tmp, "key.pem")
+
+        # Self-signed certificate, trusted by the clients
+        subprocess.run([
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", cls.key, "-out", cls.cert, "-days", "1",
+            "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost"
+        ], check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert, self.key)
+
+        self.server = self.start_server(ssl_context=context)
+        self.port = self.server.socket.getsockname()[1]
+        self.context = ssl.create_default_context(cafile=self.cert)
+
+    def test_pubsub(self):
+        client = Client(ssl_context=self.context)
+        self.assertEqual(client.connect("localhost", self.port).result(5), 0)
+        self.assertEqual(client.subscribe("a").result(5), 0)
+        self.assertEqual(client.publish("a", b"x" * 100000).result(5), 0)
+        client.disconnect()
+
+    def test_resumption(self):
+        client = Client(ssl_context=self.context)
+        client.connect("localhost", self.port).result(5)
+        self.assertFalse(client.socket.session_reused)
+        client.disconnect()
+
+        # Reconnecting resumes the session
+        client.connect("localhost", self.port).result(5)
+        self.assertTrue(client.socket.session_reused)
+        client.disconnect()
+
+    def test_failed_handshake(self):
+        plain = Client()
+        with self.assertRaises(ConnectionError):
+            plain.connect("localhost", self.port).result(5)
+
+        untrusted = Client(ssl_context=ssl.create_default_context())
+        with self.assertRaises(ConnectionError):
+            untrusted.connect("localhost", self.port).result(5)
+
+        # The server is still up
+        client = Client(ssl_context=self.context)
+        self.assertEqual(client.connect("localhost", self.port).result(5), 0)
+        client.disconnect()
+
+if __name__ == "__main__":
+    unittest.main()
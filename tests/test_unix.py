@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dragonfly is an mqtt-like communication protocol
+# Copyright (C) 2022  Louis HEREDERO
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import queue
+import socket
+import stat
+import tempfile
+import unittest
+import sys
+
+sys.path.append("src")
+
+from dragonfly.client import Client
+from dragonfly.server import Server
+from tests.helpers import ServerTestCase
+
+class TestUnixServer(ServerTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.tmp)
+        self.path = os.path.join(self.tmp, "dragonfly.sock")
+
+    def test_pubsub(self):
+        self.start_server(unix_path=self.path)
+        received = queue.Queue()
+        client = Client()
+        client.on_message = lambda client, topic, body: received.put((topic, body))
+
+        self.assertEqual(client.connect(f"unix://{self.path}").result(1), 0)
+        self.assertEqual(client.socket.family, socket.AF_UNIX)
+        self.assertEqual(client.subscribe("a").result(1), 0)
+        self.assertEqual(client.publish("a", b"hello").result(1), 0)
+        self.assertEqual(received.get(timeout=1), ("a", b"hello"))
+        client.disconnect()
+
+    def test_stale_socket(self):
+        # Left over by a server that did not stop cleanly
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(self.path)
+
+        server = self.start_server(unix_path=self.path)
+        self.assertTrue(stat.S_ISSOCK(os.stat(self.path).st_mode))
+
+        client = Client()
+        self.assertEqual(client.connect(f"unix://{self.path}").result(1), 0)
+        client.disconnect()
+
+        server.stop()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_socket_in_use(self):
+        self.start_server(unix_path=self.path)
+
+        # The running server's socket is neither removed nor replaced
+        other = Server(port=0, unix_path=self.path)
+        with self.assertRaises(OSError):
+            other.listen(other.unix_socket, self.path)
+
+        other.unix_socket.close()
+        other.socket.close()
+
+        client = Client()
+        self.assertEqual(client.connect(f"unix://{self.path}").result(1), 0)
+        client.disconnect()
+
+if __name__ == "__main__":
+    unittest.main()